@@ -0,0 +1,708 @@
+"""
+Benchmarks of the execution modes of the networks on synthetic data of the same size as the patient data.
+
+Example:
+
+    >>>python benchmark.py --mode compile --training_model attention_unet --fitting_model biexp --batch_size 4
+"""
+from model.networks import build_net, parse_training_model
+from model.fusion import fold_batchnorm, is_folded
+from model.quantization import quantize_trunk
+from model.tiling import TiledNet
+from utils import CustomLoss, LinearWarmup, scale_learning_rate, to_channels_last, explain_graph_breaks, amp_autocast
+import argparse
+import copy
+import csv
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the networks on synthetic data')
+    parser.add_argument('--mode', '-m', default='compile', choices=list(MODES), help='Which benchmark to run')
+    parser.add_argument('--training_model', '-trn', default='attention_unet', help='Network model: unet, attention_unet or res_atten_unet, or a variant such as unet_w0.5_dw')
+    parser.add_argument('--fitting_model', '-fit', default='biexp', help='Fitting model: biexp, kurtosis or gamma')
+    parser.add_argument('--batch_size', '-b', type=int, default=4, help='Number of slices per forward pass')
+    parser.add_argument('--height', type=int, default=200, help='Image height after cropping')
+    parser.add_argument('--width', type=int, default=240, help='Image width')
+    parser.add_argument('--use_3D', '-3d', action='store_true', help='If 3D')
+    parser.add_argument('--repeats', '-r', type=int, default=5, help='Number of timed repetitions')
+    parser.add_argument('--warmup', '-w', type=int, default=2, help='Number of untimed repetitions before timing, e.g. for compilation')
+    parser.add_argument('--threads', '-t', type=int, default=0, help='Number of CPU threads, 0 keeps the torch default')
+    parser.add_argument('--device', default='cpu', help='Device to benchmark on, e.g. cpu or cuda:0')
+    parser.add_argument('--load', '-f', type=str, default=None, help='Optional .pth file with trained weights, otherwise the networks are randomly initialized')
+    parser.add_argument('--memory_budget', type=float, default=24, help='Device memory in GiB, used to estimate the maximum batch size and as memory budget of the tiling benchmark')
+    parser.add_argument('--calibration_batches', '-cal', type=int, default=4, help='Number of synthetic batches used to calibrate the int8 quantization')
+    parser.add_argument('--processes', '-np', type=str, default='1,2,4', help='Numbers of CPU training processes compared by the scaling benchmark, separated by commas')
+    parser.add_argument('--steps', type=int, default=60, help='Optimizer steps of each run of the scaling benchmark')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate of one process with batch_size slices per step in the scaling benchmark, scaled linearly with the processes')
+    parser.add_argument('--lr_warmup', type=int, default=10, help='Warmup steps of the learning rate in the scaling benchmark')
+    parser.add_argument('--scaling_csv', type=str, default=None, help='CSV file the table of the scaling benchmark is written to, with the cores and settings of the run')
+    return parser.parse_args()
+
+
+def synthetic_batch(args, device):
+    """
+    Random inputs shaped like one batch from *patientDataset*.
+
+    :return: tuple (images, b, image_b0, sigma, scale_factor)
+    """
+    n_channels = 60 if args.use_3D else 20
+    images = torch.rand(args.batch_size, n_channels, args.height, args.width, device=device)
+    image_b0 = torch.rand(args.batch_size, 1, args.height, args.width, device=device)
+    sigma = 0.05 * torch.rand(args.batch_size, 1, args.height, args.width, device=device)
+    scale_factor = torch.full((args.batch_size,), 1000., device=device)
+    b = torch.linspace(0, 2000, steps=21, device=device)[1:].reshape(1, 20, 1, 1)
+    return images, b, image_b0, sigma, scale_factor
+
+
+def make_net(args, device, **kwargs):
+    """Network with input_sigma, feed_sigma and estimate_S0 enabled, as in the sweep configuration"""
+    n_channels = 60 if args.use_3D else 20
+    net = build_net(args.training_model, n_channels, input_sigma=True, fitting_model=args.fitting_model,
+                    use_3D=args.use_3D, estimate_S0=True, feed_sigma=True, **kwargs)
+    if args.load:
+        checkpoint = {k.replace('module.', ''): v for k, v in torch.load(args.load, map_location='cpu', weights_only=True).items()}
+        if is_folded(checkpoint):
+            fold_batchnorm(net)
+        net.load_state_dict(checkpoint)
+    return net.to(device)
+
+
+def time_fn(fn, repeats, warmup, device):
+    """
+    Mean wall-clock time in seconds of *fn()* over *repeats* calls, after *warmup* untimed calls.
+    """
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def activation_bytes(net, inputs):
+    """
+    Bytes of all activations produced by the leaf modules of *net* in one forward pass of *inputs*.
+    A device independent estimate of the activation memory kept for the backward pass.
+    """
+    total = [0]
+
+    def hook(module, inp, out):
+        if torch.is_tensor(out):
+            total[0] += out.numel() * out.element_size()
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if len(list(m.children())) == 0]
+    try:
+        net(*inputs)
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
+
+
+def conv_flops(net, inputs):
+    """
+    Floating point operations (2 per multiply-add) of all convolutions of *net* in one forward pass of *inputs*.
+    The convolutions are nearly all of the compute of the networks.
+    """
+    total = [0]
+
+    def hook(module, inp, out):
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        if isinstance(module, torch.nn.ConvTranspose2d):
+            total[0] += 2 * inp[0].numel() * module.out_channels // module.groups * kernel
+        else:
+            total[0] += 2 * out.numel() * module.in_channels // module.groups * kernel
+
+    handles = [m.register_forward_hook(hook) for m in net.modules() if isinstance(m, (torch.nn.Conv2d, torch.nn.ConvTranspose2d))]
+    try:
+        net(*inputs)
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
+
+
+def parameter_map_errors(param_dict, reference):
+    """
+    Mean absolute and maximum relative error of each parameter map in *param_dict* against *reference*.
+
+    :return: dict {parameter name: (mean_abs_error, max_rel_error)}
+    """
+    errors = {}
+    for index, name in enumerate(reference['names']):
+        if name in errors:
+            continue#Only first diffusion direction, as for the logged parameter maps
+        res = param_dict['parameters'][index].float()
+        ref = reference['parameters'][index].float()
+        diff = torch.abs(res - ref)
+        errors[name] = (diff.mean().item(), (diff / ref.abs().clamp_min(1e-6)).max().item())
+    return errors
+
+
+def train_step_memory(args, device, batch_size, **net_kwargs):
+    """
+    Peak memory in bytes of one training step (forward, loss and backward) with *batch_size* slices,
+    including the network parameters and gradients. On CUDA from the allocator statistics, on CPU from the memory
+    timeline of the profiler, as there are no allocator statistics for CPU memory.
+    """
+    allocated = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0#E.g. other networks of the benchmark
+    torch.manual_seed(0)
+    criterion = CustomLoss().to(device)
+    net = make_net(args, device, **net_kwargs).train()
+    images, b, image_b0, sigma, scale_factor = synthetic_batch(argparse.Namespace(**{**vars(args), 'batch_size': batch_size}), device)
+
+    def train_step():
+        M, _ = net(images, b, image_b0, sigma, scale_factor)
+        criterion.update_data_range(torch.max(images))
+        criterion(M, images, ssim_bool=True).backward()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        train_step()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - allocated
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True, record_shapes=True, with_stack=True) as prof:
+        train_step()
+    with tempfile.TemporaryDirectory() as tmp:
+        prof.export_memory_timeline(os.path.join(tmp, 'memory.json'), device='cpu')
+        with open(os.path.join(tmp, 'memory.json')) as f:
+            times, sizes = json.load(f)#sizes: bytes per memory category at each time
+    return max(sum(size) for size in sizes)
+
+
+def print_table(header, rows):
+    """Print *rows* (list of tuples) as an aligned table below *header*"""
+    widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+    for r in [header] + rows:
+        print('  '.join(str(v).ljust(w) for v, w in zip(r, widths)))
+
+
+def benchmark_compile(args, device):
+    """
+    Eager versus channels_last versus torch.compile, for inference and for one training step (forward, loss and backward).
+    """
+    criterion = CustomLoss().to(device)
+    rows = []
+    for channels_last, compiled in [(False, False), (True, False), (False, True), (True, True)]:
+        torch.manual_seed(0)
+        net = make_net(args, device)
+        images, b, image_b0, sigma, scale_factor = synthetic_batch(args, device)
+        if channels_last:
+            net = net.to(memory_format=torch.channels_last)
+            images, sigma, image_b0 = to_channels_last(images, sigma, image_b0)
+
+        def loss_step():
+            M, _ = net(images, b, image_b0, sigma, scale_factor)
+            criterion.update_data_range(torch.max(images))
+            return criterion(M, images, ssim_bool=True)
+
+        def train_step():
+            loss = run_loss_step()
+            loss.backward()
+            net.zero_grad(set_to_none=True)
+
+        def inference():
+            with torch.no_grad():
+                run_net(images, b, image_b0, sigma, scale_factor)
+
+        if compiled:
+            print(f'\nGraph breaks (channels_last={channels_last}):')
+            net.eval()
+            with torch.no_grad():
+                explain_graph_breaks(net, images, b, image_b0, sigma, scale_factor)
+            net.train()
+            with torch.no_grad():
+                explain_graph_breaks(loss_step)
+            torch._dynamo.reset()
+        run_net = torch.compile(net) if compiled else net
+        run_loss_step = torch.compile(loss_step) if compiled else loss_step
+
+        net.eval()
+        t_inference = time_fn(inference, args.repeats, args.warmup, device)
+        net.train()
+        t_train = time_fn(train_step, args.repeats, args.warmup, device)
+        rows.append((str(channels_last), str(compiled), f'{t_inference * 1000:.1f}', f'{t_train * 1000:.1f}'))
+        torch._dynamo.reset()
+
+    print(f'\n{args.training_model}/{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('channels_last', 'compiled', 'inference [ms]', 'train step [ms]'), rows)
+
+
+def benchmark_amp(args, device):
+    """
+    float32 versus mixed precision: inference time, activation memory, training step time
+    and the accuracy of the parameter maps and M relative to float32.
+    """
+    criterion = CustomLoss().to(device)
+    torch.manual_seed(0)
+    net = make_net(args, device).eval()
+    images, b, image_b0, sigma, scale_factor = synthetic_batch(args, device)
+    inputs = (images, b, image_b0, sigma, scale_factor)
+    with torch.no_grad():
+        M_ref, reference = net(*inputs)
+
+    rows = []
+    error_rows = []
+    for amp in [None, 'bf16'] + (['fp16'] if device.type == 'cuda' else []):
+        def inference():
+            with torch.no_grad(), amp_autocast(amp, device.type):
+                return net(*inputs)
+
+        train_net = copy.deepcopy(net).train()#Keeps the BatchNorm statistics of *net* untouched
+
+        def train_step():
+            with amp_autocast(amp, device.type):
+                M, _ = train_net(*inputs)
+            criterion.update_data_range(torch.max(images))
+            criterion(M, images, ssim_bool=True).backward()
+            train_net.zero_grad(set_to_none=True)
+
+        with torch.no_grad(), amp_autocast(amp, device.type):
+            memory = activation_bytes(net, inputs)
+        t_inference = time_fn(inference, args.repeats, args.warmup, device)
+        t_train = time_fn(train_step, args.repeats, args.warmup, device)
+
+        M, param_dict = inference()
+        rows.append((amp or 'fp32', f'{memory / 2**20:.1f}', f'{t_inference * 1000:.1f}', f'{t_train * 1000:.1f}',
+                     f'{torch.abs(M - M_ref).max().item():.2e}'))
+        for name, (mean_abs, max_rel) in parameter_map_errors(param_dict, reference).items():
+            error_rows.append((amp or 'fp32', name, f'{mean_abs:.2e}', f'{max_rel:.2e}'))
+
+    print(f'\n{args.training_model}/{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('precision', 'activations [MiB]', 'inference [ms]', 'train step [ms]', 'max |M - M_fp32|'), rows)
+    print('\nParameter maps against float32:')
+    print_table(('precision', 'parameter', 'mean abs error', 'max rel error'), error_rows)
+
+
+def benchmark_fold(args, device):
+    """
+    BatchNorm folded into the convolutions versus the trained network: inference time, time to load the
+    state_dict into a constructed network, and the deviation of M and the parameter maps.
+    """
+    torch.manual_seed(0)
+    net = make_net(args, device).eval()
+    for module in net.modules():#Non-trivial BatchNorm statistics, as after training
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+    folded = fold_batchnorm(copy.deepcopy(net))
+    inputs = synthetic_batch(args, device)
+
+    rows = []
+    outputs = {}
+    for name, model in [('trained', net), ('folded', folded)]:
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        size = buffer.tell()
+
+        def load():
+            buffer.seek(0)
+            model.load_state_dict(torch.load(buffer, map_location=device, weights_only=True))
+
+        def inference():
+            with torch.no_grad():
+                return model(*inputs)
+
+        t_load = time_fn(load, args.repeats, 1, device)
+        t_inference = time_fn(inference, args.repeats, args.warmup, device)
+        outputs[name] = inference()
+        rows.append((name, f'{size / 2**20:.1f}', f'{t_load * 1000:.1f}', f'{t_inference * 1000:.1f}'))
+
+    print(f'\n{args.training_model}/{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('network', 'state_dict [MiB]', 'load [ms]', 'inference [ms]'), rows)
+    M, param_dict = outputs['folded']
+    M_ref, reference = outputs['trained']
+    print(f'\nmax |M - M_trained|: {torch.abs(M - M_ref).max().item():.2e}')
+    print_table(('parameter', 'mean abs error', 'max rel error'),
+                [(name, f'{mean_abs:.2e}', f'{max_rel:.2e}') for name, (mean_abs, max_rel) in parameter_map_errors(param_dict, reference).items()])
+
+
+def benchmark_int8(args, device):
+    """
+    int8 trunk versus float32 on CPU: inference time per batch and per patient, and the
+    accuracy of M and the parameter maps relative to float32.
+    """
+    assert device.type == 'cpu', 'Error: int8 inference only runs on CPU'
+    torch.manual_seed(0)
+    net = make_net(args, device).eval()
+    calibration = []
+    for _ in range(args.calibration_batches):
+        images, b, image_b0, sigma, scale_factor = synthetic_batch(args, device)
+        calibration.append((images, sigma))
+    quantized = quantize_trunk(copy.deepcopy(net), calibration)
+    inputs = synthetic_batch(args, device)
+    slices = 22 if args.use_3D else 66#Slices per patient
+
+    rows = []
+    outputs = {}
+    for name, model in [('fp32', net), ('int8', quantized)]:
+        def inference():
+            with torch.no_grad():
+                return model(*inputs)
+
+        t_inference = time_fn(inference, args.repeats, args.warmup, device)
+        outputs[name] = inference()
+        rows.append((name, f'{t_inference * 1000:.1f}', f'{t_inference * slices / args.batch_size:.2f}'))
+    t_fp32 = float(rows[0][1])
+    rows = [r + (f'{t_fp32 / float(r[1]):.2f}',) for r in rows]
+
+    print(f'\n{args.training_model}/{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('precision', 'inference [ms]', 'per patient [s]', 'speedup'), rows)
+    M, param_dict = outputs['int8']
+    M_ref, reference = outputs['fp32']
+    print(f'\nmax |M - M_fp32|: {torch.abs(M - M_ref).max().item():.2e}')
+    print_table(('parameter', 'mean abs error', 'max rel error'),
+                [(name, f'{mean_abs:.2e}', f'{max_rel:.2e}') for name, (mean_abs, max_rel) in parameter_map_errors(param_dict, reference).items()])
+
+
+def benchmark_checkpointing(args, device):
+    """
+    Activation checkpointing of the encoder, decoder and attention stages versus storing all activations:
+    training step time, peak memory of a training step and the maximum batch size it allows within *args.memory_budget*.
+    """
+    assert args.batch_size > 1, 'Error: The memory per slice is measured between batch size 1 and --batch_size, pass at least 2'
+    criterion = CustomLoss().to(device)
+    rows = []
+    for checkpointing in [False, True]:
+        torch.manual_seed(0)
+        net = make_net(args, device, checkpointing=checkpointing).train()
+        images, b, image_b0, sigma, scale_factor = synthetic_batch(args, device)
+
+        def train_step():
+            M, _ = net(images, b, image_b0, sigma, scale_factor)
+            criterion.update_data_range(torch.max(images))
+            criterion(M, images, ssim_bool=True).backward()
+            net.zero_grad(set_to_none=True)
+
+        t_train = time_fn(train_step, args.repeats, args.warmup, device)
+        memory = train_step_memory(args, device, args.batch_size, checkpointing=checkpointing)
+        #Memory grows linearly with the batch size, on top of a fixed part for parameters and gradients
+        per_slice = (memory - train_step_memory(args, device, 1, checkpointing=checkpointing)) / (args.batch_size - 1)
+        fixed = memory - args.batch_size * per_slice
+        rows.append((str(checkpointing), f'{t_train * 1000:.1f}', f'{memory / 2**20:.0f}', f'{per_slice / 2**20:.0f}',
+                     str(int((args.memory_budget * 2**30 - fixed) // per_slice))))
+
+    print(f'\n{args.training_model}/{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('checkpointing', 'train step [ms]', 'peak step memory [MiB]', 'per slice [MiB]', f'max batch in {args.memory_budget:g} GiB'), rows)
+
+
+def benchmark_variants(args, device):
+    """
+    Width multipliers and depthwise-separable convolutions of the network model of *args.training_model*:
+    parameters, FLOPs per slice and inference time.
+    """
+    model, _ = parse_training_model(args.training_model)
+    rows = []
+    for width in [1.0, 0.5, 0.25]:
+        for separable in [False, True]:
+            name = model + (f'_w{width:g}' if width != 1 else '') + ('_dw' if separable else '')
+            torch.manual_seed(0)
+            net = make_net(argparse.Namespace(**{**vars(args), 'training_model': name}), device).eval()
+            inputs = synthetic_batch(args, device)
+
+            def inference():
+                with torch.no_grad():
+                    return net(*inputs)
+
+            with torch.no_grad():
+                flops = conv_flops(net, inputs) / args.batch_size
+            params = sum(p.numel() for p in net.parameters())
+            t_inference = time_fn(inference, args.repeats, args.warmup, device)
+            rows.append((name, f'{params / 1e6:.2f}', f'{flops / 1e9:.1f}', f'{t_inference * 1000:.1f}'))
+
+    print(f'\n{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('training_model', 'params [M]', 'GFLOPs per slice', 'inference [ms]'), rows)
+
+
+def benchmark_stem(args, device):
+    """
+    Input layer of use_3D: the dense stem over all 60 channels versus the per diffusion direction stems 'grouped'
+    (own filters per direction) and 'shared' (same filters for every direction), see *DirectionStem*.
+    Parameters, FLOPs per slice of the input layer and of the whole network, inference and training step time.
+    """
+    args = argparse.Namespace(**{**vars(args), 'use_3D': True})
+    criterion = CustomLoss().to(device)
+    rows = []
+    for stem in ['dense', 'grouped', 'shared']:
+        name = args.training_model + (f'_{stem}_stem' if stem != 'dense' else '')
+        torch.manual_seed(0)
+        net = make_net(argparse.Namespace(**{**vars(args), 'training_model': name}), device)
+        images, b, image_b0, sigma, scale_factor = synthetic_batch(args, device)
+
+        def inference():
+            with torch.no_grad():
+                return net(images, b, image_b0, sigma, scale_factor)
+
+        def train_step():
+            M, _ = net(images, b, image_b0, sigma, scale_factor)
+            criterion.update_data_range(torch.max(images))
+            criterion(M, images, ssim_bool=True).backward()
+            net.zero_grad(set_to_none=True)
+
+        net.eval()
+        with torch.no_grad():
+            stem_flops = conv_flops(net.inc, (torch.cat([images, sigma], dim=1),)) / args.batch_size
+            flops = conv_flops(net, (images, b, image_b0, sigma, scale_factor)) / args.batch_size
+        params = sum(p.numel() for p in net.parameters())
+        t_inference = time_fn(inference, args.repeats, args.warmup, device)
+        net.train()
+        t_train = time_fn(train_step, args.repeats, args.warmup, device)
+        rows.append((name, f'{params / 1e6:.2f}', f'{stem_flops / 1e9:.2f}', f'{flops / 1e9:.1f}', f'{t_inference * 1000:.1f}', f'{t_train * 1000:.1f}'))
+
+    print(f'\n{args.fitting_model}, batch {args.batch_size}x60x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('training_model', 'params [M]', 'stem GFLOPs per slice', 'GFLOPs per slice', 'inference [ms]', 'train step [ms]'), rows)
+
+
+def benchmark_tiling(args, device):
+    """
+    Tiled sliding-window inference versus full-slice inference: slice batch and tile size of each setting, activation
+    memory of one forward pass (measured peak on CUDA, estimate of *TiledNet.probe_memory* on CPU), inference time and
+    the difference of the parameter maps, mean absolute error relative to the mean of each map and the worst map.
+    """
+    torch.manual_seed(0)
+    net = make_net(args, device).eval()
+    inputs = synthetic_batch(args, device)
+    with torch.no_grad():
+        M_reference, reference = net(*inputs)
+        bytes_per_voxel = TiledNet(net).probe_memory(*inputs)
+    settings = [('full slices', {}),
+                ('slice batch 1', {'slice_batch': 1}),
+                ('tile 128, overlap 32, linear', {'tile_size': 128, 'overlap': 32}),
+                ('tile 128, overlap 32, gaussian', {'tile_size': 128, 'overlap': 32, 'blending': 'gaussian'}),
+                ('tile 128, overlap 16, constant', {'tile_size': 128, 'overlap': 16, 'blending': 'constant'}),
+                ('tile 96, overlap 32, linear', {'tile_size': 96, 'overlap': 32}),
+                (f'budget {args.memory_budget:g} GiB', {'memory_budget': args.memory_budget})]
+    rows = []
+    for name, kwargs in settings:
+        tiled = TiledNet(net, **kwargs)
+
+        def inference():
+            with torch.no_grad():
+                return tiled(*inputs)
+
+        slice_batch, tile_height, tile_width = tiled.plan(*inputs)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            start = torch.cuda.memory_allocated(device)
+            M, param_dict = inference()
+            memory = torch.cuda.max_memory_allocated(device) - start
+        else:
+            M, param_dict = inference()
+            memory = bytes_per_voxel * slice_batch * tile_height * tile_width
+        errors = parameter_map_errors(param_dict, reference)
+        relative = max(mean_abs / reference['parameters'][reference['names'].index(p)].abs().mean().item() for p, (mean_abs, _) in errors.items())
+        M_error = (torch.abs(M - M_reference).max() / M_reference.abs().max()).item()
+        t_inference = time_fn(inference, args.repeats, args.warmup, device)
+        rows.append((name, str(slice_batch), f'{tile_height}x{tile_width}', f'{memory / 2**20:.0f}', f'{t_inference * 1000:.1f}', f'{relative:.1e}', f'{M_error:.1e}'))
+
+    print(f'\n{args.training_model}/{args.fitting_model}, batch {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('setting', 'slice batch', 'tile', 'activation memory [MiB]', 'inference [ms]', 'parameter error (relative)', 'M max error (relative)'), rows)
+
+
+def benchmark_loss(args, device):
+    """
+    The loss of utils.CustomLoss against the previous implementation with pytorch_msssim.MS_SSIM, for 1, 20 and 60
+    channels at the same data range: value, relative difference of value and gradient, forward and backward time.
+    """
+    from pytorch_msssim import MS_SSIM#Only the reference implementation needs it
+
+    rows = []
+    for n_channels in [1, 20, 60]:
+        torch.manual_seed(0)
+        images = 1000 * torch.rand(args.batch_size, n_channels, args.height, args.width, device=device)
+        M = (images + 50 * torch.randn_like(images)).relu()
+        data_range = torch.max(images)
+        reference_ssim = MS_SSIM(channel=n_channels, win_size=5, data_range=data_range)
+        criterion = CustomLoss().to(device)
+        criterion.update_data_range(data_range)
+
+        def reference_loss(M):
+            return (1 - reference_ssim(M, images)) * torch.nn.functional.l1_loss(M, images)
+
+        def fused_loss(M):
+            return criterion(M, images, ssim_bool=True)
+
+        values, gradients, times = [], [], []
+        for loss_fn in [reference_loss, fused_loss]:
+            M_grad = M.clone().requires_grad_(True)
+            value = loss_fn(M_grad)
+            value.backward()
+            values.append(value.item())
+            gradients.append(M_grad.grad)
+
+            def step():
+                loss_fn(M_grad).backward()
+                M_grad.grad = None
+
+            times.append(time_fn(step, args.repeats, args.warmup, device))
+        value_error = abs(values[1] - values[0]) / abs(values[0])
+        gradient_error = (torch.abs(gradients[1] - gradients[0]).max() / gradients[0].abs().max()).item()
+        rows.append((str(n_channels), f'{values[0]:.6f}', f'{values[1]:.6f}', f'{value_error:.1e}', f'{gradient_error:.1e}',
+                     f'{times[0] * 1000:.1f}', f'{times[1] * 1000:.1f}', f'{times[0] / times[1]:.2f}'))
+
+    print(f'\nbatch {args.batch_size}xCx{args.height}x{args.width}, device {device}, {torch.get_num_threads()} threads')
+    print_table(('channels', 'pytorch_msssim', 'fused', 'value error', 'gradient error', 'pytorch_msssim [ms]', 'fused [ms]', 'speedup'), rows)
+
+
+def decay_batch(n_slices, args, generator):
+    """
+    Synthetic slices with a learnable signal: mono-exponential decay over the b-values of smooth random S0 and
+    ADC maps, plus noise. Unlike the uniform noise of *synthetic_batch*, the loss decreases with training.
+
+    :return: tuple (images, b, image_b0, sigma, scale_factor)
+    """
+    n_directions = 3 if args.use_3D else 1
+    def smooth(low, high):
+        coarse = torch.rand(n_slices, 1, args.height // 16, args.width // 16, generator=generator)
+        return low + (high - low) * F.interpolate(coarse, size=(args.height, args.width), mode='bilinear', align_corners=False)
+    b = torch.linspace(0, 2000, steps=21)[1:].reshape(1, 20, 1, 1)
+    image_b0 = smooth(0.5, 1.0)
+    adc = smooth(0.5e-3, 2.5e-3)
+    sigma = torch.full((n_slices, 1, args.height, args.width), 0.02)
+    images = (image_b0 * torch.exp(-b * adc)).repeat(1, n_directions, 1, 1)
+    images = images + sigma * torch.randn(images.shape, generator=generator)
+    scale_factor = torch.full((n_slices,), 1000.)
+    return images, b, image_b0, sigma, scale_factor
+
+
+def scaling_worker(rank, world_size, args, port, result_file):
+    """
+    One process of *benchmark_scaling*: trains with DDP over gloo on its share of each global batch. The global batches
+    are the same sequence of slices for every number of processes. Each process is pinned to its own block of cores where
+    the OS allows it. Process 0 writes the loss and time of every step.
+    """
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        block = cores[rank * len(cores) // world_size:(rank + 1) * len(cores) // world_size] or [cores[rank % len(cores)]]#Shared core with fewer cores than processes
+        os.sched_setaffinity(0, block)
+        torch.set_num_threads(len(block))
+    else:
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    device = torch.device('cpu')
+
+    images, b, image_b0, sigma, scale_factor = decay_batch(4 * args.batch_size * max(int(n) for n in args.processes.split(',')), args, torch.Generator().manual_seed(1))
+    torch.manual_seed(0)
+    net = torch.nn.parallel.DistributedDataParallel(make_net(args, device))
+    global_batch = world_size * args.batch_size
+    optimizer = torch.optim.Adam(net.parameters(), lr=scale_learning_rate(args.lr, global_batch, args.batch_size, 'linear'))
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=2)
+    warmup = LinearWarmup(optimizer, args.lr_warmup)
+    criterion = CustomLoss()
+
+    history = []
+    start = time.perf_counter()
+    for step in range(args.steps):
+        index = (step * global_batch + rank * args.batch_size + torch.arange(args.batch_size)) % len(images)
+        M, _ = net(images[index], b, image_b0[index], sigma[index].clone(), scale_factor[index])
+        criterion.update_data_range(torch.max(images[index]))
+        loss = criterion(M, images[index], ssim_bool=True)
+        loss.backward()
+        torch.nn.utils.clip_grad_value_(net.parameters(), clip_value=1)
+        optimizer.step()
+        optimizer.zero_grad()
+        warmup.step()
+        mean_loss = loss.detach().clone()
+        dist.all_reduce(mean_loss)
+        history.append((time.perf_counter() - start, mean_loss.item() / world_size))
+        if (step + 1) % 20 == 0:
+            scheduler.step(mean_loss)#Stands in for the validation loss of an epoch
+    if rank == 0:
+        with open(result_file, 'w') as f:
+            json.dump(history, f)
+    dist.destroy_process_group()
+
+
+def benchmark_scaling(args, device):
+    """
+    Scaling study of distributed training on CPU processes with linear learning rate scaling and warmup: every process
+    trains *batch_size* slices per step, the learning rate is scaled with the number of processes. The target loss is
+    the final loss of the first run (moving average over 5 steps). Reported are the steps, slices and wall-clock time
+    each run needs to reach it.
+
+    The wall-clock time only measures the scaling if every process has its own cores. With fewer cores than processes,
+    the processes share them and only the steps and slices to the target are meaningful.
+    """
+    assert device.type == 'cpu', 'Error: The scaling benchmark trains on CPU processes'
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if cores < max(int(n) for n in args.processes.split(',')):
+        print(f'-Warning: {cores} cores for up to {args.processes.split(",")[-1]} processes. The processes share cores, the times to the target do not show the speedup of more processes')
+    runs = []
+    for world_size in [int(n) for n in args.processes.split(',')]:
+        with socket.socket() as s:
+            s.bind(('', 0))
+            port = s.getsockname()[1]
+        with tempfile.TemporaryDirectory() as folder:
+            result_file = os.path.join(folder, 'history.json')
+            mp.spawn(scaling_worker, args=(world_size, args, port, result_file), nprocs=world_size)
+            with open(result_file) as f:
+                history = json.load(f)
+        times = [t for t, _ in history]
+        losses = torch.tensor([loss for _, loss in history])
+        smoothed = torch.stack([losses[max(0, i - 4):i + 1].mean() for i in range(len(losses))])#Moving average over 5 steps
+        runs.append((world_size, times, smoothed))
+
+    target = runs[0][2][-1].item()
+    rows = []
+    for world_size, times, smoothed in runs:
+        reached = torch.nonzero(smoothed <= target).flatten()
+        lr = scale_learning_rate(args.lr, world_size * args.batch_size, args.batch_size, 'linear')
+        if len(reached):
+            step = reached[0].item()
+            rows.append((str(world_size), str(world_size * args.batch_size), f'{lr:.1e}', str(step + 1), str((step + 1) * world_size * args.batch_size),
+                         f'{times[step]:.1f}', f'{runs[0][1][-1] / times[step]:.2f}', f'{smoothed[-1].item():.4f}'))
+        else:
+            rows.append((str(world_size), str(world_size * args.batch_size), f'{lr:.1e}', '-', '-', '-', '-', f'{smoothed[-1].item():.4f}'))
+
+    print(f'\n{args.training_model}, {args.fitting_model}, {args.batch_size}x{60 if args.use_3D else 20}x{args.height}x{args.width} per process, '
+          f'{args.steps} steps, {cores} cores, target loss {target:.4f}')
+    header = ('processes', 'global batch', 'lr', 'steps to target', 'slices to target', 'time to target [s]', 'speedup', 'final loss')
+    print_table(header, rows)
+    if args.scaling_csv:
+        settings = {'training_model': args.training_model, 'fitting_model': args.fitting_model, 'slices per process': args.batch_size,
+                    'height': args.height, 'width': args.width, 'steps': args.steps, 'cores': cores, 'target loss': f'{target:.4f}'}
+        with open(args.scaling_csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header + tuple(settings))
+            writer.writerows(row + tuple(str(v) for v in settings.values()) for row in rows)
+        print(f'Saved the table to {args.scaling_csv}')
+
+
+MODES = {
+    'compile': benchmark_compile,
+    'amp': benchmark_amp,
+    'fold': benchmark_fold,
+    'int8': benchmark_int8,
+    'checkpointing': benchmark_checkpointing,
+    'variants': benchmark_variants,
+    'stem': benchmark_stem,
+    'tiling': benchmark_tiling,
+    'loss': benchmark_loss,
+    'scaling': benchmark_scaling,
+}
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    MODES[args.mode](args, device)
@@ -0,0 +1,173 @@
+"""
+Export trained checkpoints to inference-optimized versions. The folder structure
+<model>/<fitting_model>/run_N/<file>.pth of *--load* is mirrored in *--output*, so predict.py can be pointed at the exported folder.
+
+Example:
+
+    >>>python export.py -f /TANK/mustafa/checkpoints/cross_validation_l1_ssim_s0est -o /TANK/mustafa/exported/cross_validation_l1_ssim_s0est -s -s0 -fs
+
+    >>>python export.py -f /TANK/mustafa/checkpoints/cross_validation_l1_ssim_s0est -o /TANK/mustafa/onnx/cross_validation_l1_ssim_s0est -fmt onnx -s -s0 -fs
+
+    >>>python export.py -f /TANK/mustafa/checkpoints/cross_validation_l1_ssim_s0est -o /TANK/mustafa/torchscript/cross_validation_l1_ssim_s0est -fmt torchscript -s -s0 -fs
+"""
+from predict import index_files, extract_file_name_folders, load_net
+from model.fusion import fold_batchnorm
+from pathlib import Path
+import argparse
+import json
+import os
+import torch
+import torch.nn as nn
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export trained networks for inference')
+    parser.add_argument('--load', '-f', type=str, required=True, help='Folder with the trained .pth files, same layout as for predict.py')
+    parser.add_argument('--output', '-o', type=str, required=True, help='Folder the exported networks are written to')
+    parser.add_argument('--format', '-fmt', type=str, default='folded', choices=['folded', 'onnx', 'torchscript'],
+                        help='folded: state_dict with BatchNorm folded into the convolutions. '
+                             'onnx: network and physics head as ONNX graph, for predict.py --backend onnxruntime. '
+                             'torchscript: standalone traced network, physics head and b-values, for predict.py --backend torchscript')
+    parser.add_argument('--filter', '-filter', type=str, default='', help='Filter neural network models to export, for example -filter attention_unet.')
+    parser.add_argument('--rice', '-rice', action='store_true', help='Use this flag if Rician bias is added during inference')
+    parser.add_argument('--use_3D', '-3d', action='store_true', help='If 3D')
+    parser.add_argument('--learn_sigma_scaling', '-ss', type=str, help='Pass True if AI was allowed to learn scaling sigma')
+    parser.add_argument('--input_sigma', '-s', action='store_true', help='If a known noise map was inputted.')
+    parser.add_argument('--estimate_S0', '-s0', action='store_true', help='Pass if allowed AI to estimate S0-image')
+    parser.add_argument('--feed_sigma', '-fs', action='store_true', help='Pass if feeding sigma map to AI. Input sigma has to be true')
+    args = parser.parse_args()
+    args.fold_bn = False#Folding is done by the export itself
+    return args
+
+
+def export_folded(net, save_path: Path, file_name: str):
+    """
+    Save the state_dict of *net* with BatchNorm folded into the convolutions.
+    """
+    fold_batchnorm(net)
+    torch.save(net.state_dict(), str(save_path / f'{file_name}.pth'))
+
+
+class ExportWrapper(nn.Module):
+    """Network with the parameter dictionary flattened to tensors, as traced exports only allow tensor outputs"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, images, b, b0, sigma, scale_factor):
+        M, param_dict = self.net(images, b, b0, sigma, scale_factor)
+        return M, param_dict['parameters'], param_dict['sigma']
+
+
+class StandaloneWrapper(ExportWrapper):
+    """ExportWrapper with the b-values stored in the module, so the artifact needs no other inputs than the dataset provides"""
+
+    def __init__(self, net, b):
+        super().__init__(net)
+        self.register_buffer('b', b)
+
+    def forward(self, images, b0, sigma, scale_factor):
+        return super().forward(images, self.b, b0, sigma, scale_factor)
+
+
+def network_config(model_name: str, fitting_name: str, names: list, args):
+    """Configuration stored with exported networks, read by predict.py instead of the CLI flags"""
+    return {
+        'training_model': model_name,
+        'fitting_model': fitting_name,
+        'input_sigma': args.input_sigma,
+        'estimate_S0': args.estimate_S0,
+        'use_3D': args.use_3D,
+        'feed_sigma': args.feed_sigma,
+        'rice': args.rice,
+        'names': names,
+    }
+
+
+def example_inputs(n_channels: int):
+    """
+    Random inputs shaped like two slices from *patientDataset*, used for tracing.
+
+    :return: tuple (images, b, b0, sigma, scale_factor)
+    """
+    images = torch.rand(2, n_channels, 200, 240)
+    b0 = torch.rand(2, 1, 200, 240)
+    sigma = 0.05 * torch.rand(2, 1, 200, 240)
+    scale_factor = torch.full((2,), 1000.)
+    b = torch.linspace(0, 2000, steps=21)[1:].reshape(1, 20, 1, 1)
+    return images, b, b0, sigma, scale_factor
+
+
+def export_onnx(net, save_path: Path, file_name: str, model_name: str, fitting_name: str, args):
+    """
+    Export *net* including the physics head to ONNX, with dynamic batch size and image size.
+    The configuration of the network and the parameter names are stored in the metadata of the model,
+    so predict.py --backend onnxruntime does not need the model classes or CLI flags to run it.
+
+    Outputs: M (n_batches, n_channels, H, W), parameters (num_par, n_batches, H, W) and sigma (n_batches, 1, H, W).
+    Inputs that the network does not use, e.g. b0 if estimate_S0, are removed from the graph by the export.
+    """
+    import onnx#Only needed for this format
+
+    wrapper = ExportWrapper(net).eval()#torch.onnx.export restores the mode of *wrapper*, which would otherwise put *net* in train mode
+    inputs = example_inputs(net.n_channels)
+    with torch.no_grad():
+        names = net(*[x.clone() for x in inputs])[1]['names']
+    image_axes = {0: 'batch', 2: 'height', 3: 'width'}
+    onnx_file = str(save_path / f'{file_name}.onnx')
+    torch.onnx.export(wrapper, inputs, onnx_file, opset_version=17,
+                      input_names=['images', 'b', 'b0', 'sigma', 'scale_factor'],
+                      output_names=['M', 'parameters', 'sigma_map'],
+                      dynamic_axes={'images': image_axes, 'b0': image_axes, 'sigma': image_axes, 'scale_factor': {0: 'batch'},
+                                    'M': image_axes, 'parameters': {1: 'batch', 2: 'height', 3: 'width'}, 'sigma_map': image_axes})
+
+    model = onnx.load(onnx_file)
+    config = network_config(model_name, fitting_name, names, args)
+    onnx.helper.set_model_props(model, {key: ','.join(value) if key == 'names' else str(value) for key, value in config.items()})
+    onnx.save(model, onnx_file)
+
+
+def export_torchscript(net, save_path: Path, file_name: str, model_name: str, fitting_name: str, args):
+    """
+    Trace *net* including the physics head and the b-values [100, 200, ..., 2000] to TorchScript. The artifact loads in
+    one call without the model/ source:
+
+        >>>extra_files = {'config.json': ''}
+
+        >>>net = torch.jit.load('checkpoint_epoch30.pt', _extra_files=extra_files)
+
+        >>>M, parameters, sigma = net(images, b0, sigma, scale_factor)
+
+    The batch size and image size are dynamic. The configuration and parameter names are stored in config.json.
+    The background of M is not masked, multiply by the foreground mask to get the output of --mask_background.
+    """
+    images, b, b0, sigma, scale_factor = example_inputs(net.n_channels)
+    wrapper = StandaloneWrapper(net, b).eval()
+    with torch.no_grad():
+        names = net(images, b, b0, sigma.clone(), scale_factor)[1]['names']
+        traced = torch.jit.trace(wrapper, (images, b0, sigma.clone(), scale_factor), check_trace=False)#sigma is modified in place by the head
+    config = network_config(model_name, fitting_name, names, args)
+    torch.jit.save(traced, str(save_path / f'{file_name}.pt'), _extra_files={'config.json': json.dumps(config)})
+
+
+if __name__ == '__main__':
+    args = get_args()
+    assert not(args.feed_sigma and not args.input_sigma), 'Error: Argument input_sigma needs to be true if argument feed_sigma is passed'
+
+    device = torch.device('cpu')
+    n_channels = 60 if args.use_3D else 20
+    indexed_files = [f for f in index_files(args.load) if f.endswith('.pth') and args.filter in f]
+    for pth_file in indexed_files:
+        model_name, fitting_name, run_number, file_name = extract_file_name_folders(pth_file)
+        net = load_net(pth_file, model_name, fitting_name, n_channels, args, device)
+
+        save_path = Path(os.path.join(args.output, model_name, fitting_name, run_number))
+        save_path.mkdir(parents=True, exist_ok=True)
+        if args.format == 'folded':
+            export_folded(net, save_path, file_name)
+        elif args.format == 'onnx':
+            export_onnx(net, save_path, file_name, model_name, fitting_name, args)
+        elif args.format == 'torchscript':
+            export_torchscript(net, save_path, file_name, model_name, fitting_name, args)
+        print(f'Exported {pth_file} to {save_path} as {args.format}\n')
@@ -0,0 +1,60 @@
+""" Apparent diffusion coefficient (ADC) maps of diffusion-weighted images, for the ADC loss and for saving ADC maps """
+import torch
+import torch.nn as nn
+
+
+class ADC(nn.Module):
+    """
+    ADC between two b-values of each diffusion direction, averaged over the directions:
+
+    :math:`ADC = -\\log((S(b_{high}) + \\epsilon) / (S(b_{low}) + \\epsilon)) / (b_{high} - b_{low})`
+
+    The images of all directions are taken with one gather, the channel indices of the two b-values are computed once
+    from the b-values and the direction layout of the data (directions one after another along the channels).
+
+    Example:
+
+        >>>adc = ADC(b, n_directions=3)#b-values [100, 200, ..., 2000], images with 60 channels
+
+        >>>ADC_M, ADC_images = adc(M), adc(images)#(n_batches, 1, H, W)
+    """
+
+    def __init__(self, b, b_low: float = 100, b_high: float = 1000, n_directions: int = 1, eps: float = 1e-4):
+        """
+        :param b: b-values of one diffusion direction, any shape, e.g. (1, 20, 1, 1) as used by the networks.
+        :param b_low: Lower b-value of the ADC, has to be in *b*.
+        :param b_high: Higher b-value of the ADC, has to be in *b*.
+        :param n_directions: Number of diffusion directions in the channels of the images, 3 if use_3D else 1.
+        :param eps: Added to the signal before the logarithm, avoids log(0) in the background.
+        """
+        super(ADC, self).__init__()
+        b = torch.as_tensor(b, dtype=torch.float32).detach().flatten().cpu()
+        indices = []
+        for value in (b_low, b_high):
+            found = torch.nonzero(torch.isclose(b, torch.tensor(float(value)))).flatten()
+            assert len(found) == 1, f'Error: b-value {value} is not one of the b-values {b.tolist()}'
+            indices.append(found.item())
+        self.n_directions = n_directions
+        self.delta_b = b_high - b_low
+        self.eps = eps
+        #Channels [low, high] of every direction, (n_directions * 2,)
+        index = torch.tensor([direction * len(b) + i for direction in range(n_directions) for i in indices])
+        self.register_buffer('index', index, persistent=False)
+
+    def per_direction(self, images):
+        """
+        ADC of every diffusion direction.
+
+        :param images: (n_batches, n_directions * num_diffusion_levels, H, W)
+        :return: (n_batches, n_directions, H, W)
+        """
+        pair = images.index_select(1, self.index.to(images.device)) + self.eps
+        pair = pair.unflatten(1, (self.n_directions, 2))#(n_batches, n_directions, [low, high], H, W)
+        return -torch.log(pair[:, :, 1] / pair[:, :, 0]) / self.delta_b
+
+    def forward(self, images):
+        """
+        :param images: (n_batches, n_directions * num_diffusion_levels, H, W)
+        :return: ADC averaged over the directions, (n_batches, 1, H, W)
+        """
+        return self.per_direction(images).mean(dim=1, keepdim=True)
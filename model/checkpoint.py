@@ -0,0 +1,172 @@
+""" Full training states (network, optimizer, scheduler, loop position, RNG and data order) for resuming a training exactly """
+import math
+import os
+import random
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DistributedSampler
+
+#Not .pth or .pt, so predict.py and prune.py do not take the training states for trained networks
+STATE_SUFFIX = '.ckpt'
+
+
+def state_name(global_step: int):
+    """File name of the training state after *global_step* optimizer steps"""
+    return f'training_state_step{global_step}{STATE_SUFFIX}'
+
+
+def state_step(path):
+    """Optimizer steps of the training state *path*, from its file name, see *state_name*. None if it is no training state"""
+    match = re.fullmatch(r'training_state_step(\d+)' + re.escape(STATE_SUFFIX), Path(path).name)
+    return int(match.group(1)) if match else None
+
+
+def list_states(folder):
+    """Training states in *folder*, oldest first"""
+    folder = Path(folder)
+    if not folder.is_dir():
+        return []
+    steps = {path: state_step(path) for path in folder.iterdir() if state_step(path) is not None}
+    return sorted(steps, key=steps.get)
+
+
+def latest_state(folder):
+    """Newest training state in *folder*, None if there is none"""
+    states = list_states(folder)
+    return states[-1] if states else None
+
+
+def load_state(path):
+    """Training state saved by *AsyncCheckpointer*, with all tensors on the CPU"""
+    #The RNG states of numpy and python are not tensors, so the file is not loaded with weights_only
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def to_host(obj):
+    """Copy of the nested *obj* (dicts, lists, tuples) with all tensors copied to host memory, independent of later in-place updates"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """States of all random number generators used by the training: torch, CUDA, numpy and python"""
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'numpy': np.random.get_state(),
+            'python': random.getstate()}
+
+
+def set_rng_state(state):
+    """Restore the random number generators from *rng_state*"""
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+
+class ResumableSampler(DistributedSampler):
+    """
+    DistributedSampler with shuffling that can start an epoch after the first *start* samples of its order. The order of
+    an epoch only depends on *seed* and the epoch, so a resumed training sees the remaining batches of the interrupted
+    epoch in the same order, without loading the batches trained before the checkpoint.
+
+    *start* counts the samples of all processes. With the same number of processes as before the interruption, every
+    process gets the same batches as without the interruption. With another number, e.g. after torchrun restarted
+    without a failed machine, the remaining samples of the epoch are split between the new processes.
+
+    Example:
+
+        >>>sampler = ResumableSampler(train_set, num_replicas=world_size, rank=rank)
+
+        >>>sampler.set_epoch(epoch, start=batches_done * batch_size * world_size)
+    """
+
+    def __init__(self, dataset, num_replicas: int, rank: int, seed: int = 0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.start = 0
+
+    def set_epoch(self, epoch: int, start: int = 0):
+        """
+        :param epoch: Epoch, sets the order of the samples.
+        :param start: Number of samples of all processes that are skipped at the beginning of the epoch.
+        """
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start = start
+
+    def pad(self, order: list):
+        """*order* repeated up to a multiple of num_replicas samples, so every process gets the same number of samples, as in DistributedSampler"""
+        size = math.ceil(len(order) / self.num_replicas) * self.num_replicas
+        return (order * math.ceil(size / len(order)))[:size] if order else order
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.dataset), generator=generator).tolist()
+        #Padded before skipping, so the same number of processes gets the order of DistributedSampler. Padded again
+        #after skipping if the samples were trained by another number of processes
+        order = self.pad(self.pad(order)[self.start:])
+        return iter(order[self.rank::self.num_replicas])
+
+    def __len__(self):
+        remaining = max(math.ceil(len(self.dataset) / self.num_replicas) * self.num_replicas - self.start, 0)
+        return math.ceil(remaining / self.num_replicas)
+
+
+class AsyncCheckpointer:
+    """
+    Writes training states to *folder* in a background thread. The training loop only waits for the copy of the state
+    to host memory, see *to_host*, while the file is written. One state is written at a time: a new state waits until
+    the previous one is on disk. Each file is written under a temporary name and renamed when complete, so an
+    interrupted write never replaces a complete state. Only the *keep* newest states are kept.
+
+    Example:
+
+        >>>checkpointer = AsyncCheckpointer(save_path)
+
+        >>>checkpointer.save({'net': net.state_dict(), 'optimizer': optimizer.state_dict()}, state_name(global_step))
+
+        >>>checkpointer.wait()#Before the process ends
+    """
+
+    def __init__(self, folder, keep: int = 2):
+        assert keep >= 1, 'Error: At least one training state has to be kept'
+        self.folder = Path(folder)
+        self.keep = keep
+        self.thread = None
+        self.error = None
+
+    def save(self, state: dict, name: str):
+        snapshot = to_host(state)
+        self.wait()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.thread = threading.Thread(target=self._write, args=(snapshot, self.folder / name), name='checkpoint writer')
+        self.thread.start()
+
+    def _write(self, snapshot, path):
+        try:
+            temporary = path.with_name(path.name + '.tmp')
+            torch.save(snapshot, temporary)
+            os.replace(temporary, path)
+            for old in list_states(self.folder)[:-self.keep]:
+                old.unlink()
+        except Exception as error:#Raised in the training process by the next save or wait
+            self.error = error
+
+    def wait(self):
+        """Block until the last state is written. Raises the error of the write, if any"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
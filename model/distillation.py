@@ -0,0 +1,78 @@
+""" Knowledge distillation of a trained (teacher) network into a smaller (student) network """
+import torch
+import torch.nn as nn
+
+from model.networks import build_net
+from model.fusion import fold_batchnorm, is_folded
+
+
+def load_teacher(pth_file: str, training_model: str, n_channels: int, device, **kwargs):
+    """
+    Load a trained network as frozen teacher. Its weights are not trained and it always runs in eval mode,
+    so the BatchNorm layers use the running statistics of its own training.
+
+    :param pth_file: Path to the .pth file of the teacher, also checkpoints exported with folded BatchNorm (export.py).
+    :param training_model: Name of the network model of the teacher, e.g. 'res_atten_unet', see *build_net*.
+    :param n_channels: Number of input channels, 20 or 60 if use_3D.
+    :param device: Device the teacher is moved to.
+    :param kwargs: Passed on to the network constructor. Must match the student, e.g. fitting_model, input_sigma, estimate_S0,
+        so both predict the same parameters.
+    :return: Teacher network in eval mode without gradients
+    """
+    teacher = build_net(training_model, n_channels, **kwargs)
+    checkpoint = torch.load(pth_file, map_location=device, weights_only=True)
+    checkpoint = {k.replace('module.', ''): v for k, v in checkpoint.items()}#Saved from DistributedDataParallel
+    if is_folded(checkpoint):
+        fold_batchnorm(teacher)
+    teacher.load_state_dict(checkpoint)
+    return teacher.to(device).eval().requires_grad_(False)
+
+
+class LogitsRecorder:
+    """
+    Keeps the output of the last convolution *outc* of a network, i.e. the logits given to the physics head, of the
+    latest forward pass. The network itself is unchanged, so it can be wrapped by DistributedDataParallel or torch.compile.
+    """
+
+    def __init__(self, net: nn.Module):
+        self.logits = None
+        self.handle = net.outc.register_forward_hook(self.hook)
+
+    def hook(self, module, inputs, output):
+        self.logits = output
+
+    def remove(self):
+        self.handle.remove()
+
+
+def distillation_loss(student_params, teacher_params, student_logits=None, teacher_logits=None, target: str = 'parameters', mask=None):
+    """
+    Distance between the predictions of the student and the teacher.
+
+    parameters: L1 distance of the parameter maps, each parameter relative to the mean absolute value of the teacher's map,
+    so parameters of different units (e.g. D and S0) are weighted equally.
+    logits: L1 distance of the logits before the physics head, which are not bounded to the physiological range.
+
+    :param student_params: param_dict['parameters'] of the student, (num_par, n_batches, H, W)
+    :param teacher_params: param_dict['parameters'] of the teacher, same shape
+    :param student_logits: Logits of the student, (n_batches, n_classes, H, W). Only needed for the targets logits and both.
+    :param teacher_logits: Logits of the teacher, same shape
+    :param target: 'parameters', 'logits' or 'both' (sum of the two)
+    :param mask: Optional boolean foreground mask, (n_batches, 1, H, W). The distance is then averaged over foreground voxels.
+    """
+    assert target in ('parameters', 'logits', 'both'), f'Error: Unknown distillation target {target}'
+    if mask is not None:
+        mask = mask.to(torch.float32)
+    loss = 0
+    if target in ('parameters', 'both'):
+        teacher_params = teacher_params.to(student_params.device)
+        weight = mask[:, 0] if mask is not None else torch.ones_like(teacher_params[0])#(n_batches, H, W)
+        scale = (torch.abs(teacher_params) * weight).sum(dim=(1, 2, 3)) / weight.sum() + 1e-8#(num_par,)
+        distance = (torch.abs(student_params - teacher_params) * weight).sum(dim=(1, 2, 3)) / weight.sum()
+        loss = loss + torch.mean(distance / scale)
+    if target in ('logits', 'both'):
+        assert student_logits is not None and teacher_logits is not None, 'Error: Logits are needed for the distillation target logits'
+        weight = mask if mask is not None else torch.ones_like(teacher_logits[:, :1])
+        distance = torch.abs(student_logits.float() - teacher_logits.float()) * weight
+        loss = loss + distance.sum() / (weight.sum() * teacher_logits.shape[1])
+    return loss
@@ -0,0 +1,70 @@
+""" Vectorized inference of an ensemble of trained networks of the same network model, e.g. the folds of a cross validation """
+import copy
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+
+from model.physics_head import Trunk
+
+
+class EnsembleNet:
+    """
+    The trunks of all *nets* run as one vectorized forward: their weights are stacked along a new first dimension and
+    the trunk is mapped over it with torch.func.vmap. The physics head runs per network, as it may use learned weights
+    (sigma_scale) and is cheap compared to the trunk.
+
+    Vectorizing saves kernel launches on GPU. On CPU, where the batched-weight convolutions of vmap are slower than the
+    convolutions of each network, pass *vectorize=False* to run the trunks one after another with the same outputs.
+
+    Example:
+
+        >>>ensemble = EnsembleNet([net_run_1, net_run_2, net_run_3])
+
+        >>>M, param_dict = ensemble(images, b, b0, sigma, scale_factor)
+
+    M and param_dict['parameters'] are the per-voxel means over the networks, the variances are in param_dict
+    ('M_variance', 'parameters_variance', 'sigma_variance').
+    """
+
+    def __init__(self, nets: list, vectorize: bool = True):
+        assert len({type(net) for net in nets}) == 1, 'Error: Only networks of the same network model can be stacked'
+        shapes = [{k: v.shape for k, v in net.state_dict().items()} for net in nets]
+        assert all(s == shapes[0] for s in shapes), 'Error: Only networks with the same configuration can be stacked'
+        self.nets = [net.eval() for net in nets]
+        self.vectorize = vectorize
+        params, buffers = stack_module_state(self.nets)#(n_nets, ...) per weight
+        self.weights = {f'net.{k}': v for k, v in {**params, **buffers}.items()}#Keys of *Trunk*
+        self.base = Trunk(copy.deepcopy(nets[0]).to('meta'))#Only the structure is used, the weights are replaced by *weights*
+
+    def __len__(self):
+        return len(self.nets)
+
+    def trunk(self, x, sigma_true):
+        """Logits of all networks, (n_nets, n_batches, n_classes, H, W)"""
+        if not self.vectorize:
+            return torch.stack([net.trunk(x, sigma_true) for net in self.nets])
+        def call(weights, x, sigma_true):
+            return functional_call(self.base, weights, (x, sigma_true))
+        return vmap(call, in_dims=(0, None, None))(self.weights, x, sigma_true)
+
+    def members(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        """
+        Outputs of every network, stacked along the first dimension.
+
+        :return: tuple (M (n_nets, n_batches, n_channels, H, W), parameters (n_nets, num_par, n_batches, H, W),
+            sigma (n_nets, n_batches, 1, H, W), parameter names)
+        """
+        logits = self.trunk(x, sigma_true)
+        outputs = [net.physics_head(member_logits, b, b0, sigma_true.clone(), scale_factor, mask)#sigma is modified in place by the head
+                   for net, member_logits in zip(self.nets, logits)]
+        M = torch.stack([M for M, _ in outputs])
+        parameters = torch.stack([param_dict['parameters'] for _, param_dict in outputs])
+        sigma = torch.stack([param_dict['sigma'] for _, param_dict in outputs])
+        return M, parameters, sigma, outputs[0][1]['names']
+
+    def __call__(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        M, parameters, sigma, names = self.members(x, b, b0, sigma_true, scale_factor, mask)
+        #Population variance over the networks, as every network is one sample of the ensemble
+        return M.mean(dim=0), {'parameters': parameters.mean(dim=0), 'sigma': sigma.mean(dim=0), 'names': names,
+                               'M_variance': M.var(dim=0, unbiased=False),
+                               'parameters_variance': parameters.var(dim=0, unbiased=False),
+                               'sigma_variance': sigma.var(dim=0, unbiased=False)}
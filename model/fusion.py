@@ -0,0 +1,32 @@
+""" Conv-BatchNorm folding for inference """
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_batchnorm(net):
+    """
+    Fold every BatchNorm2d into the Conv2d in front of it, in place. In eval mode a BatchNorm is a per-channel affine map,
+    so it can be merged into the convolution weights and bias. The BatchNorm is replaced by nn.Identity, keeping the
+    indices and thus the state_dict keys of the convolutions.
+
+    All conv-BN pairs of the networks (DoubleConv, DoubleConvResidual, Up_conv, Attention_block) sit next to each other in an nn.Sequential.
+
+    :param net: Network model as type *torch.nn.Module*. It is put in eval mode, the folded network is only meant for inference.
+    :return: *net*
+    """
+    net.eval()
+    for module in list(net.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                module[i + 1] = nn.Identity()
+    return net
+
+
+def is_folded(state_dict):
+    """
+    True if *state_dict* was saved from a network folded with *fold_batchnorm*, i.e. it has no BatchNorm running statistics.
+    """
+    return not any(key.endswith('running_mean') for key in state_dict)
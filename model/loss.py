@@ -0,0 +1,107 @@
+""" Loss of the predicted against the measured images, shared by training, validation and inference """
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model.utils import float32_policy
+
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)#Weights of the five scales, same as pytorch_msssim
+
+
+def gaussian_window(win_size: int = 5, win_sigma: float = 1.5):
+    """Normalized 1D Gaussian window, (win_size,)"""
+    coords = torch.arange(win_size, dtype=torch.float32) - win_size // 2
+    window = torch.exp(-coords ** 2 / (2 * win_sigma ** 2))
+    return window / window.sum()
+
+
+class CustomLoss(nn.Module):
+
+    """
+    Custom loss function: :math:`L` = (1-MS-SSIM) :math:`\cdot` L1
+
+    One instance for any number of channels (1, 20 or 60 if use_3D): MS-SSIM is computed per channel and averaged, the
+    same value as pytorch_msssim.MS_SSIM with *win_size* 5 and the data range of *update_data_range*. The Gaussian window
+    is shared by all channels, as a depthwise convolution with the 2D window, the outer product of the 1D window.
+    The luminance term is only computed at the coarsest scale, where it is used.
+
+    Example:
+
+        >>>loss = CustomLoss()
+
+        >>>loss.update_data_range(torch.max(target))
+
+        >>>loss_value = loss(predicted,target, ssim_bool=True)
+    """
+
+    def __init__(self, win_size: int = 5, win_sigma: float = 1.5, data_range: float = 255, K=(0.01, 0.03)):
+        super(CustomLoss, self).__init__()
+        assert win_size % 2 == 1, 'Error: Window size of SSIM has to be odd'
+        self.win_size = win_size
+        self.data_range = data_range#Value range of the images, sets the stabilizing constants of SSIM
+        self.K = K
+        window = gaussian_window(win_size, win_sigma)
+        #A 2D window reads every map once, on CPU faster than the two passes of the separable 1D windows, see benchmark.py --mode loss
+        self.register_buffer('window', (window[:, None] * window[None, :]).view(1, 1, win_size, win_size), persistent=False)
+        self.register_buffer('weights', torch.tensor(MS_SSIM_WEIGHTS), persistent=False)
+
+    def update_data_range(self, range):
+        self.data_range = range
+
+    def gaussian_filter(self, x):
+        """Gaussian window on every channel of *x*, (n_batches, n_channels, H, W), without padding as in pytorch_msssim"""
+        n_channels = x.shape[1]
+        window = self.window.to(device=x.device, dtype=x.dtype).expand(n_channels, 1, self.win_size, self.win_size)
+        return F.conv2d(x, window, groups=n_channels)
+
+    def ms_ssim(self, X, Y):
+        """
+        MS-SSIM of *X* and *Y*, (n_batches, n_channels, H, W), averaged over batches and channels.
+        """
+        assert min(X.shape[-2:]) > (self.win_size - 1) * 2 ** 4, f'Error: Images have to be larger than {(self.win_size - 1) * 2 ** 4} voxels for the four down-samplings of MS-SSIM'
+        C1 = (self.K[0] * self.data_range) ** 2
+        C2 = (self.K[1] * self.data_range) ** 2
+        levels = len(MS_SSIM_WEIGHTS)
+        scales = []
+        for level in range(levels):
+            mu_x, mu_y = self.gaussian_filter(X), self.gaussian_filter(Y)
+            mu_xy = mu_x * mu_y
+            mu_xx, mu_yy = mu_x * mu_x, mu_y * mu_y
+            sigma_xx = self.gaussian_filter(X * X) - mu_xx
+            sigma_yy = self.gaussian_filter(Y * Y) - mu_yy
+            sigma_xy = self.gaussian_filter(X * Y) - mu_xy
+            cs_map = (2 * sigma_xy + C2) / (sigma_xx + sigma_yy + C2)
+            if level < levels - 1:
+                scales.append(torch.relu(cs_map.flatten(2).mean(-1)))#Contrast-structure term, (n_batches, n_channels)
+                padding = [s % 2 for s in X.shape[2:]]
+                X = F.avg_pool2d(X, kernel_size=2, padding=padding)
+                Y = F.avg_pool2d(Y, kernel_size=2, padding=padding)
+            else:
+                ssim_map = (2 * mu_xy + C1) / (mu_xx + mu_yy + C1) * cs_map
+                scales.append(torch.relu(ssim_map.flatten(2).mean(-1)))
+        weights = self.weights.to(device=X.device, dtype=X.dtype)
+        return torch.prod(torch.stack(scales) ** weights.view(-1, 1, 1), dim=0).mean()
+
+    @float32_policy
+    def forward(self, M,images, ssim_bool = False, only_ssim = False, mask = None):
+        """
+        :param M: The predicted data/image
+        :param images: The target data/image
+        :param ssim_bool: If True, ssim is part of the loss function. Else only L1 is calculated
+        :param only_ssim: If True, the loss function will only be = 1-ssim. L1 would not be included.
+        :param mask: Optional foreground mask (n_batches, 1, H, W). If given, the loss only considers the masked voxels.
+        """
+        if mask is not None:
+            mask = mask.to(M.dtype)
+            M = M * mask#Background is set to zero in both images, so it does not contribute to SSIM
+            images = images * mask
+
+        loss_ssim = 1 - self.ms_ssim(M, images) if ssim_bool else 1
+
+        if not only_ssim and mask is not None:
+            l1_loss = torch.sum(torch.abs(M - images)) / (torch.sum(mask) * M.shape[1])#Mean over foreground voxels only
+        elif not only_ssim:
+            l1_loss = torch.mean(torch.abs(M - images))
+        else:
+            l1_loss = 1
+        return loss_ssim * l1_loss
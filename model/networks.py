@@ -0,0 +1,56 @@
+""" Look-up of the network models by the names used on the command line and in the checkpoint folders """
+import re
+
+from model.unet_model import UNet
+from model.attention_unet import Atten_Unet
+from model.res_attention_unet import Res_Atten_Unet
+from model.shared_attention_unet import Shared_Atten_Unet
+
+NETWORKS = {
+    'unet': UNet,
+    'attention_unet': Atten_Unet,
+    'res_atten_unet': Res_Atten_Unet,
+    'shared_attention_unet': Shared_Atten_Unet,#One encoder for several fitting models, e.g. fitting model 'biexp_kurtosis_gamma'
+}
+
+
+def parse_training_model(training_model: str):
+    """
+    Split a network name into the network model and the constructor arguments of its variant.
+    The name is a network model optionally followed by '_w<width multiplier>' and/or '_dw' for depthwise-separable
+    convolutions, e.g. 'attention_unet_w0.5_dw' is Atten_Unet with half the channels and depthwise-separable convolutions.
+    For use_3D, '_grouped_stem' or '_shared_stem' at the end replaces the input layer by a *DirectionStem*.
+
+    :return: tuple (network model name, dict of constructor arguments)
+    """
+    match = re.fullmatch(r'(?P<model>.+?)(?:_w(?P<width>\d*\.?\d+))?(?P<separable>_dw)?(?:_(?P<stem>grouped|shared)_stem)?', training_model)
+    kwargs = {}
+    if match['width']:
+        kwargs['width'] = float(match['width'])
+    if match['separable']:
+        kwargs['separable'] = True
+    if match['stem']:
+        kwargs['stem'] = match['stem']
+    return match['model'], kwargs
+
+
+def build_net(training_model: str, n_channels: int, **kwargs):
+    """
+    Construct a network from its name, e.g. 'unet'/'attention_unet'/'res_atten_unet' or a variant like 'unet_w0.25_dw_shared_stem',
+    see *parse_training_model*.
+
+    :param training_model: Name of network model, as used for *--training_model* and the checkpoint folders.
+    :param n_channels: Number of input channels, 20 or 60 if use_3D.
+    :param kwargs: Passed on to the network constructor, e.g. input_sigma, fitting_model, estimate_S0, feed_sigma.
+    """
+    model, variant = parse_training_model(training_model)
+    assert model in NETWORKS, f'Could not find type of network model, i got {training_model}'
+    return NETWORKS[model](n_channels=n_channels, **variant, **kwargs)
+
+
+def parse_fitting_models(fitting_model: str):
+    """
+    Fitting models of a fitting model name, e.g. ['biexp', 'kurtosis', 'gamma'] for 'biexp_kurtosis_gamma' of the
+    shared_attention_unet, or ['biexp'] for 'biexp'.
+    """
+    return fitting_model.split('_')
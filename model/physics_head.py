@@ -0,0 +1,186 @@
+""" Physics head shared by the U-Net models: maps logits to parameter maps and the expected signal """
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model.utils import *
+
+
+class PhysicsHead:
+    """
+    Mixin for networks whose output channels are parameters of a diffusion signal model.
+    The network must define the attributes *fitting_model*, *use_3D*, *input_sigma*, *estimate_S0*,
+    *learn_sigma_scaling*, *sigma_scale*, *rice* and *n_classes*.
+    """
+
+    @float32_policy
+    def physics_head(self, logits, b, b0, sigma_true, scale_factor, mask=None):
+        """
+        Constrain the logits to physiological parameters and compute the expected (Rician biased) signal.
+
+        :param logits: Output of the network trunk, (n_batches, n_classes, H, W)
+        :param b: b-values, (1, num_diffusion_levels, 1, 1)
+        :param b0: b0-image, (n_batches, 1, H, W)
+        :param sigma_true: Known noise map, (n_batches, 1, H, W). Only used if *input_sigma*
+        :param scale_factor: Scaling used on the images in the dataset, (n_batches,)
+        :param mask: Optional boolean foreground mask, (n_batches, 1, H, W). If given, the signal model is only
+            evaluated on the masked voxels and the background of the returned image is zero.
+        :return: tuple (M, dictionary_of_predicted_parameter_values)
+
+        The head always runs in float32, also when the trunk runs under autocast.
+        """
+        num_diffusion = 3 if self.use_3D else 1
+        num_par = self.n_classes
+
+        #n_classes may not count noise map and b0-image
+        if self.input_sigma:
+            num_par+=1
+        if not self.estimate_S0:
+            num_par+=1
+        par_collect = torch.zeros(size=(num_par, logits.shape[0], *logits.shape[-2:]), device=logits.device)#collect all parameters in one array (num_par,num_batches,H,W)
+        par_name_list = [None] * num_par# [None,None,None...]
+
+        imag_collect = torch.zeros(size=(num_diffusion, logits.shape[0], max(b.shape), *logits.shape[-2:]),
+                                   device=logits.device)# (num_diffusion_directions, num_batches, num_diffusion_levels, H,W)
+        if self.input_sigma:
+            sigma_true[sigma_true == 0.] = 1e-8#To avoid overflow
+            if self.learn_sigma_scaling:
+                sigma_scale = self.sigma_scale.to(device=logits.device)
+                sigma_scale = F.relu(sigma_scale)
+                sigma_final = sigma_true * sigma_scale
+            else:
+                sigma_final = sigma_true
+        else:
+            sigma_final = sigmoid_cons(logits[:, slice(-1, None), :, :], 0.01, 1)
+        sigma_final[sigma_final == 0.] = 1e-8
+
+        par_collect[-1] = sigma_final[:, 0]
+        par_name_list[-1] = 'sigma'
+
+        if self.estimate_S0:
+            if not self.input_sigma: s0 = sigmoid_cons(logits[:, slice(-2, -1), :, :],0.001,1.4)#last index is sigma, second last index is s0
+            else: s0 = sigmoid_cons(logits[:, slice(-1, None), :, :],0.001,1.4)#last index is s0, there is no predicted noise map
+        else:
+            s0 = b0#s0 = b0 from scanner
+        par_collect[-2] = s0[:, 0]
+        par_name_list[-2] = 's0'
+
+        if mask is not None:
+            mask = mask.bool()
+            b_head = b.reshape(1, -1)#(1, num_diffusion_levels) to broadcast against (n_voxels, 1)
+        else:
+            b_head = b
+        #With a mask, all maps below are (n_voxels, 1) instead of (n_batches, 1, H, W)
+        s0_head, sigma_head, scale_head = gather_voxels(mask, s0, sigma_final, scale_factor.view(-1, 1, 1, 1))
+
+        for index in range(num_diffusion):
+            if self.fitting_model == 'biexp':
+
+                d_1 = logits[:, 3*index + 0:3*index + 1, :, :]#shape batch,1,200,240
+                d_2 = logits[:, 3*index + 1:3*index + 2, :, :]
+                f =   logits[:, 3*index + 2:3*index + 3, :, :]
+
+                # make sure D1 is the larger value between D1 and D2
+                #if torch.mean(d_1) < torch.mean(d_2):
+                #    d_1, d_2 = d_2, d_1
+                #    f = 1 - f
+
+                d_1 = sigmoid_cons(d_1, 0, 4)  # testa utan också
+                d_2 = sigmoid_cons(d_2, 0, 1)
+                f = sigmoid_cons(f, 0.1, 0.9)
+
+                #collect
+
+                par_collect[3 * index + 0] = d_1[:,0]
+                par_collect[3 * index + 1] = d_2[:,0]
+                par_collect[3 * index + 2] = f[:,0]
+                par_name_list[3 * index + 0] = 'D1'
+                par_name_list[3 * index + 1] = 'D2'
+                par_name_list[3 * index + 2] = 'f'
+
+
+                # get the expectation of the clean images
+                d_1, d_2, f = gather_voxels(mask, d_1, d_2, f)
+
+                v = bio_exp(d_1, d_2, f, b_head)
+
+                if self.estimate_S0:
+                    v = (s0_head * v)
+                else:
+                    v = (s0_head * v) / scale_head
+
+                if self.rice:
+                    res =  F.relu(rice_exp(v, sigma_head)) #+  1 / scale_factor.view(-1, 1, 1, 1)
+
+                else:
+                    res = F.relu(v) #+  1 / scale_factor.view(-1, 1, 1, 1)
+
+                imag_collect[index] = scatter_voxels(mask, res)
+            elif self.fitting_model == 'kurtosis':
+
+                d = logits[:, 2*index + 0:2*index + 1, :, :]
+                k = logits[:, 2*index + 1:2*index + 2, :, :]
+
+
+                d = sigmoid_cons(d, 0, 4)
+                k = sigmoid_cons(k, 0, 1)
+
+                par_collect[2 * index + 0] = d[:,0]
+                par_collect[2 * index + 1] = k[:,0]
+                par_name_list[2 * index + 0] = 'D'
+                par_name_list[2 * index + 1] = 'K'
+
+
+                # get the expectation of the clean images
+                d, k = gather_voxels(mask, d, k)
+                v = kurtosis(b_head, D = d,K = k)
+                if self.estimate_S0:
+                    v = (s0_head * v)
+                else:
+                    v = (s0_head * v) / scale_head
+
+                if self.rice:
+                    res = rice_exp(v, sigma_head)
+                else:
+                    res = v
+                imag_collect[index] = scatter_voxels(mask, res)
+            elif self.fitting_model == 'gamma':
+                theta = logits[:, 2*index + 0:2*index + 1, :, :]
+                k =     logits[:, 2*index + 1:2*index + 2, :, :]
+
+                theta = sigmoid_cons(theta, 0, 10)
+                k = sigmoid_cons(k, 0, 20)
+
+
+
+                par_collect[2 * index + 0] = k[:,0]
+                par_collect[2 * index + 1] = theta[:,0]
+                par_name_list[2 * index + 0] = 'K'
+                par_name_list[2 * index + 1] = 'Theta'
+
+                # get the expectation of the clean images
+                theta, k = gather_voxels(mask, theta, k)
+                v = gamma(bval=b_head, theta=theta,K=k)
+
+                if self.estimate_S0:
+                    v = (s0_head * v)
+                else:
+                    v = (s0_head * v) / scale_head
+                if self.rice:
+                    res = rice_exp(v, sigma_head)
+                else:
+                    res = v
+                imag_collect[index] = scatter_voxels(mask, res)
+        imag_collect_cat = torch.cat([imag_collect[i] for i in range(num_diffusion)], dim=1)  # Concatenate along dim=1
+        return imag_collect_cat, {'parameters': par_collect, 'sigma': sigma_final * scale_factor.view(-1, 1, 1, 1), 'names':par_name_list}
+
+
+class Trunk(nn.Module):
+    """Exposes *net.trunk* as forward, so e.g. torch.fx traces or torch.func calls the convolutions without the physics head"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x, sigma_true):
+        return self.net.trunk(x, sigma_true)
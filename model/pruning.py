@@ -0,0 +1,148 @@
+""" Structured channel pruning of trained networks into their narrower width variants """
+import operator
+import torch
+import torch.nn as nn
+from torch.fx import symbolic_trace
+from torch.fx.passes.shape_prop import ShapeProp
+
+from model.physics_head import Trunk
+
+
+def channel_importance(module, dims):
+    """L1 norm of the filters of a convolution per output channel, *dims* are the remaining weight dimensions"""
+    return module.weight.detach().abs().sum(dim=dims)
+
+
+def prune_channels(net, small, images, sigma):
+    """
+    Copy the most important channels of every layer of the trained network *net* into *small*, the same network model with
+    fewer channels per layer, e.g. the width variant 'attention_unet_w0.5' of 'attention_unet' (see *build_net*).
+
+    The trunk is traced with torch.fx to find the channels of each tensor. Every convolution output is a set of channels
+    that is pruned to the size of the same layer in *small*. Channels joined by an addition (residual connections and the
+    gating of the attention blocks) are pruned together, concatenations (skip connections) keep the channels selected for
+    each part. Importance of a channel is |gamma| of the BatchNorm normalizing it, or the L1 norm of its filters if there is none.
+
+    :param net: Trained network (UNet, Atten_Unet or Res_Atten_Unet).
+    :param small: Narrower network of the same model, its weights are overwritten.
+    :param images: Example input, (n_batches, n_channels, H, W), used for tracing.
+    :param sigma: Example noise map, (n_batches, 1, H, W).
+    :return: *small*
+    """
+    assert getattr(net, 'stem', 'dense') == 'dense', 'Error: Networks with a grouped or shared input layer can not be pruned'
+    traced = symbolic_trace(Trunk(net).eval())
+    ShapeProp(traced).propagate(images, sigma)
+    modules = dict(traced.named_modules())
+    small_modules = dict(Trunk(small).named_modules())
+
+    #Union-find over channel sets, one per convolution output and network input
+    parent = []
+
+    def find(space):
+        while parent[space] != space:
+            space = parent[space]
+        return space
+
+    def new_space():
+        parent.append(len(parent))
+        return len(parent) - 1
+
+    segments = {}#node -> list of (channel set, number of channels), concatenated along the channel dimension
+    producers = {}#channel set -> name of the convolution producing it
+    norms = []#(channel set, name of BatchNorm)
+    inputs = set()
+    for node in traced.graph.nodes:
+        if 'tensor_meta' not in node.meta:
+            continue#Sizes and padding arithmetic
+        channels = node.meta['tensor_meta'].shape[1]
+        if node.op == 'placeholder':
+            space = new_space()
+            inputs.add(space)
+            segments[node] = [(space, channels)]
+        elif node.op == 'call_module':
+            module = modules[node.target]
+            segments[node] = segments[node.args[0]]#Elementwise layers and depthwise convolutions keep the channels
+            if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)) and not is_depthwise(module):
+                space = new_space()
+                producers[space] = node.target
+                segments[node] = [(space, channels)]
+            elif isinstance(module, nn.BatchNorm2d):
+                assert len(segments[node]) == 1, 'Error: BatchNorm is expected directly after a convolution'
+                norms.append((segments[node][0][0], node.target))
+        elif node.target is torch.cat:
+            assert node.kwargs.get('dim', node.args[1] if len(node.args) > 1 else 0) == 1, 'Error: Only concatenation along channels is supported'
+            segments[node] = [segment for arg in node.args[0] for segment in segments[arg]]
+        elif node.target in (operator.add, operator.mul):
+            a, b = (segments[arg] for arg in node.args)
+            if sum(n for _, n in a) == 1:#Broadcast of a single channel, e.g. the attention coefficients
+                segments[node] = b
+            elif sum(n for _, n in b) == 1:
+                segments[node] = a
+            else:
+                assert len(a) == len(b) == 1, 'Error: Only additions of single convolution outputs are supported'
+                parent[find(a[0][0])] = find(b[0][0])
+                segments[node] = a
+        else:
+            segments[node] = segments[node.args[0]]#e.g. padding
+
+    #Importance and number of kept channels of each channel set
+    normalized = {find(space) for space, _ in norms}
+    importance = {}
+    for space, name in norms:
+        root = find(space)
+        importance[root] = importance.get(root, 0) + modules[name].weight.detach().abs()
+    keep = {}
+    for space, name in producers.items():
+        root = find(space)
+        module = modules[name]
+        n_keep = small_modules[name].out_channels
+        assert keep.get(root, n_keep) == n_keep, f'Error: Coupled channels of {name} have different sizes in the small network'
+        keep[root] = n_keep
+        if root not in normalized:
+            dims = (0, 2, 3) if isinstance(module, nn.ConvTranspose2d) else (1, 2, 3)
+            importance[root] = importance.get(root, 0) + channel_importance(module, dims)
+    selected = {root: torch.sort(torch.topk(importance[root], keep[root]).indices).values for root in keep}
+
+    def indices(segment_list):
+        """Kept channel indices of a tensor made of *segment_list*"""
+        result, offset = [], 0
+        for space, n in segment_list:
+            root = find(space)
+            result.append((torch.arange(n) if space in inputs else selected[root]) + offset)
+            offset += n
+        return torch.cat(result)
+
+    state_dict = {}
+    for node in traced.graph.nodes:
+        if node.op != 'call_module':
+            continue
+        module = modules[node.target]
+        name = node.target[len('net.'):]
+        in_sel = indices(segments[node.args[0]])
+        out_sel = indices(segments[node])
+        if isinstance(module, nn.Conv2d):
+            weight = module.weight[out_sel] if is_depthwise(module) else module.weight[out_sel][:, in_sel]
+        elif isinstance(module, nn.ConvTranspose2d):
+            weight = module.weight[in_sel][:, out_sel]
+        elif isinstance(module, nn.BatchNorm2d):
+            weight = module.weight[out_sel]
+            state_dict[f'{name}.running_mean'] = module.running_mean[out_sel]
+            state_dict[f'{name}.running_var'] = module.running_var[out_sel]
+            state_dict[f'{name}.num_batches_tracked'] = module.num_batches_tracked
+        else:
+            continue
+        state_dict[f'{name}.weight'] = weight
+        if module.bias is not None:
+            state_dict[f'{name}.bias'] = module.bias[out_sel]
+    for key, value in net.state_dict().items():
+        if key not in small.state_dict():
+            continue
+        state_dict.setdefault(key, value)#Layers outside the trunk, e.g. a learned sigma scaling
+    small.load_state_dict({key: value.detach().clone() for key, value in state_dict.items()})
+    return small
+
+
+def is_depthwise(module):
+    """True for the depthwise convolutions of depthwise-separable layers, one filter per channel"""
+    return isinstance(module, nn.Conv2d) and module.groups > 1 and module.groups == module.in_channels == module.out_channels
+
@@ -0,0 +1,44 @@
+""" Post-training static int8 quantization of the convolutional trunk for CPU inference """
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from model.physics_head import Trunk
+
+
+class QuantizedNet(nn.Module):
+    """
+    Network with an int8 trunk and the float32 physics head of the original network.
+    Same call signature and outputs as the original network.
+    """
+
+    def __init__(self, net, quantized_trunk):
+        super().__init__()
+        self.net = net
+        self.quantized_trunk = quantized_trunk
+
+    def forward(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        logits = self.quantized_trunk(x, sigma_true)#float logits, dequantized at the graph output
+        return self.net.physics_head(logits, b, b0, sigma_true, scale_factor, mask)
+
+
+def quantize_trunk(net, calibration_batches, backend: str = 'x86'):
+    """
+    Post-training static quantization of the trunk of *net* with torch.fx. Conv-BatchNorm(-ReLU) are fused,
+    observers record the activation ranges on *calibration_batches* and the trunk is converted to int8.
+    The physics head is not quantized.
+
+    :param net: Trained network (UNet, Atten_Unet or Res_Atten_Unet).
+    :param calibration_batches: List of (images, sigma) tuples, e.g. all slices of a few patients. Only run on CPU.
+    :param backend: Quantized engine, 'x86'/'fbgemm' for x86 CPUs or 'qnnpack' for ARM.
+    :return: *QuantizedNet* on CPU in eval mode
+    """
+    torch.backends.quantized.engine = backend
+    net = net.cpu().eval()
+    images, sigma = calibration_batches[0]
+    prepared = prepare_fx(Trunk(net), get_default_qconfig_mapping(backend), example_inputs=(images, sigma))
+    with torch.no_grad():
+        for images, sigma in calibration_batches:
+            prepared(images.cpu(), sigma.cpu())
+    return QuantizedNet(net, convert_fx(prepared)).eval()
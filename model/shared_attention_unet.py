@@ -0,0 +1,165 @@
+""" Attention U-Net with one encoder shared by several fitting models, each with its own decoder and physics head """
+import torch
+
+from model.unet_parts import *
+from model.utils import *
+from model.physics_head import PhysicsHead
+
+
+class Fit_Decoder(nn.Module, PhysicsHead):
+    """Decoder of Atten_Unet and physics head of one fitting model"""
+
+    def __init__(self, fitting_model: str, ch: list, factor: int, input_sigma: bool, estimate_S0, rice=True, use_3D=False, learn_sigma_scaling=False, checkpointing=False, separable=False):
+        super(Fit_Decoder, self).__init__()
+        self.fitting_model = fitting_model
+        self.input_sigma = input_sigma
+        self.estimate_S0 = estimate_S0
+        self.rice = rice
+        self.use_3D = use_3D
+        self.learn_sigma_scaling = learn_sigma_scaling
+        self.checkpointing = checkpointing
+        if fitting_model == 'biexp':
+            self.n_classes = 3
+        elif fitting_model == 'kurtosis':
+            self.n_classes = 2
+        elif fitting_model == 'gamma':
+            self.n_classes = 2
+
+        if use_3D:
+            self.n_classes *= 3#three times more parameters to predict
+        if not self.input_sigma:
+            self.n_classes += 1#If no noise map was input to AI, then AI will predict one
+        if self.estimate_S0:
+            self.n_classes += 1
+
+        self.upconv1 = Up_conv(ch[4] // factor, ch[3], separable)
+        self.atten1 = Attention_block(ch[3], ch[3], ch[2])
+        self.dbconv1 = DoubleConv(ch[4], ch[3], separable=separable)
+
+        self.upconv2 = Up_conv(ch[3] // factor, ch[2], separable)
+        self.atten2 = Attention_block(ch[2], ch[2], ch[1])
+        self.dbconv2 = DoubleConv(ch[3], ch[2], separable=separable)
+
+        self.upconv3 = Up_conv(ch[2] // factor, ch[1], separable)
+        self.atten3 = Attention_block(ch[1], ch[1], ch[0])
+        self.dbconv3 = DoubleConv(ch[2], ch[1], separable=separable)
+
+        self.upconv4 = Up_conv(ch[1] // factor, ch[0], separable)
+        self.atten4 = Attention_block(ch[0], ch[0], ch[0] // 2)
+        self.dbconv4 = DoubleConv(ch[1], ch[0], separable=separable)
+
+        self.outc = OutConv(ch[0], self.n_classes)
+        if self.learn_sigma_scaling:
+            self.sigma_scale = nn.Parameter(torch.tensor(1.0, requires_grad=True))#A learnable parameter
+        else:
+            self.sigma_scale = torch.tensor(1.0, requires_grad=False)# A constant
+
+    def decode(self, x1, x2, x3, x4, x5):
+        """Feature maps of the encoder -> logits of this fitting model, (n_batches, n_classes, H, W)"""
+        d5 = run_stage(self.upconv1, x5, checkpointing=self.checkpointing)
+        x4 = run_stage(self.atten1, d5, x4, checkpointing=self.checkpointing)
+        d5 = self.pad_cat(d5, x4)
+        d5 = run_stage(self.dbconv1, d5, checkpointing=self.checkpointing)
+
+        d4 = run_stage(self.upconv2, d5, checkpointing=self.checkpointing)
+        x3 = run_stage(self.atten2, d4, x3, checkpointing=self.checkpointing)
+        d4 = self.pad_cat(d4, x3)
+        d4 = run_stage(self.dbconv2, d4, checkpointing=self.checkpointing)
+
+        d3 = run_stage(self.upconv3, d4, checkpointing=self.checkpointing)
+        x2 = run_stage(self.atten3, d3, x2, checkpointing=self.checkpointing)
+        d3 = self.pad_cat(d3, x2)
+        d3 = run_stage(self.dbconv3, d3, checkpointing=self.checkpointing)
+
+        d2 = run_stage(self.upconv4, d3, checkpointing=self.checkpointing)
+        x1 = run_stage(self.atten4, d2, x1, checkpointing=self.checkpointing)
+        d2 = self.pad_cat(d2, x1)
+        d2 = run_stage(self.dbconv4, d2, checkpointing=self.checkpointing)
+        return self.outc(d2)
+
+    def pad_cat(self, s, b):
+        """The feature map of s is smaller than that of b"""
+        diffY = b.size()[2] - s.size()[2]
+        diffX = b.size()[3] - s.size()[3]
+
+        s = F.pad(s, [diffX // 2, diffX - diffX // 2,
+                      diffY //2, diffY - diffY //2])
+
+        ot = torch.cat([b, s], dim=1)
+        return ot
+
+
+class Shared_Atten_Unet(nn.Module):
+    """
+    Encoder of Atten_Unet shared by several fitting models, with one decoder and physics head per fitting model.
+    All parameter sets are predicted from one encoder pass.
+
+    *fitting_model* names the fitting models joined by '_', e.g. 'biexp_kurtosis_gamma', as in the checkpoint folders.
+    The forward pass returns a dictionary fitting model -> (M, dictionary_of_predicted_parameter_values), each entry
+    the same as the output of Atten_Unet for that fitting model.
+    """
+
+    def __init__(self, n_channels, input_sigma: bool, fitting_model: str, estimate_S0, feed_sigma, rice=True, bilinear=False, use_3D=False, learn_sigma_scaling=False, checkpointing=False, width=1.0, separable=False, stem='dense'):
+        super(Shared_Atten_Unet, self).__init__()
+        self.input_sigma = input_sigma
+        self.n_channels = n_channels#20 or 60 if use_3D
+        self.fitting_model = fitting_model
+        self.fitting_models = fitting_model.split('_')#e.g. ['biexp', 'kurtosis', 'gamma']
+        assert all(fit in ('biexp', 'kurtosis', 'gamma') for fit in self.fitting_models), f'Not correct fitting model names, i got {fitting_model}'
+        self.use_3D = use_3D
+        self.learn_sigma_scaling = learn_sigma_scaling
+        self.checkpointing = checkpointing#Recompute the activations of each stage in the backward pass, see run_stage
+        self.width = width#Multiplier of the channels 64/128/256/512/1024 of the five resolution levels
+        self.separable = separable#Depthwise-separable instead of full 3x3 convolutions
+        self.stem = stem#Input layer for use_3D: 'dense', or per diffusion direction 'grouped'/'shared', see DirectionStem
+        assert stem == 'dense' or use_3D, 'Error: Only the input layer of use_3D can be grouped or shared'
+        ch = scaled_channels(width)
+        self.estimate_S0 = estimate_S0#Boolean if AI will estimate b0-image
+        self.bilinear = bilinear#For upsampling, default is False and instead ConvTranspose will be used
+        self.rice = rice#If Rician bias is going to be added.
+        self.feed_sigma = feed_sigma# If noise map is input to AI, then number of input channels is +1
+        if self.feed_sigma: add_channel = 1
+        else: add_channel = 0
+
+        if use_3D and stem != 'dense':#First layer
+            self.inc = DirectionStem(n_channels, ch[0], add_channel, shared=stem == 'shared', separable=separable)
+        elif use_3D:
+            self.inc = nn.Sequential(
+                DoubleConv(n_channels + add_channel, ch[0] * 3, separable=separable),
+                DoubleConv(ch[0] * 3, ch[0] * 2, separable=separable),
+                DoubleConv(ch[0] * 2, ch[0], separable=separable)
+            )
+        else:
+            self.inc = DoubleConv(n_channels + add_channel, ch[0], separable=separable)
+        self.down1 = Down(ch[0], ch[1], separable)
+        self.down2 = Down(ch[1], ch[2], separable)
+        self.down3 = Down(ch[2], ch[3], separable)
+        factor = 2 if bilinear else 1
+        self.down4 = Down(ch[3], ch[4] // factor, separable)
+
+        self.decoders = nn.ModuleDict({fit: Fit_Decoder(fit, ch, factor, input_sigma, estimate_S0, rice=rice, use_3D=use_3D, learn_sigma_scaling=learn_sigma_scaling,
+                                                        checkpointing=checkpointing, separable=separable)
+                                       for fit in self.fitting_models})
+
+    @property
+    def sigma_scale(self):
+        """Mean of the sigma scaling of the fitting models, for logging"""
+        return torch.stack([torch.as_tensor(decoder.sigma_scale).detach().cpu() for decoder in self.decoders.values()]).mean()
+
+    def encode(self, x, sigma_true):
+        """Shared encoder: input images -> feature maps of the five resolution levels"""
+        if self.feed_sigma:  x = torch.cat([x, sigma_true], dim=1)
+        x1 = run_stage(self.inc, x, checkpointing=self.checkpointing)
+        x2 = run_stage(self.down1, x1, checkpointing=self.checkpointing)
+        x3 = run_stage(self.down2, x2, checkpointing=self.checkpointing)
+        x4 = run_stage(self.down3, x3, checkpointing=self.checkpointing)
+        x5 = run_stage(self.down4, x4, checkpointing=self.checkpointing)
+        return x1, x2, x3, x4, x5
+
+    def forward(self, x,b,b0,sigma_true, scale_factor, mask=None):
+        features = self.encode(x, sigma_true)
+        outputs = {}
+        for fit, decoder in self.decoders.items():
+            logits = decoder.decode(*features)#Checked during training by LogitsMonitor
+            outputs[fit] = decoder.physics_head(logits, b, b0, sigma_true.clone(), scale_factor, mask)#sigma is modified in place by the head
+        return outputs
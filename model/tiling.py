@@ -0,0 +1,203 @@
+""" Tiled sliding-window inference, for patients whose slices do not fit into memory as one batch at full resolution """
+import math
+import torch
+import torch.nn as nn
+
+
+BLENDINGS = ('gaussian', 'linear', 'constant')
+
+
+def blending_window(height: int, width: int, overlap: int, blending: str = 'linear', device=None):
+    """
+    Weights of the voxels of one tile when overlapping tiles are averaged, (height, width), all weights > 0.
+
+    gaussian: Gaussian with standard deviation 1/8 of the tile size, centered on the tile.
+    linear: rises linearly over the *overlap* voxels at each edge and is 1 in the inner part of the tile.
+    constant: plain average of the overlapping tiles.
+    The voxels at the edges of a tile see the zero padding instead of their neighbours, so gaussian and linear weight
+    them down. The weights are normalized by their sum over the tiles, so a voxel covered by one tile keeps its value.
+    """
+    assert blending in BLENDINGS, f'Error: Unknown blending {blending}, choose between {", ".join(BLENDINGS)}'
+
+    def profile(size):
+        position = torch.arange(size, dtype=torch.float32, device=device)
+        if blending == 'gaussian':
+            std = size / 8
+            return torch.exp(-0.5 * ((position - (size - 1) / 2) / std) ** 2)
+        if blending == 'linear':
+            distance = torch.minimum(position + 1, size - position)#1 at the edges
+            return torch.clamp(distance / (overlap + 1), max=1.0)
+        return torch.ones(size, device=device)
+
+    window = profile(height)[:, None] * profile(width)[None, :]
+    return torch.clamp(window / window.max(), min=1e-3)
+
+
+def tile_starts(size: int, tile: int, overlap: int):
+    """First index of each tile along a dimension of *size* voxels. The last tile ends at the edge, so all tiles have the same size"""
+    if tile >= size:
+        return [0]
+    step = tile - overlap
+    starts = list(range(0, size - tile, step))
+    return starts + [size - tile]
+
+
+def batch_dim(key):
+    """Slice dimension of an output tensor: param_dict['parameters'] and its variance are (num_par, n_batches, H, W), all others (n_batches, ..., H, W)"""
+    return 1 if isinstance(key, str) and key.startswith('parameters') else 0
+
+
+def merge_outputs(fn, outputs, accumulated=None, key=None):
+    """
+    Apply fn(accumulated tensor, output tensor, key) to the tensors of the nested *outputs* of a network, e.g.
+    (M, param_dict) or {fitting model: (M, param_dict)}, and return the results in the same structure.
+    Other values, e.g. param_dict['names'], are passed through. *key* is the name of the innermost dictionary entry.
+    """
+    if isinstance(outputs, dict):
+        return {k: merge_outputs(fn, v, accumulated[k] if accumulated is not None else None, k) for k, v in outputs.items()}
+    if isinstance(outputs, tuple):
+        return tuple(merge_outputs(fn, v, accumulated[i] if accumulated is not None else None, key) for i, v in enumerate(outputs))
+    if torch.is_tensor(outputs):
+        return fn(accumulated, outputs, key)
+    return outputs
+
+
+class TiledNet:
+    """
+    Runs *net* on micro-batches of *slice_batch* slices, each cut into overlapping tiles of *tile_size* x *tile_size*
+    voxels, and blends the outputs of the tiles into full-size outputs. Called like the network, with the same outputs.
+
+    The physics head is evaluated per voxel, so only the trunk differs from full-slice inference: voxels near the edge
+    of a tile miss part of their receptive field. The overlap should cover that border: with 32 voxels and linear
+    blending, the mean absolute difference of each parameter map to full-slice inference is below 1e-4 of the mean of
+    the map, and M differs by at most 2e-3 of its maximum (see benchmark.py --mode tiling).
+    Tile sizes and overlaps that are multiples of 16 keep the pooling grid of the four down-sampling levels.
+
+    If *memory_budget* (GiB) is given, *slice_batch* and *tile_size* that are not given are chosen as large as possible
+    such that the activations of one forward pass stay within the budget. The activation memory per voxel is measured
+    once per input shape: on CUDA as the peak allocated memory of a probe forward pass, on CPU as the total size of all
+    module outputs of the probe, which overestimates the memory needed without gradients. The outputs assembled for
+    the whole patient have the size of the outputs of full-slice inference and are not part of the budget.
+
+    Example:
+
+        >>>tiled = TiledNet(net, tile_size=128, overlap=32, memory_budget=4)
+
+        >>>M, param_dict = tiled(images, b, image_b0, sigma, scale_factor)
+    """
+
+    def __init__(self, net, tile_size: int = None, overlap: int = 32, blending: str = 'linear', slice_batch: int = None, memory_budget: float = None):
+        assert blending in BLENDINGS, f'Error: Unknown blending {blending}, choose between {", ".join(BLENDINGS)}'
+        assert tile_size is None or tile_size > overlap, 'Error: Tile size has to be larger than the overlap'
+        self.net = net
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.blending = blending
+        self.slice_batch = slice_batch
+        self.memory_budget = memory_budget
+        self.bytes_per_voxel = {}#Per input shape (channels, H, W), see *probe_memory*
+
+    def probe_memory(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        """Activation bytes of one forward pass per slice and voxel, measured on a crop of the first slice"""
+        height, width = min(x.shape[-2], 128), min(x.shape[-1], 128)
+        inputs = self.crop((x, b, b0, sigma_true, scale_factor, mask), x.shape, slice(0, 1), slice(0, height), slice(0, width))
+        if x.device.type == 'cuda':
+            torch.cuda.synchronize(x.device)
+            torch.cuda.reset_peak_memory_stats(x.device)
+            start = torch.cuda.memory_allocated(x.device)
+            self.net(*inputs)
+            torch.cuda.synchronize(x.device)
+            total = torch.cuda.max_memory_allocated(x.device) - start
+        else:
+            assert isinstance(self.net, nn.Module), 'Error: The memory budget on CPU needs a torch network, pass the tile size and slice batch instead'
+            sizes = []
+            def hook(module, inp, out):
+                if torch.is_tensor(out):
+                    sizes.append(out.numel() * out.element_size())
+            handles = [m.register_forward_hook(hook) for m in self.net.modules() if len(list(m.children())) == 0]
+            try:
+                self.net(*inputs)
+            finally:
+                for h in handles:
+                    h.remove()
+            total = sum(sizes)
+        return total / (height * width)
+
+    def plan(self, x, *inputs):
+        """
+        Slice batch and tile size used for the input images *x*, (n_batches, n_channels, H, W).
+
+        :return: tuple (slice_batch, tile_height, tile_width)
+        """
+        n_batches, _, height, width = x.shape
+        tile = self.tile_size
+        slice_batch = self.slice_batch
+        if self.memory_budget:
+            shape = tuple(x.shape[1:])
+            if shape not in self.bytes_per_voxel:
+                self.bytes_per_voxel[shape] = self.probe_memory(x, *inputs)
+            voxels = self.memory_budget * 2**30 / self.bytes_per_voxel[shape]#Voxels of all slices of one forward pass
+            if tile is None and (slice_batch or 1) * height * width > voxels:
+                tile = int(math.sqrt(voxels / (slice_batch or 1))) // 16 * 16#Square tile on the pooling grid
+                assert tile > self.overlap, f'Error: Memory budget of {self.memory_budget} GiB is too small for tiles larger than the overlap'
+            tile_voxels = min(tile or height, height) * min(tile or width, width)
+            if slice_batch is None:
+                slice_batch = max(1, int(voxels // tile_voxels))
+        tile_height = min(tile or height, height)
+        tile_width = min(tile or width, width)
+        return min(slice_batch or n_batches, n_batches), tile_height, tile_width
+
+    @staticmethod
+    def crop(inputs, shape, slices, rows, cols):
+        """The slices *slices* and the region (*rows*, *cols*) of the inputs that have the batch size and image size of *shape*"""
+        def crop_one(t):
+            if not torch.is_tensor(t):
+                return t
+            if t.ndim >= 1 and t.shape[0] == shape[0]:
+                t = t[slices]
+            if t.ndim == 4 and tuple(t.shape[-2:]) == tuple(shape[-2:]):
+                t = t[..., rows, cols]
+            return t
+        return [crop_one(t) for t in inputs]
+
+    def __call__(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        n_batches, _, height, width = x.shape
+        slice_batch, tile_height, tile_width = self.plan(x, b, b0, sigma_true, scale_factor, mask)
+        if slice_batch == n_batches and (tile_height, tile_width) == (height, width):
+            return self.net(x, b, b0, sigma_true, scale_factor, mask)#Fits as a whole
+
+        window = blending_window(tile_height, tile_width, self.overlap, self.blending, device=x.device)
+        tiles = [(slice(top, top + tile_height), slice(left, left + tile_width))
+                 for top in tile_starts(height, tile_height, self.overlap) for left in tile_starts(width, tile_width, self.overlap)]
+        weight_sum = torch.zeros(height, width, device=x.device)
+        for rows, cols in tiles:
+            weight_sum[rows, cols] += window
+
+        accumulated = None
+        for first in range(0, n_batches, slice_batch):
+            slices = slice(first, min(first + slice_batch, n_batches))
+            for rows, cols in tiles:
+                inputs = self.crop((x, b, b0, sigma_true, scale_factor, mask), x.shape, slices, rows, cols)
+                outputs = self.net(*inputs)
+
+                def add(total, tile_output, key):
+                    if tuple(tile_output.shape[-2:]) != (tile_height, tile_width):
+                        return tile_output#Not a map, e.g. a scalar
+                    dim = batch_dim(key)
+                    if total is None:
+                        shape = list(tile_output.shape)
+                        shape[dim], shape[-2], shape[-1] = n_batches, height, width
+                        total = torch.zeros(shape, device=tile_output.device)
+                    index = [slice(None)] * total.ndim
+                    index[dim], index[-2], index[-1] = slices, rows, cols
+                    total[tuple(index)] += tile_output.float() * window.to(tile_output.device)
+                    return total
+
+                accumulated = merge_outputs(add, outputs, accumulated)
+
+        def normalize(_, total, key):
+            if tuple(total.shape[-2:]) != (height, width):
+                return total
+            return total / weight_sum.to(total.device)
+
+        return merge_outputs(normalize, accumulated)
@@ -1,23 +1,41 @@
 """ Parts of the U-Net model """
 
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def conv3x3(in_channels, out_channels, bias=False, separable=False):
+    """
+    3x3 convolution as a list of layers. With *separable*, a depthwise 3x3 followed by a pointwise 1x1 convolution,
+    which needs about 1/out_channels + 1/9 of the multiply-adds.
+    """
+    if separable:
+        return [nn.Conv2d(in_channels, in_channels, kernel_size=3, padding=1, groups=in_channels, bias=False),
+                nn.Conv2d(in_channels, out_channels, kernel_size=1, bias=bias)]
+    return [nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=bias)]
+
+
+def scaled_channels(width=1.0):
+    """Channels of the five resolution levels, 64/128/256/512/1024 times the width multiplier *width*"""
+    return [max(2, int(c * width)) for c in (64, 128, 256, 512, 1024)]
 
 
 class DoubleConv(nn.Module):
     """(convolution => [BN] => ReLU) * 2"""
 
-    def __init__(self, in_channels, out_channels, mid_channels=None, dropout_prob=0.1):
+    def __init__(self, in_channels, out_channels, mid_channels=None, dropout_prob=0.1, separable=False):
         super().__init__()
         if not mid_channels:
             mid_channels = out_channels
         self.double_conv = nn.Sequential(
-            nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1, bias=False),
+            *conv3x3(in_channels, mid_channels, separable=separable),
             nn.BatchNorm2d(mid_channels),
             nn.ReLU(inplace=True),
             #nn.Dropout(dropout_prob),
-            nn.Conv2d(mid_channels, out_channels, kernel_size=3, padding=1, bias=False),
+            *conv3x3(mid_channels, out_channels, separable=separable),
             nn.BatchNorm2d(out_channels),
             nn.ReLU(inplace=True)
         )
@@ -25,23 +43,62 @@ class DoubleConv(nn.Module):
     def forward(self, x):
         return self.double_conv(x)
 
+class DirectionStem(nn.Module):
+    """
+    Input layer for use_3D: (convolution => [BN] => ReLU) * 2 on the b-values of each diffusion direction separately,
+    then a DoubleConv fusing the three directions. Needs about 1/6 of the multiply-adds of the dense input layer.
+
+    *shared*: the same filters for all directions, the directions are stacked along the batch dimension.
+    Otherwise grouped convolutions with separate filters per direction.
+    Extra input channels after the *n_channels* images, e.g. the noise map of feed_sigma, are given to every direction.
+    """
+
+    def __init__(self, n_channels, out_channels, add_channel=0, shared=False, separable=False, n_directions=3):
+        super().__init__()
+        self.n_channels = n_channels
+        self.n_directions = n_directions
+        self.shared = shared
+        in_channels = n_channels // n_directions + add_channel#Per direction
+        mid_channels = out_channels // 2#Per direction
+        groups = 1 if shared else n_directions
+        self.directions = nn.Sequential(
+            nn.Conv2d(in_channels * groups, mid_channels * groups, kernel_size=3, padding=1, groups=groups, bias=False),
+            nn.BatchNorm2d(mid_channels * groups),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(mid_channels * groups, mid_channels * groups, kernel_size=3, padding=1, groups=groups, bias=False),
+            nn.BatchNorm2d(mid_channels * groups),
+            nn.ReLU(inplace=True)
+        )
+        self.fuse = DoubleConv(mid_channels * n_directions, out_channels, separable=separable)
+
+    def forward(self, x):
+        n_batches, _, height, width = x.shape
+        images, extra = x[:, :self.n_channels], x[:, self.n_channels:]
+        #(n_batches, n_directions, channels per direction, H, W)
+        x = torch.cat([images.reshape(n_batches, self.n_directions, -1, height, width),
+                       extra.unsqueeze(1).expand(-1, self.n_directions, -1, -1, -1)], dim=2)
+        x = x.reshape(n_batches * self.n_directions if self.shared else n_batches, -1, height, width)
+        x = self.directions(x)
+        return self.fuse(x.reshape(n_batches, -1, height, width))#Directions one after another along the channels
+
+
 class DoubleConvResidual(nn.Module):
     """(convolution => [BN] => ReLU) * 2"""
 
-    def __init__(self, in_channels, out_channels, mid_channels=None, dropout_prob=0.1):
+    def __init__(self, in_channels, out_channels, mid_channels=None, dropout_prob=0.1, separable=False):
         super().__init__()
         if not mid_channels:
             mid_channels = out_channels
         self.double_conv = nn.Sequential(
-            nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1, bias=False),
+            *conv3x3(in_channels, mid_channels, separable=separable),
             nn.BatchNorm2d(mid_channels),
             nn.ReLU(inplace=True),
             #nn.Dropout(dropout_prob),
-            nn.Conv2d(mid_channels, out_channels, kernel_size=3, padding=1),
+            *conv3x3(mid_channels, out_channels, bias=True, separable=separable),
             nn.BatchNorm2d(out_channels),
 
         )
-        self.residual_conv = nn.Conv2d(in_channels, out_channels, kernel_size=1, padding='same')
+        self.residual_conv = nn.Conv2d(in_channels, out_channels, kernel_size=1, padding=0)#1x1 kernel, same as padding='same', which the quantized conv does not accept
         self.residual_final_relu =  nn.ReLU(inplace=True)
     def forward(self, x):
 
@@ -55,11 +112,11 @@ class DoubleConvResidual(nn.Module):
 class Down(nn.Module):
     """Downscaling with maxpool then double conv"""
 
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, separable=False):
         super().__init__()
         self.maxpool_conv = nn.Sequential(
             nn.MaxPool2d(2),
-            DoubleConv(in_channels, out_channels)
+            DoubleConv(in_channels, out_channels, separable=separable)
         )
 
     def forward(self, x):
@@ -69,27 +126,27 @@ class Down(nn.Module):
 class Res_Down(nn.Module):
     """Downscaling with maxpool then double conv"""
 
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, separable=False):
         super().__init__()
         self.maxpool_conv = nn.Sequential(
             nn.MaxPool2d(2),
-            DoubleConvResidual(in_channels, out_channels)
+            DoubleConvResidual(in_channels, out_channels, separable=separable)
         )
     def forward(self, x):
         return self.maxpool_conv(x)
 class Up(nn.Module):
     """Upscaling then double conv"""
 
-    def __init__(self, in_channels, out_channels, bilinear=True):
+    def __init__(self, in_channels, out_channels, bilinear=True, separable=False):
         super().__init__()
 
         # if bilinear, use the normal convolutions to reduce the number of channels
         if bilinear:
             self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-            self.conv = DoubleConv(in_channels, out_channels, in_channels // 2)
+            self.conv = DoubleConv(in_channels, out_channels, in_channels // 2, separable=separable)
         else:
             self.up = nn.ConvTranspose2d(in_channels, in_channels // 2, kernel_size=2, stride=2)
-            self.conv = DoubleConv(in_channels, out_channels)
+            self.conv = DoubleConv(in_channels, out_channels, separable=separable)
 
     def forward(self, x1, x2):
         # upsampled feature map might be smaller than the original one
@@ -105,11 +162,11 @@ class Up(nn.Module):
         return self.conv(x)
 
 class Up_conv(nn.Module):
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, separable=False):
         super(Up_conv, self).__init__()
         self.up = nn.Sequential(
                 nn.Upsample(scale_factor=2),
-                nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=True),
+                *conv3x3(in_channels, out_channels, bias=True, separable=separable),
                 nn.BatchNorm2d(out_channels),
                 nn.ReLU(inplace=True))
     
@@ -238,3 +295,37 @@ class Attention_block(nn.Module):
         alpha = self.psi(psi)
 
         return alpha * x
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    """Restore the running statistics of all BatchNorm layers in *module* on exit, batch statistics are still used in training mode"""
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [[buffer.clone() for buffer in (m.running_mean, m.running_var, m.num_batches_tracked)] for m in norms]
+    try:
+        yield
+    finally:
+        for m, saved in zip(norms, stats):
+            for buffer, value in zip((m.running_mean, m.running_var, m.num_batches_tracked), saved):
+                buffer.copy_(value)
+
+
+def run_stage(stage, *inputs, checkpointing=False):
+    """
+    Run one stage of a network, e.g. Down, Up or Attention_block. With *checkpointing*, the activations inside the stage
+    are not kept for the backward pass but recomputed from *inputs*, trading compute for memory. Only applies when
+    gradients are enabled, inference is unaffected.
+
+    The recomputation does not update the BatchNorm running statistics a second time.
+    """
+    if not (checkpointing and torch.is_grad_enabled()):
+        return stage(*inputs)
+    recompute = [False]
+
+    def run(*inputs):
+        if recompute[0]:
+            with frozen_batchnorm_stats(stage):
+                return stage(*inputs)
+        recompute[0] = True
+        return stage(*inputs)
+    return checkpoint(run, *inputs, use_reentrant=False)
@@ -1,29 +1,79 @@
+import functools
 import torch
-from cmath import sqrt
+from math import sqrt
 
+def float32_policy(fn):
+    """
+    Mixed precision policy for precision-sensitive functions: *fn* always runs in float32.
+    Autocast is disabled inside *fn* and float16/bfloat16 tensor arguments are cast to float32.
+    """
+    def to_float32(arg):
+        if torch.is_tensor(arg) and arg.dtype in (torch.float16, torch.bfloat16):
+            return arg.float()
+        return arg
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [to_float32(arg) for arg in args]
+        kwargs = {key: to_float32(value) for key, value in kwargs.items()}
+        device_type = 'cpu'
+        for arg in [*args, *kwargs.values()]:
+            if torch.is_tensor(arg):
+                device_type = arg.device.type
+                break
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def bessel_i0e_i1e(x):
+    """
+    Exponentially scaled modified Bessel functions i0e(x) and i1e(x) for x >= 0, from the polynomial
+    approximations of Abramowitz and Stegun 9.8.1-9.8.4 (relative error < 1e-6). Only elementary operations,
+    used where torch.special.i0e/i1e are not available, e.g. in ONNX export.
+    """
+    small = torch.clamp(x, max=3.75)
+    t = (small / 3.75)**2
+    i0_small = torch.exp(-small)*(1+t*(3.5156229+t*(3.0899424+t*(1.2067492+t*(0.2659732+t*(0.0360768+t*0.0045813))))))
+    i1_small = torch.exp(-small)*small*(0.5+t*(0.87890594+t*(0.51498869+t*(0.15084934+t*(0.02658733+t*(0.00301532+t*0.00032411))))))
+
+    large = torch.clamp(x, min=3.75)
+    t = 3.75 / large
+    i0_large = (0.39894228+t*(0.01328592+t*(0.00225319+t*(-0.00157565+t*(0.00916281+t*(-0.02057706+t*(0.02635537+t*(-0.01647633+t*0.00392377))))))))/torch.sqrt(large)
+    i1_large = (0.39894228+t*(-0.03988024+t*(-0.00362018+t*(0.00163801+t*(-0.01031555+t*(0.02282967+t*(-0.02895312+t*(0.01787654-t*0.00420059))))))))/torch.sqrt(large)
+    return torch.where(x <= 3.75, i0_small, i0_large), torch.where(x <= 3.75, i1_small, i1_large)
+
+@float32_policy
 def sigmoid_cons(param, dmin, dmax):
     """
     constrain the output physilogical parameters between *dmin* and *dmax*
     """
     return dmin+(torch.sigmoid(param))*(dmax-dmin)
 
+@float32_policy
 def rice_exp(v, sigma):
     """
     Add the rician bias
     """
     t = v / sigma
+    if torch.onnx.is_in_onnx_export():
+        i0e, i1e = bessel_i0e_i1e(t**2/4)#torch.special.i0e/i1e have no ONNX operator
+    else:
+        i0e, i1e = torch.special.i0e(t**2/4), torch.special.i1e(t**2/4)
     res= sigma*(sqrt(torch.pi/8)*
-                    ((2+t**2)*torch.special.i0e(t**2/4)+
-                    t**2*torch.special.i1e(t**2/4)))
+                    ((2+t**2)*i0e+
+                    t**2*i1e))
     res = res.to(torch.float32)
     return res
 
+@float32_policy
 def bio_exp(d1, d2, f, b):
     """ivim model"""
     v = f*torch.exp(-b*d1*1e-3+1e-6) + (1-f)*torch.exp(-b*d2*1e-3+1e-6)
 
     return v
 
+@float32_policy
 def kurtosis(bval, D, K):
     """
     torch kurtosis function
@@ -32,9 +82,44 @@ def kurtosis(bval, D, K):
     X = torch.exp(-bval*D*1e-3+(bval*D*1e-3)**2*K/6+1e-6)
 
     return X
+
+@float32_policy
 def gamma(bval, theta, K):
     """
     torch gamma function
     """
-    X = torch.float_power(1+theta*bval*1e-3,-K)+1e-6
+    X = torch.pow((1+theta*bval*1e-3).double(),-K.double())+1e-6#Same as torch.float_power, which has no ONNX operator
     return X
+
+def foreground_mask(b0, threshold=0.05):
+    """
+    Tissue mask from the b0-image. A voxel is foreground if its b0 intensity exceeds *threshold* times the maximum of its slice.
+
+    :param b0: b0-image, (n_batches, 1, H, W)
+    :param threshold: Fraction of the per-slice maximum used as cut-off
+    :return: Boolean mask, (n_batches, 1, H, W)
+    """
+    return b0 > threshold * torch.amax(b0, dim=(-2, -1), keepdim=True)
+
+def gather_voxels(mask, *maps):
+    """
+    Gather the foreground voxels of each map into a compact (n_voxels, C) tensor.
+    Maps broadcastable to (n_batches, C, H, W) are accepted, e.g. scale_factor.view(-1,1,1,1).
+    If *mask* is None the maps are returned unchanged.
+    """
+    if mask is None:
+        return maps
+    m = mask[:, 0]#(n_batches, H, W)
+    return tuple(t.expand(m.shape[0], -1, *m.shape[-2:]).permute(0, 2, 3, 1)[m] for t in maps)
+
+def scatter_voxels(mask, values):
+    """
+    Inverse of *gather_voxels*: (n_voxels, C) -> (n_batches, C, H, W), background voxels are set to zero.
+    If *mask* is None the values are returned unchanged.
+    """
+    if mask is None:
+        return values
+    m = mask[:, 0]
+    out = values.new_zeros(size=(*m.shape, values.shape[-1]))
+    out[m] = values
+    return out.permute(0, 3, 1, 2)
@@ -1,15 +1,20 @@
-from pytorch_msssim import MS_SSIM
-from model.unet_model import UNet
-from model.attention_unet import Atten_Unet
-from model.res_attention_unet import Res_Atten_Unet
+from model.networks import build_net, parse_fitting_models
+from model.fusion import fold_batchnorm, is_folded
+from model.quantization import quantize_trunk
+from model.ensemble import EnsembleNet
+from model.tiling import TiledNet, BLENDINGS
+from model.adc import ADC
 from model.unet_MultiDecoder import UNet_MultiDecoders
 from torch.utils.data import DataLoader, random_split
-from utils import patientDataset
+from utils import CustomLoss, patientDataset, to_channels_last, amp_autocast
+from model.utils import foreground_mask
 from pathlib import Path
 import os
 import numpy as np
 import torch
 import argparse
+import json
+import time
 import wandb
 import torch.nn as nn
 from tqdm import tqdm
@@ -17,46 +22,11 @@ from IPython import embed
 result_path = Path('/TANK/mustafa/results/cross_validation_l1_ssim_s0est/')
 
 
-class CustomLoss(nn.Module):
-
-    """
-    Custom loss function: :math:`L` = (1-SSIM) :math:`\cdot` MSEloss
-
-    Example:
-
-        >>>loss = CustomLoss()
-
-        >>>loss_value = loss(predicted,target)
-    """
-
-
-    def __init__(self):
-        super(CustomLoss, self).__init__()
-        self.ssim_loss = MS_SSIM(channel=1, win_size=5)
-        self.ssim_loss2 = MS_SSIM(channel=20, win_size=5)
-        self.ssim_loss3 = MS_SSIM(channel=60, win_size=5)
-        self.mse_loss =  nn.L1Loss()#nn.MSELoss()
-    def update_data_range(self, range):
-        self.ssim_loss.data_range = range
-    def forward(self, M,images, ssim_bool = False, only_ssim = False):
-        if M.shape[1]>1 and M.shape[1]<21 and ssim_bool:
-            loss_ssim = 1 - self.ssim_loss2(M, images)
-        elif M.shape[1]>21 and ssim_bool:
-            loss_ssim = 1 - self.ssim_loss3(M, images)
-        elif ssim_bool:
-            loss_ssim = 1 - self.ssim_loss(M, images)
-        else:
-            loss_ssim = 1
-
-        if not only_ssim:
-            loss_mse = self.mse_loss(M, images)
-        else:
-            loss_mse = 1
-        return loss_ssim * loss_mse
 def get_args():
     parser = argparse.ArgumentParser(description='Train the UNet on images')
     parser.add_argument('--load', '-f', type=str, default='/TANK/mustafa/checkpoints/cross_validation_l1_ssim_s0est',
                         help='Specify folder path to the neural network models to be used for inference')
+    parser.add_argument('--result_path', '-rpath', type=str, default=str(result_path), help='Folder the parameter maps are saved to, in subfolders per network model, fitting model, patient and run')
     parser.add_argument('--custom_patient_list', '-clist', type=str, default='predictList.txt', help='Input path to txt file with patient names to be used for inference.')
     parser.add_argument('--rice', '-rice', action='store_true',help='Use this flag if you want to add Rician bias during inference')
     parser.add_argument('--filter', '-filter',  type=str, default='', help='Filter nerual network models for inference , for example -filter attention_unet.')
@@ -66,6 +36,25 @@ def get_args():
     parser.add_argument('--input_sigma', '-s',  action = 'store_true', help='If a known noise map was inputted.')
     parser.add_argument('--estimate_S0', '-s0', action = 'store_true', help='Pass if allowed AI to estimate S0-image')
     parser.add_argument('--feed_sigma', '-fs', action = 'store_true', help='Pass if feeding sigma map to AI. Input sigma has to be true')
+    parser.add_argument('--mask_background', '-mask', action = 'store_true', help='Pass if the physics head is only evaluated on foreground voxels, derived from the b0-image')
+    parser.add_argument('--mask_threshold', '-mth', type=float, default=0.05, help='Fraction of the per-slice b0 maximum used as foreground threshold')
+    parser.add_argument('--channels_last', '-cl', action = 'store_true', help='Pass to run the network and its inputs in channels_last memory format')
+    parser.add_argument('--compile', '-compile', action = 'store_true', help='Pass to wrap the network in torch.compile')
+    parser.add_argument('--fold_bn', '-fold', action = 'store_true', help='Pass to fold BatchNorm into the convolutions after loading. Checkpoints exported with export.py are already folded')
+    parser.add_argument('--amp', '-amp', type=str, default=None, choices=['bf16', 'fp16'], help='Mixed precision for the convolutional part of the network. Physics head and loss stay in float32')
+    parser.add_argument('--int8', '-int8', action = 'store_true', help='Pass to run the convolutional part of the network quantized to int8 on CPU. Physics head stays in float32')
+    parser.add_argument('--backend', '-backend', type=str, default='torch', choices=list(BACKEND_EXTENSIONS),
+                        help='torch: .pth checkpoints, built from the CLI flags. onnxruntime: .onnx files from export.py --format onnx. '
+                             'torchscript: .pt files from export.py --format torchscript. The exported networks are configured from their metadata')
+    parser.add_argument('--calibration_list', '-calist', type=str, default=None, help='Input path to txt file with patient names used to calibrate the int8 quantization. Defaults to the first two patients of --custom_patient_list')
+    parser.add_argument('--ensemble', '-ens', action = 'store_true', help='Pass to run the runs (e.g. cross validation folds) of each network model and fitting model as one ensemble. '
+                        'Saves the per-voxel mean and variance over the runs to the run folder ensemble')
+    parser.add_argument('--tile_size', '-tile', type=int, default=0, help='Run the network on overlapping tiles of tile_size x tile_size voxels instead of full slices, 0 for full slices. Multiples of 16 keep the pooling grid')
+    parser.add_argument('--overlap', '-overlap', type=int, default=32, help='Overlap of neighbouring tiles in voxels')
+    parser.add_argument('--blending', '-blend', type=str, default='linear', choices=list(BLENDINGS), help='Weighting of the overlapping tiles, see blending_window in model/tiling.py')
+    parser.add_argument('--slice_batch', '-sb', type=int, default=0, help='Number of slices per forward pass, 0 for all slices of a patient')
+    parser.add_argument('--adc', '-adc', action = 'store_true', help='Pass to also save the ADC maps between b100 and b1000 of M and of the images, averaged over the diffusion directions')
+    parser.add_argument('--memory_budget', '-mem', type=float, default=0, help='Activation memory in GiB of one forward pass. Slice batch and tile size that are not given are chosen to stay within it, 0 for no limit')
 
     return parser.parse_args()
 
@@ -113,6 +102,95 @@ def save_params(result_dict,model_folder: str,fitting_folder: str ,patient_folde
             print(f'{key} is not on cpu. Moved to cpu')
         npy_file_name =key+'.npy'
         np.save(os.path.join(complete_path,npy_file_name ), res)
+def load_net(pth_file, model_name: str, fitting_name: str, n_channels: int, args, device):
+    """
+    Construct the network given by the checkpoint folder names and the CLI flags, and load the trained weights.
+    Checkpoints exported with folded BatchNorm (export.py) are detected and loaded into a folded network.
+
+    :param pth_file: Path to the .pth file
+    :param model_name: Name of network model, e.g. 'unet'. See *extract_file_name_folders*.
+    :param fitting_name: Name of fitting model, e.g. 'biexp'.
+    :param n_channels: Number of input channels, 20 or 60 if use_3D.
+    :param args: Parsed CLI arguments with rice, input_sigma, use_3D, learn_sigma_scaling, estimate_S0, feed_sigma and fold_bn.
+    :param device: Device the network is moved to.
+    :return: Network in eval mode
+    """
+    net = build_net(model_name, n_channels, rice=args.rice, bilinear=False, input_sigma=args.input_sigma, fitting_model=fitting_name, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma)
+
+    #Load in the trained neural network for inference
+    checkpoint = torch.load(pth_file, map_location=device, weights_only=True)
+    print(f'loaded model weights from {pth_file}\n')
+
+    #Needed as with net = nn.parallel.DistributedDataParallel(net) adds the 'module' in the layers' labels.
+    modified_checkpoint = {k.replace('module.', ''): v for k, v in checkpoint.items()}
+
+    folded = is_folded(modified_checkpoint)
+    if folded:
+        fold_batchnorm(net)#Same structure as the exported network, the weights are overwritten below
+    net.load_state_dict(modified_checkpoint)
+    net.to(device=device)
+
+    net.eval()
+    if args.fold_bn and not folded:
+        fold_batchnorm(net)
+    return net
+
+class OnnxNet:
+    """
+    Network exported with export.py --format onnx, run with ONNX Runtime on CPU. Called like the torch networks.
+    The configuration of the network is read from the metadata of the .onnx file into *config*.
+    """
+
+    def __init__(self, onnx_file: str):
+        import onnxruntime as ort#Only needed for this backend
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+        print(f'loaded ONNX model from {onnx_file}\n')
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = metadata['names'].split(',')
+        self.config = {key: metadata[key] == 'True' for key in ['input_sigma', 'estimate_S0', 'use_3D', 'feed_sigma', 'rice']}
+        self.config['fitting_model'] = metadata['fitting_model']
+        self.input_names = [i.name for i in self.session.get_inputs()]#Unused inputs, e.g. b0 if estimate_S0, are not in the graph
+
+    def __call__(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        inputs = {'images': x, 'b': b, 'b0': b0, 'sigma': sigma_true, 'scale_factor': scale_factor}
+        M, parameters, sigma = self.session.run(None, {name: inputs[name].cpu().numpy() for name in self.input_names})
+        M = torch.from_numpy(M)
+        if mask is not None:
+            M = M * mask.cpu()#Same as the masked physics head, which leaves the background of M zero
+        return M, {'parameters': torch.from_numpy(parameters), 'sigma': torch.from_numpy(sigma), 'names': self.names}
+
+class ScriptedNet:
+    """
+    Network exported with export.py --format torchscript, loaded without the model classes. Called like the torch networks,
+    the b-values stored in the artifact are used. The configuration of the network is read from config.json into *config*.
+    """
+
+    def __init__(self, pt_file: str):
+        extra_files = {'config.json': ''}
+        self.module = torch.jit.load(pt_file, map_location='cpu', _extra_files=extra_files)
+        print(f'loaded TorchScript model from {pt_file}\n')
+        self.config = json.loads(extra_files['config.json'])
+        self.names = self.config['names']
+
+    def __call__(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        M, parameters, sigma = self.module(x, b0, sigma_true, scale_factor)
+        if mask is not None:
+            M = M * mask#Same as the masked physics head, which leaves the background of M zero
+        return M, {'parameters': parameters, 'sigma': sigma, 'names': self.names}
+
+BACKEND_EXTENSIONS = {'torch': '.pth', 'onnxruntime': '.onnx', 'torchscript': '.pt'}
+EXPORTED_NETS = {'onnxruntime': OnnxNet, 'torchscript': ScriptedNet}
+
+def calibration_batches(test_dir: str, patients: list, args, fitting_name: str):
+    """
+    All slices of *patients* as (images, sigma) tuples, one tuple per patient, for calibrating *quantize_trunk*.
+    """
+    dataset = patientDataset(test_dir, custom_list=patients, input_sigma=args.input_sigma, use_3D=args.use_3D, fitting_model=fitting_name)
+    loader = DataLoader(dataset, batch_size=22 if args.use_3D else 66, shuffle=False, num_workers=4)
+    return [(images.float(), sigma.float()) for images, image_b0, sigma, scale_factor in loader]
+
 def index_files(path, file_list=None):
     """ Recursively index files inside folders and return a flat list of file paths. """
     if file_list is None:
@@ -160,8 +238,12 @@ if __name__ == '__main__':
     os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 
     args = get_args()
+    result_path = Path(args.result_path)#Used by save_params
     assert not(args.feed_sigma and not args.input_sigma), 'Error: Argument input_sigma needs to be true if argument feed_sigma is passed'
     #Otherwise a tensor(1) is fed to neural network and not a proper noise map
+    assert not(args.int8 and (args.amp or args.compile)), 'Error: Argument int8 can not be combined with amp or compile'
+    assert not(args.backend != 'torch' and (args.int8 or args.amp or args.compile or args.channels_last)), 'Error: Arguments int8, amp, compile and channels_last are only used by the torch backend'
+    assert not(args.ensemble and (args.backend != 'torch' or args.int8 or args.channels_last)), 'Error: Argument ensemble is only supported by the torch backend without int8 and channels_last'
 
     if args.custom_patient_list:
         with open(args.custom_patient_list, 'r') as file:
@@ -170,20 +252,42 @@ if __name__ == '__main__':
             predict_list = content.split(',')#List of patients where inference is applied on
 
     test_dir = args.test_data_directory
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    device = torch.device('cuda:0' if torch.cuda.is_available() and not args.int8 and args.backend == 'torch' else 'cpu')#Quantized kernels and exported networks run on CPU
+    if args.int8:
+        if args.calibration_list:
+            with open(args.calibration_list, 'r') as file:
+                calibration_list = file.read().strip().split(',')
+        else:
+            calibration_list = predict_list[:2]
+        calibration = {}#Calibration data per fitting model, as patientDataset depends on it
     folder_path = args.load
     indexed_files = index_files(folder_path)
     indexed_files = [f for f in indexed_files if args.filter in f]#If filtering is used, e.g. -filter '/unet' only runs inference on unet models
+    indexed_files = [f for f in indexed_files if f.endswith(BACKEND_EXTENSIONS[args.backend])]
+    if args.ensemble:
+        #One ensemble per network model, fitting model and checkpoint name, made of the files of all runs
+        ensembles = {}
+        for f in indexed_files:
+            model_name, fitting_name, run_number, file_name = extract_file_name_folders(f)
+            ensembles.setdefault((model_name, fitting_name, file_name), []).append(f)
+        indexed_files = [files[0] for files in ensembles.values()]#The loop below runs once per ensemble
     for patient in predict_list:
         print(f'Running model for patient: {patient}::\n\n')
         for i,pth_file in enumerate(indexed_files):
             model_name, fitting_name,run_number, file_name = extract_file_name_folders(indexed_files[i]) # List of all files with their full paths
             print( model_name, fitting_name,run_number, file_name)
+            fitting_models = parse_fitting_models(fitting_name)#Several with a shared encoder, e.g. biexp_kurtosis_gamma
+            assert not(len(fitting_models) > 1 and (args.int8 or args.ensemble)), 'Error: Arguments int8 and ensemble need a network of one fitting model'
+            if args.backend != 'torch':
+                net = EXPORTED_NETS[args.backend](indexed_files[i])
+                input_sigma, use_3D = net.config['input_sigma'], net.config['use_3D']#The exported network knows its configuration
+            else:
+                input_sigma, use_3D = args.input_sigma, args.use_3D
             # Load the test dataset
-            test = patientDataset(test_dir,  custom_list=[patient], input_sigma=args.input_sigma, use_3D=args.use_3D, fitting_model=fitting_name)
+            test = patientDataset(test_dir,  custom_list=[patient], input_sigma=input_sigma, use_3D=use_3D, fitting_model=fitting_models[0])#Noise map of the first fitting model
 
             #Load all images of that patient
-            if args.use_3D:
+            if use_3D:
                 batch_size = 22# Will load (22,3,200,240)
             else:
                 batch_size = 66# Will load(66,1,200,240)
@@ -194,38 +298,39 @@ if __name__ == '__main__':
             b = torch.linspace(0, 2000, steps=21, device=device)
             b = b[1:]#Exclude 0
             b = b.reshape(1, len(b), 1, 1)
+            adc_map = ADC(b, n_directions=3 if use_3D else 1)
 
-            if args.use_3D:
+            if use_3D:
                 n_channels = 60#All three diffusion encoding directions are input
             else:
                 n_channels = 20#Only one diffusion encoding directions is input
 
 
             # Load the neural network model
-            if model_name == 'attention_unet':
-                net = Atten_Unet(n_channels=n_channels, rice=args.rice, bilinear=False, input_sigma=args.input_sigma, fitting_model=fitting_name, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma)
-            elif model_name == 'unet':
-                net = UNet(n_channels=n_channels, rice=args.rice, bilinear=False, input_sigma=args.input_sigma,fitting_model=fitting_name, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma)
-            elif model_name == 'res_atten_unet':
-                net = Res_Atten_Unet(n_channels=n_channels, rice=args.rice, bilinear=False, input_sigma=args.input_sigma, fitting_model=fitting_name, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma)
-            else:
-                assert False, f'Could not find type of network model, i got {model_name}'
-
-            #Load in the trained neural network for inference
-            checkpoint = torch.load(indexed_files[i], map_location=device, weights_only=True)
-            print(f'loaded model weights from {indexed_files[i]}\n')
-
-            #Needed as with net = nn.parallel.DistributedDataParallel(net) adds the 'module' in the layers' labels.
-            modified_checkpoint = {k.replace('module.', ''): v for k, v in checkpoint.items()}
-
-            net.load_state_dict(modified_checkpoint)
-            net.to(device=device)
-
-            net.eval()
+            if args.ensemble:
+                ensemble_files = ensembles[(model_name, fitting_name, file_name)]
+                #vmap over the stacked weights pays off on GPU, on CPU the networks run one after another
+                net = EnsembleNet([load_net(f, model_name, fitting_name, n_channels, args, device) for f in ensemble_files], vectorize=device.type == 'cuda')
+                run_number = 'ensemble'
+                print(f'Ensemble of {len(net)} runs: {ensemble_files}')
+            elif args.backend == 'torch':
+                net = load_net(indexed_files[i], model_name, fitting_name, n_channels, args, device)
+            if args.int8:
+                if fitting_name not in calibration:
+                    calibration[fitting_name] = calibration_batches(test_dir, calibration_list, args, fitting_name)
+                net = quantize_trunk(net, calibration[fitting_name])
+            if args.channels_last and args.backend == 'torch':
+                net = net.to(memory_format=torch.channels_last)
+            run_net = torch.compile(net) if args.compile else net
+            if args.tile_size or args.slice_batch or args.memory_budget:
+                #Micro-batches of slices and/or overlapping tiles, blended into the same outputs as for full slices
+                run_net = TiledNet(run_net, tile_size=args.tile_size or None, overlap=args.overlap, blending=args.blending,
+                                   slice_batch=args.slice_batch or None, memory_budget=args.memory_budget or None)
             b0_image = None
             n = len(test)#number of images in a patient
             results = {}
             criterion = CustomLoss()
+            inference_time = 0.0#Forward passes of all batches of the patient, without loss and saving
             with torch.no_grad():
 
                 with tqdm(total=n, unit='img') as pbar:
@@ -235,21 +340,36 @@ if __name__ == '__main__':
                         image_b0 = image_b0.to(device=device, dtype=torch.float32, non_blocking=True)# (66, 1, 200, 240)
                         scale_factor = scale_factor.to(device=device, dtype=torch.float32, non_blocking=True)# (66,)
                         b = b.to(device=device, dtype=torch.float32, non_blocking=True)# (1, 20, 1, 1)
+                        if args.channels_last:
+                            images, sigma, image_b0 = to_channels_last(images, sigma, image_b0)
 
                         mse = torch.nn.MSELoss()
-                        M, param_dict = net(images,b,image_b0, sigma,scale_factor)
+                        mask = foreground_mask(image_b0, threshold=args.mask_threshold) if args.mask_background else None
+                        start = time.perf_counter()
+                        with amp_autocast(args.amp, device.type):
+                            outputs = run_net(images,b,image_b0, sigma,scale_factor, mask)
+                        if device.type == 'cuda':
+                            torch.cuda.synchronize(device)#Kernels run asynchronously, wait for them before stopping the clock
+                        inference_time += time.perf_counter() - start
                         # M: (66, 20, 200, 240) or (22, 60, 200, 240) if use_3D
                         #param_dict: dict_keys(['parameters', 'sigma', 'names']),  'names' for parameter names
+                        #Shared encoder: one tuple (M, param_dict) per fitting model from one encoder pass, saved to the folder of each fitting model
+                        fit_outputs = outputs.items() if isinstance(outputs, dict) else [(fitting_name, outputs)]
 
-                        M = M * scale_factor.view(-1, 1, 1, 1)
                         images = images * scale_factor.view(-1, 1, 1, 1)
                         b0_image = image_b0
                         criterion.update_data_range(torch.max(images))
-                        loss = criterion(M, images, ssim_bool=True)
-                        loss_np = np.array(loss.item())
-                        M_np,param_dict_np = to_numpy(M, param_dict)
-                        results.update(param_dict_np)
-                        results.update({'M':M_np,'loss': loss_np})
                         pbar.update(images.shape[0])
-                        save_params(result_dict= results, model_folder = model_name,fitting_folder  =fitting_name,patient_folder = patient, run_number = run_number,file_name = file_name )
-                        print('Saved this run\n')
\ No newline at end of file
+                        for fit, (M, param_dict) in fit_outputs:
+                            M = M * scale_factor.view(-1, 1, 1, 1)
+                            loss = criterion(M, images, ssim_bool=True, mask=mask)
+                            loss_np = np.array(loss.item())
+                            M_np,param_dict_np = to_numpy(M, param_dict)
+                            results.setdefault(fit, {}).update(param_dict_np)
+                            results[fit].update({'M':M_np,'loss': loss_np})
+                            if args.adc:
+                                ADC_M_np, ADC_images_np = to_numpy(adc_map(M), adc_map(images))
+                                results[fit].update({'ADC': ADC_M_np, 'ADC_images': ADC_images_np})
+                            save_params(result_dict= results[fit], model_folder = model_name,fitting_folder  =fit,patient_folder = patient, run_number = run_number)
+                        print('Saved this run\n')
+                print(f'Inference time for {patient}: {inference_time:.2f} s')
@@ -0,0 +1,191 @@
+"""
+Structured channel pruning of trained checkpoints. The least important channels of every layer are removed, the
+remaining weights are copied into the narrower width variant of the network, e.g. 'attention_unet_w0.5' for
+--keep 0.5, which is fine-tuned for a few steps with the training loss. The pruned checkpoints are written to
+<output>/<model>_w<width>/<fitting_model>/run_N/<file>.pth, so predict.py builds the narrower network from the folder name.
+
+A quality-versus-sparsity report, comparing every pruned network with the original one on the validation patients,
+is printed and saved to <output>/prune_report.json.
+
+Example:
+
+    >>>python prune.py -f /TANK/mustafa/checkpoints/cross_validation_l1_ssim_s0est -o /TANK/mustafa/pruned/cross_validation_l1_ssim_s0est -dir /m2_data/mustafa/trainData/ -clist trainList.txt -vlist valList.txt -k 0.75 0.5 0.25 -s -s0 -fs
+"""
+from predict import index_files, extract_file_name_folders, load_net
+from model.networks import build_net, parse_training_model
+from model.pruning import prune_channels
+from utils import patientDataset, CustomLoss
+from torch.utils.data import DataLoader
+from pathlib import Path
+import argparse
+import itertools
+import json
+import os
+import time
+import torch
+import torch.optim as optim
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Prune channels of trained networks and fine-tune the narrower networks')
+    parser.add_argument('--load', '-f', type=str, required=True, help='Folder with the trained .pth files, same layout as for predict.py')
+    parser.add_argument('--output', '-o', type=str, required=True, help='Folder the pruned networks and the report are written to')
+    parser.add_argument('--keep', '-k', type=float, nargs='+', default=[0.75, 0.5, 0.25], help='Fractions of the channels of every layer that are kept, one pruned network per fraction')
+    parser.add_argument('--filter', '-filter', type=str, default='', help='Filter neural network models to prune, for example -filter attention_unet.')
+    parser.add_argument('--data_directory', '-dir', type=str, default='/m2_data/mustafa/trainData/', help='Path to the training data.')
+    parser.add_argument('--custom_patient_list', '-clist', type=str, default='trainList.txt', help='Input path to txt file with patient names used for fine-tuning.')
+    parser.add_argument('--validation_list', '-vlist', type=str, default='valList.txt', help='Input path to txt file with patient names used for the report.')
+    parser.add_argument('--steps', '-steps', type=int, default=200, help='Number of fine-tuning steps per pruned network, 0 to skip fine-tuning')
+    parser.add_argument('--batch_size', '-b', type=int, default=8, help='Batch size of the fine-tuning')
+    parser.add_argument('--learning_rate', '-l', type=float, default=1e-4, help='Learning rate of the fine-tuning')
+    parser.add_argument('--rice', '-rice', action='store_true', help='Use this flag if Rician bias is added during inference')
+    parser.add_argument('--use_3D', '-3d', action='store_true', help='If 3D')
+    parser.add_argument('--learn_sigma_scaling', '-ss', type=str, help='Pass True if AI was allowed to learn scaling sigma')
+    parser.add_argument('--input_sigma', '-s', action='store_true', help='If a known noise map was inputted.')
+    parser.add_argument('--estimate_S0', '-s0', action='store_true', help='Pass if allowed AI to estimate S0-image')
+    parser.add_argument('--feed_sigma', '-fs', action='store_true', help='Pass if feeding sigma map to AI. Input sigma has to be true')
+    args = parser.parse_args()
+    args.fold_bn = False#Pruning needs the BatchNorm layers
+    return args
+
+
+def read_patient_list(txt_file: str):
+    """Patient names of a comma separated txt file"""
+    with open(txt_file, 'r') as file:
+        return file.read().strip().split(',')
+
+
+def pruned_name(model_name: str, keep: float):
+    """Name of the width variant of *model_name* with the fraction *keep* of its channels, e.g. 'unet_w0.5_dw' for 'unet_dw' and 0.5"""
+    model, variant = parse_training_model(model_name)
+    width = variant.get('width', 1.0) * keep
+    return f'{model}_w{width:g}' + ('_dw' if variant.get('separable') else '')
+
+
+def loss_step(net, criterion, images, image_b0, sigma, scale_factor, b):
+    """Forward pass and loss of one batch, same loss as train.py without ADC loss"""
+    M, param_dict = net(images, b, image_b0, sigma, scale_factor)
+    M = M * scale_factor.view(-1, 1, 1, 1)
+    images = images * scale_factor.view(-1, 1, 1, 1)
+    criterion.update_data_range(torch.max(images))
+    return criterion(M, images, ssim_bool=True), param_dict
+
+
+def to_device(batch, device):
+    """(images, image_b0, sigma, scale_factor) of *patientDataset* as float32 on *device*"""
+    return [x.to(device=device, dtype=torch.float32) for x in batch]
+
+
+def fine_tune(net, loader, b, steps: int, learning_rate: float, device):
+    """
+    Train *net* for *steps* batches of *loader* with Adam and the training loss.
+
+    :return: *net* in eval mode
+    """
+    net.train()
+    optimizer = optim.Adam(net.parameters(), lr=learning_rate)
+    criterion = CustomLoss()
+    batches = itertools.cycle(loader)#The fine-tuning is usually shorter than an epoch
+    for step in range(steps):
+        images, image_b0, sigma, scale_factor = to_device(next(batches), device)
+        optimizer.zero_grad(set_to_none=True)
+        loss, _ = loss_step(net, criterion, images, image_b0, sigma, scale_factor, b)
+        loss.backward()
+        optimizer.step()
+    return net.eval()
+
+
+def evaluate(net, loader, b, device, reference=None):
+    """
+    Mean loss and inference time of *net* on *loader*. If *reference* is given, the parameter maps are compared with
+    those of *reference*, see the return value.
+
+    :param reference: List of the parameter maps of the original network per batch, returned by a previous call.
+    :return: tuple (mean loss, inference time in s, list of parameter maps per batch, dict parameter name -> mean absolute
+        difference to *reference* relative to the mean absolute value of *reference*)
+    """
+    net.eval()
+    criterion = CustomLoss()
+    losses, parameters, seconds = [], [], 0.0
+    with torch.no_grad():
+        for images, image_b0, sigma, scale_factor in (to_device(batch, device) for batch in loader):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            loss, param_dict = loss_step(net, criterion, images, image_b0, sigma, scale_factor, b)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            seconds += time.perf_counter() - start
+            losses.append(loss.item())
+            parameters.append(param_dict['parameters'].cpu())
+    names = param_dict['names']
+    errors = None
+    if reference is not None:
+        errors = {}
+        for i, name in enumerate(names):
+            difference = sum(torch.abs(p[i] - r[i]).sum().item() for p, r in zip(parameters, reference))
+            magnitude = sum(torch.abs(r[i]).sum().item() for r in reference)
+            errors[name] = difference / magnitude
+    return sum(losses) / len(losses), seconds, parameters, errors
+
+
+def print_report(report: list):
+    """Table of the quality-versus-sparsity report"""
+    print(f'{"network":<56}{"keep":>6}{"params":>12}{"time [s]":>10}{"speedup":>9}{"loss":>10}{"pruned":>10}{"tuned":>10}  relative parameter error')
+    for row in report:
+        errors = ', '.join(f'{name} {error:.3f}' for name, error in row['relative_error'].items())
+        print(f'{row["network"]:<56}{row["keep"]:>6.2f}{row["parameters"]:>12}{row["time"]:>10.2f}{row["speedup"]:>9.2f}'
+              f'{row["loss_original"]:>10.4f}{row["loss_pruned"]:>10.4f}{row["loss_fine_tuned"]:>10.4f}  {errors}')
+
+
+if __name__ == '__main__':
+    args = get_args()
+    assert not(args.feed_sigma and not args.input_sigma), 'Error: Argument input_sigma needs to be true if argument feed_sigma is passed'
+    assert all(0 < keep <= 1 for keep in args.keep), 'Error: Argument keep has to be in (0, 1]'
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    n_channels = 60 if args.use_3D else 20
+    b = torch.linspace(0, 2000, steps=21, device=device)[1:].reshape(1, 20, 1, 1)#[100, 200, ..., 2000]
+    train_list = read_patient_list(args.custom_patient_list)
+    val_list = read_patient_list(args.validation_list)
+    datasets = {}#Per fitting model, as patientDataset depends on it
+
+    report = []
+    indexed_files = [f for f in index_files(args.load) if f.endswith('.pth') and args.filter in f]
+    for pth_file in indexed_files:
+        model_name, fitting_name, run_number, file_name = extract_file_name_folders(pth_file)
+        if fitting_name not in datasets:
+            datasets[fitting_name] = [patientDataset(args.data_directory, custom_list=patients, input_sigma=args.input_sigma, use_3D=args.use_3D, fitting_model=fitting_name)
+                                      for patients in (train_list, val_list)]
+        train_set, val_set = datasets[fitting_name]
+        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
+        val_loader = DataLoader(val_set, batch_size=22 if args.use_3D else 66, shuffle=False, num_workers=4)
+
+        net = load_net(pth_file, model_name, fitting_name, n_channels, args, device)
+        loss_original, time_original, reference, _ = evaluate(net, val_loader, b, device)
+        images, _, sigma, _ = to_device(next(iter(val_loader)), device)
+        for keep in args.keep:
+            small_name = pruned_name(model_name, keep)
+            small = build_net(small_name, n_channels, rice=args.rice, bilinear=False, input_sigma=args.input_sigma, fitting_model=fitting_name, use_3D=args.use_3D,
+                              learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0=args.estimate_S0, feed_sigma=args.feed_sigma).to(device)
+            prune_channels(net, small, images[:2], sigma[:2])
+            loss_pruned = evaluate(small, val_loader, b, device)[0]
+            fine_tune(small, train_loader, b, args.steps, args.learning_rate, device)
+            loss_tuned, time_small, _, errors = evaluate(small, val_loader, b, device, reference)
+
+            save_path = Path(os.path.join(args.output, small_name, fitting_name, run_number))
+            save_path.mkdir(parents=True, exist_ok=True)
+            torch.save(small.state_dict(), str(save_path / f'{file_name}.pth'))
+            print(f'Pruned {pth_file} to {save_path}\n')
+
+            report.append({'network': f'{small_name}/{fitting_name}/{run_number}/{file_name}', 'keep': keep,
+                           'parameters': sum(p.numel() for p in small.parameters()),
+                           'parameters_original': sum(p.numel() for p in net.parameters()),
+                           'time': time_small, 'speedup': time_original / time_small,
+                           'loss_original': loss_original, 'loss_pruned': loss_pruned, 'loss_fine_tuned': loss_tuned,
+                           'relative_error': errors})
+
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(args.output, 'prune_report.json'), 'w') as file:
+        json.dump(report, file, indent=2)
+    print_report(report)
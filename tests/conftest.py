@@ -0,0 +1,37 @@
+""" Shared setup of the tests: the repository root is importable, e.g. ``from model.networks import build_net`` """
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+B = torch.linspace(0, 2000, 21)[1:].reshape(1, 20, 1, 1)#b-values of one diffusion direction, as used by the networks
+
+
+def randomize_batchnorm(net):
+    """Random running statistics and affine parameters of all BatchNorm layers, so eval-mode BatchNorm is not the identity"""
+    for module in net.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.2, 0.2)
+    return net.eval()
+
+
+@pytest.fixture
+def make_inputs():
+    """
+    Synthetic inputs of the networks, (x, b, b0, sigma_true, scale_factor). The physics head modifies sigma_true in
+    place, pass sigma_true.clone() to compare several forward passes.
+    """
+    def make(n_batches=2, height=32, width=48, n_channels=20):
+        generator = torch.Generator().manual_seed(1)
+        x = torch.rand(n_batches, n_channels, height, width, generator=generator)
+        b0 = torch.rand(n_batches, 1, height, width, generator=generator)
+        sigma_true = torch.rand(n_batches, 1, height, width, generator=generator) * 0.05
+        scale_factor = torch.arange(2., n_batches + 2)
+        return x, B, b0, sigma_true, scale_factor
+    return make
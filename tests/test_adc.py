@@ -0,0 +1,19 @@
+""" ADC with one gather equals the ADC computed direction by direction """
+import pytest
+import torch
+
+from model.adc import ADC
+
+B = torch.linspace(0, 2000, 21)[1:].reshape(1, 20, 1, 1)
+
+
+@pytest.mark.parametrize('n_directions', [1, 3])
+def test_equals_per_direction_loop(n_directions):
+    torch.manual_seed(0)
+    images = torch.rand(4, 20 * n_directions, 50, 60) * 100
+    eps = torch.tensor(0.0001)
+    reference = torch.stack([-torch.log((images[:, [20 * d + 9]] + eps) / (images[:, [20 * d]] + eps)) / (1000 - 100)
+                             for d in range(n_directions)]).mean(0)#b-values 100 and 1000 are the channels 0 and 9
+    adc = ADC(B, n_directions=n_directions)
+    assert adc(images).shape == (4, 1, 50, 60)
+    assert torch.allclose(adc(images), reference, rtol=1e-5, atol=1e-7)
@@ -0,0 +1,90 @@
+""" A training resumed from a training state of train.py continues exactly as the uninterrupted training """
+import sys
+
+import pytest
+import torch
+import torch.distributed as dist
+import wandb
+from torch.utils.data import DistributedSampler, TensorDataset
+
+from model.checkpoint import ResumableSampler, list_states, load_state, state_name
+from model.networks import build_net
+
+ARGS = ['--input_sigma', 'True', '--estimate_S0', 'True', '--feed_sigma', 'True', '--fitting_model', 'biexp',
+        '--main_folder', 'test', '--checkpoint_every', '1', '--keep_states', '100', '--val_batch_size', '2', '--log_every', '2', '--warmup_steps', '4']
+
+
+def train_run(train, monkeypatch, dataset, run_number, resume=None):
+    """One training of two epochs with *train*.train_net in a single process, as started by train.py with one process"""
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + ARGS + (['--resume', str(resume)] if resume else []))
+    for name, value in {'MASTER_ADDR': 'localhost', 'MASTER_PORT': str(train.free_port()), 'RANK': '0', 'WORLD_SIZE': '1'}.items():
+        monkeypatch.setenv(name, value)
+    train.setup(0, 1)
+    torch.manual_seed(42)
+    net = build_net('unet_w0.25', 20, rice=True, input_sigma=True, fitting_model='biexp', estimate_S0=True, feed_sigma=True)
+    net = torch.nn.parallel.DistributedDataParallel(net)
+    b = torch.linspace(0, 2000, steps=21)[1:]
+    train.train_net(dataset=dataset, net=net, b=b, input_sigma=True, experiment=wandb.init(mode='disabled'), training_model='unet_w0.25',
+                    fitting_model='biexp', run_number=run_number, world_size=1, rank=0, device=torch.device('cpu'), epochs=2,
+                    batch_size=2, learning_rate=1e-3, val_percent=0.2)
+
+
+@pytest.mark.parametrize('step, epoch, samples_done, restarted', [(3, 1, 6, False), (6, 2, 4, False), (6, 2, 4, True)])
+def test_resume_train_net(monkeypatch, tmp_path, step, epoch, samples_done, restarted):
+    train = pytest.importorskip('train', reason='train.py can not be imported')
+    monkeypatch.setattr(train, 'dir_checkpoint', tmp_path)
+    generator = torch.Generator().manual_seed(0)
+    dataset = TensorDataset(torch.rand(10, 20, 80, 96, generator=generator), torch.rand(10, 1, 80, 96, generator=generator),
+                            torch.rand(10, 1, 80, 96, generator=generator) * 0.05, torch.full((10,), 100.))
+    run_folder = tmp_path / 'test' / 'unet_w0.25' / 'biexp'
+
+    train_run(train, monkeypatch, dataset, '1')#8 training slices, 4 steps per epoch
+    assert [path.name for path in list_states(run_folder / 'run_1')] == [state_name(step) for step in range(1, 9)]
+    interrupted = load_state(run_folder / 'run_1' / state_name(step))
+    assert (interrupted['epoch'], interrupted['samples_done'], interrupted['global_step']) == (epoch, samples_done, step)
+
+    if restarted:
+        #A process restarted by torchrun uses the training state of argument resume while its run has no newer one
+        monkeypatch.setenv('TORCHELASTIC_RESTART_COUNT', '1')
+    train_run(train, monkeypatch, dataset, '2', resume=run_folder / 'run_1' / state_name(step))#Continues in the middle of an epoch
+    uninterrupted, resumed = load_state(run_folder / 'run_1' / state_name(8)), load_state(run_folder / 'run_2' / state_name(8))
+    assert (resumed['epoch'], resumed['samples_done'], resumed['global_step']) == (3, 0, 8)
+    for key, value in uninterrupted['net'].items():
+        assert torch.equal(resumed['net'][key], value), key
+    assert resumed['scheduler'] == uninterrupted['scheduler'] and resumed['warmup'] == uninterrupted['warmup']
+    for state, reference in zip(resumed['optimizer']['state'].values(), uninterrupted['optimizer']['state'].values()):
+        assert torch.equal(state['exp_avg'], reference['exp_avg']) and torch.equal(state['exp_avg_sq'], reference['exp_avg_sq'])
+    assert not dist.is_initialized()
+
+
+@pytest.mark.parametrize('num_replicas', [1, 3])
+def test_sampler_skips_start_of_epoch(num_replicas):
+    dataset = list(range(17))
+    for rank in range(num_replicas):
+        reference = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=True)
+        reference.set_epoch(3)
+        sampler = ResumableSampler(dataset, num_replicas=num_replicas, rank=rank)
+        sampler.set_epoch(3)
+        assert list(sampler) == list(reference)
+        sampler.set_epoch(3, start=2 * num_replicas)#Two samples of every process
+        assert list(sampler) == list(reference)[2:]
+        assert len(sampler) == len(reference) - 2
+
+
+@pytest.mark.parametrize('num_replicas', [1, 2, 5])
+def test_sampler_splits_rest_for_other_replicas(num_replicas):
+    dataset = list(range(17))
+    trained = set()
+    for rank in range(3):#Three processes trained two samples each before the interruption
+        sampler = ResumableSampler(dataset, num_replicas=3, rank=rank)
+        sampler.set_epoch(3)
+        trained.update(list(sampler)[:2])
+    shards = []
+    for rank in range(num_replicas):
+        sampler = ResumableSampler(dataset, num_replicas=num_replicas, rank=rank)
+        sampler.set_epoch(3, start=2 * 3)
+        shards.append(list(sampler))
+        assert len(sampler) == len(shards[0])
+    rest = [index for shard in shards for index in shard]
+    assert set(dataset) - trained <= set(rest)
+    assert len(rest) < len(dataset) - len(trained) + num_replicas#Only padding repeats samples
@@ -0,0 +1,21 @@
+""" The vectorized ensemble gives the mean and variance of its members run one by one """
+import torch
+
+from conftest import randomize_batchnorm
+from model.ensemble import EnsembleNet
+from model.networks import build_net
+
+
+def test_vectorized_equals_members(make_inputs):
+    nets = []
+    for seed in range(3):
+        torch.manual_seed(seed)
+        nets.append(randomize_batchnorm(build_net('unet', 20, rice=True, input_sigma=True, fitting_model='biexp', estimate_S0=True, feed_sigma=True)))
+    x, b, b0, sigma, scale_factor = make_inputs()
+    with torch.no_grad():
+        M, param_dict = EnsembleNet(nets)(x, b, b0, sigma.clone(), scale_factor)
+        outputs = [net(x, b, b0, sigma.clone(), scale_factor) for net in nets]
+    parameters = torch.stack([output[1]['parameters'] for output in outputs])
+    assert torch.allclose(M, torch.stack([output[0] for output in outputs]).mean(0), rtol=1e-4, atol=1e-5)
+    assert torch.allclose(param_dict['parameters'], parameters.mean(0), rtol=1e-4, atol=1e-5)
+    assert torch.allclose(param_dict['parameters_variance'], parameters.var(0, unbiased=False), rtol=1e-3, atol=1e-6)
@@ -0,0 +1,22 @@
+""" Folding the BatchNorm layers into the convolutions does not change the output of a network in eval mode """
+import pytest
+import torch
+
+from conftest import randomize_batchnorm
+from model.fusion import fold_batchnorm, is_folded
+from model.networks import build_net
+
+
+@pytest.mark.parametrize('training_model', ['unet', 'attention_unet', 'res_atten_unet'])
+def test_fold_batchnorm(make_inputs, training_model):
+    torch.manual_seed(0)
+    net = randomize_batchnorm(build_net(training_model, 20, input_sigma=True, fitting_model='kurtosis', estimate_S0=True, feed_sigma=True))
+    x, b, b0, sigma, scale_factor = make_inputs()
+    with torch.no_grad():
+        M, param_dict = net(x, b, b0, sigma.clone(), scale_factor)
+        fold_batchnorm(net)
+        M_folded, param_dict_folded = net(x, b, b0, sigma.clone(), scale_factor)
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in net.modules())
+    assert is_folded(net.state_dict())
+    assert torch.allclose(M_folded, M, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(param_dict_folded['parameters'], param_dict['parameters'], rtol=1e-4, atol=1e-5)
@@ -0,0 +1,27 @@
+""" Learning rate scaling with the global batch size and its linear warmup """
+import math
+
+import pytest
+import torch
+
+from utils import LinearWarmup, scale_learning_rate
+
+
+@pytest.mark.parametrize('scaling, expected', [('none', 1e-3), ('linear', 4e-3), ('sqrt', 2e-3)])
+def test_scale_learning_rate(scaling, expected):
+    assert math.isclose(scale_learning_rate(1e-3, global_batch_size=64, base_batch_size=16, scaling=scaling), expected)
+
+
+def test_warmup_keeps_plateau_reductions():
+    optimizer = torch.optim.SGD([torch.zeros(1, requires_grad=True)], lr=1.0)
+    warmup = LinearWarmup(optimizer, warmup_steps=4)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5, patience=0)
+    learning_rates = [optimizer.param_groups[0]['lr']]
+    for step in range(5):
+        optimizer.step()
+        warmup.step()
+        if step == 1:
+            scheduler.step(1.0)
+            scheduler.step(2.0)#No improvement, the learning rate is halved during the warmup
+        learning_rates.append(optimizer.param_groups[0]['lr'])
+    assert learning_rates == pytest.approx([0.25, 0.5, 0.375, 0.5, 0.5, 0.5])
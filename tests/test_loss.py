@@ -0,0 +1,36 @@
+""" The fused MS-SSIM of CustomLoss gives the value of pytorch_msssim """
+import pytest
+import torch
+
+from model.loss import CustomLoss
+
+pytorch_msssim = pytest.importorskip('pytorch_msssim')
+
+
+@pytest.mark.parametrize('n_channels, height, width', [(1, 100, 120), (20, 99, 131)])
+@pytest.mark.parametrize('max_range', [True, False])
+def test_equals_pytorch_msssim(n_channels, height, width, max_range):
+    torch.manual_seed(0)
+    Y = torch.rand(2, n_channels, height, width) * 500
+    X = (Y + 30 * torch.randn_like(Y)).relu()
+    data_range = Y.max() if max_range else 255
+    reference = (1 - pytorch_msssim.MS_SSIM(channel=n_channels, win_size=5, data_range=data_range)(X, Y)) * torch.nn.L1Loss()(X, Y)
+    loss = CustomLoss()
+    loss.update_data_range(data_range)
+    assert torch.allclose(loss(X, Y, ssim_bool=True), reference, rtol=1e-4)
+
+
+def test_masked_gradient():
+    torch.manual_seed(0)
+    Y = torch.rand(2, 20, 100, 120) * 500
+    X = (Y + 30 * torch.randn_like(Y)).relu()
+    mask = torch.rand(2, 1, 100, 120) > 0.5
+    loss = CustomLoss()
+    loss.update_data_range(Y.max())
+    X_fused, X_reference = X.clone().requires_grad_(), X.clone().requires_grad_()
+    loss(X_fused, Y, ssim_bool=True, mask=mask).backward()
+    weight = mask.float()
+    msssim = pytorch_msssim.MS_SSIM(channel=20, win_size=5, data_range=Y.max())(X_reference * weight, Y * weight)
+    l1 = torch.abs(X_reference * weight - Y * weight).sum() / (weight.sum() * 20)
+    ((1 - msssim) * l1).backward()
+    assert torch.allclose(X_fused.grad, X_reference.grad, rtol=1e-3, atol=1e-4 * X_reference.grad.abs().max().item())
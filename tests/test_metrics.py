@@ -0,0 +1,30 @@
+""" Train metrics stay on the device and are checked when they are flushed """
+import torch
+
+from model.networks import build_net
+from utils import LogitsMonitor, MetricAccumulator
+
+
+def test_logits_monitor_warns_at_flush(make_inputs, capsys):
+    torch.manual_seed(0)
+    net = build_net('unet_w0.25', 20, input_sigma=True, fitting_model='biexp', estimate_S0=True, feed_sigma=True).train()
+    monitor = LogitsMonitor(net)
+    metrics = MetricAccumulator(limits=LogitsMonitor.LIMITS)
+    x, b, b0, sigma, scale_factor = make_inputs()
+
+    net(x, b, b0, sigma.clone(), scale_factor)
+    metrics.update({'train loss': torch.tensor(1.)}, maxima=monitor.collect())
+    logged = metrics.flush()
+    assert logged['NaN logits'] == 0 and logged['max logit'] < 1e10
+    assert 'Warning' not in capsys.readouterr().out
+
+    with torch.no_grad():
+        net.outc.conv.weight[0] = float('nan')
+    net(x, b, b0, sigma.clone(), scale_factor)
+    metrics.update({'train loss': torch.tensor(1.)}, maxima=monitor.collect())
+    assert metrics.flush()['NaN logits'] == x.shape[0] * x.shape[-2] * x.shape[-1]
+    assert 'NaN logits' in capsys.readouterr().out
+
+    net.eval()#Validation and inference are not monitored
+    net(x, b, b0, sigma.clone(), scale_factor)
+    assert monitor.collect() == {}
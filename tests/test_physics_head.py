@@ -0,0 +1,26 @@
+""" The physics head evaluated on the foreground voxels only (mask) gives the same signal as on all voxels """
+import pytest
+import torch
+
+from conftest import randomize_batchnorm
+from model.attention_unet import Atten_Unet
+from model.res_attention_unet import Res_Atten_Unet
+from model.unet_model import UNet
+from model.utils import foreground_mask
+
+
+@pytest.mark.parametrize('network', [UNet, Atten_Unet, Res_Atten_Unet])
+@pytest.mark.parametrize('fitting_model', ['biexp', 'kurtosis', 'gamma'])
+@pytest.mark.parametrize('input_sigma', [True, False])
+def test_masked_equals_unmasked(make_inputs, network, fitting_model, input_sigma):
+    torch.manual_seed(0)
+    net = randomize_batchnorm(network(n_channels=20, input_sigma=input_sigma, fitting_model=fitting_model, estimate_S0=input_sigma, feed_sigma=input_sigma))
+    x, b, b0, sigma, scale_factor = make_inputs()
+    b0[:, :, :5] = 0#Background rows
+    mask = foreground_mask(b0)
+    with torch.no_grad():
+        M, _ = net(x, b, b0, sigma.clone(), scale_factor)
+        M_masked, _ = net(x, b, b0, sigma.clone(), scale_factor, mask)
+    foreground = mask.expand_as(M)
+    assert torch.allclose(M_masked[foreground], M[foreground], atol=1e-6)
+    assert (M_masked[~foreground] == 0).all()
@@ -0,0 +1,37 @@
+""" predict.py runs end to end on a patient and saves the parameter maps of each checkpoint """
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from model.networks import build_net
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+def test_predict_saves_maps(tmp_path):
+    rng = np.random.default_rng(0)
+    data_dir, load, results = tmp_path / 'data', tmp_path / 'checkpoints', tmp_path / 'results'
+    data_dir.mkdir()
+    #22 slices of 120 x 80 voxels, cropped to 80 x 80 by patientDataset, with the OBSIDIAN noise map at index -2 of the results
+    fits = rng.uniform(0.5, 1., size=(22, 120, 80, 6)).astype('float32')
+    patient = {'image': {'3Dsig': rng.uniform(1., 2., size=(22, 60, 120, 80)).astype('float32')}, 'image_b0': rng.uniform(1., 2., size=(22, 120, 80)).astype('float32'),
+               'result_biexp': fits, 'result_kurtosis': fits, 'result_gamma': fits}
+    np.save(data_dir / 'pat1_a.npy', patient)
+    (tmp_path / 'predictList.txt').write_text('pat1_a.npy')
+
+    run_folder = load / 'unet_w0.25' / 'biexp' / 'run_1'
+    run_folder.mkdir(parents=True)
+    net = build_net('unet_w0.25', 20, rice=False, input_sigma=True, fitting_model='biexp', estimate_S0=True, feed_sigma=True)
+    torch.save(net.state_dict(), run_folder / 'checkpoint_epoch1.pth')
+
+    subprocess.run([sys.executable, 'predict.py', '--load', str(load), '--custom_patient_list', str(tmp_path / 'predictList.txt'),
+                    '--test_data_directory', str(data_dir), '--result_path', str(results), '--input_sigma', '--estimate_S0', '--feed_sigma',
+                    '--adc'], cwd=REPO, check=True)
+
+    saved = results / 'unet_w0.25' / 'biexp' / 'pat1' / 'run_1'
+    assert {'M.npy', 'loss.npy', 'parameters.npy', 'sigma.npy', 'names.npy', 'ADC.npy', 'ADC_images.npy'} <= {path.name for path in saved.iterdir()}
+    M = np.load(saved / 'M.npy')
+    assert M.shape == (66, 20, 80, 80) and np.isfinite(M).all()
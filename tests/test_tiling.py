@@ -0,0 +1,46 @@
+""" Tiled and slice-batched inference merges the outputs of the pieces into the output of the whole slices """
+import pytest
+import torch
+import torch.nn as nn
+
+from conftest import randomize_batchnorm
+from model.networks import build_net
+from model.tiling import TiledNet
+
+
+class VoxelNet(nn.Module):
+    """Network without spatial context with the outputs (M, param_dict) of the networks, so any tiling gives the same output"""
+
+    def __init__(self):
+        super(VoxelNet, self).__init__()
+        self.conv = nn.Conv2d(20, 2, kernel_size=1)
+
+    def forward(self, x, b, b0, sigma_true, scale_factor, mask=None):
+        params = torch.sigmoid(self.conv(x)) * scale_factor.view(-1, 1, 1, 1)
+        M = b0 * torch.exp(-b * params[:, :1])
+        return M, {'parameters': params.transpose(0, 1), 'names': ['D', 'K']}
+
+
+@pytest.mark.parametrize('options', [dict(tile_size=32, overlap=8), dict(tile_size=48, overlap=16, blending='constant'),
+                                     dict(tile_size=32, overlap=16, slice_batch=2)])
+def test_merge_is_exact(make_inputs, options):
+    torch.manual_seed(0)
+    net = VoxelNet()
+    x, b, b0, sigma, scale_factor = make_inputs(n_batches=3, height=80, width=96)
+    with torch.no_grad():
+        M, param_dict = net(x, b, b0, sigma, scale_factor)
+        M_tiled, param_dict_tiled = TiledNet(net, **options)(x, b, b0, sigma, scale_factor)
+    assert torch.allclose(M_tiled, M, atol=1e-6)
+    assert torch.allclose(param_dict_tiled['parameters'], param_dict['parameters'], atol=1e-6)
+    assert param_dict_tiled['names'] == param_dict['names']
+
+
+def test_slice_batch_is_exact(make_inputs):
+    torch.manual_seed(0)
+    net = randomize_batchnorm(build_net('res_atten_unet', 20, input_sigma=True, fitting_model='kurtosis', estimate_S0=True, feed_sigma=True))
+    x, b, b0, sigma, scale_factor = make_inputs(n_batches=3)
+    with torch.no_grad():
+        M, param_dict = net(x, b, b0, sigma.clone(), scale_factor)
+        M_batched, param_dict_batched = TiledNet(net, slice_batch=2)(x, b, b0, sigma.clone(), scale_factor)
+    assert torch.allclose(M_batched, M, rtol=1e-5, atol=1e-6)
+    assert torch.allclose(param_dict_batched['parameters'], param_dict['parameters'], rtol=1e-5, atol=1e-6)
@@ -0,0 +1,12 @@
+""" The validation shards of the processes cover every slice exactly once """
+import pytest
+
+from utils import ShardSampler
+
+
+@pytest.mark.parametrize('num_replicas', [1, 2, 3, 5])
+def test_shards_cover_dataset(num_replicas):
+    dataset = list(range(13))
+    shards = [list(ShardSampler(dataset, num_replicas=num_replicas, rank=rank)) for rank in range(num_replicas)]
+    assert sorted(index for shard in shards for index in shard) == dataset
+    assert [len(ShardSampler(dataset, num_replicas=num_replicas, rank=rank)) for rank in range(num_replicas)] == [len(shard) for shard in shards]
@@ -1,14 +1,15 @@
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 from torch import nn, optim
-from torch.utils.data import DataLoader, random_split
-from model.res_attention_unet import Res_Atten_Unet
-from utils import post_processing, patientDataset, init_weights
+from torch.utils.data import DataLoader, Subset, random_split
+from model.networks import build_net, parse_fitting_models
+from model.distillation import load_teacher, LogitsRecorder, distillation_loss
+from utils import CustomLoss, MetricAccumulator, LogitsMonitor, ShardSampler, LinearWarmup, scale_learning_rate, LR_SCALINGS, gradient_norms, post_processing, patientDataset, init_weights, to_channels_last, explain_graph_breaks, amp_autocast
+from model.utils import foreground_mask
+from model.adc import ADC
+from model.checkpoint import AsyncCheckpointer, ResumableSampler, latest_state, load_state, rng_state, set_rng_state, state_name, state_step
 from model.unet_MultiDecoder import UNet_MultiDecoders
-from model.UNETR import UNETR
 from IPython import embed
-from model.attention_unet import Atten_Unet
-from model.unet_model import UNet
 from model.unet_2Decoder import UNet_2Decoders
 from pathlib import Path
 import logging
@@ -16,90 +17,85 @@ import wandb
 import argparse
 import torch
 import numpy as np
-from pytorch_msssim import MS_SSIM
 import torch.distributed as dist
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DistributedSampler
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import torch.multiprocessing as mp
 import os
+import socket
 import torchvision.models as models
+from contextlib import nullcontext
 
 #Directory for net models to be saved at as .pth files
 dir_checkpoint = Path('/TANK/mustafa/checkpoints')
 
 
-def setup(rank, world_size):
+def training_device(rank):
     """
-    This function assigns a **master machine** and **port** used for multiprocessing used by *torch.nn.parallel.DistributedDataParallel*.
-    The GPUs will communicate thorough the assigned port.\n
-    Standard port is 12355.
+    Device of the training process *rank*: its own GPU if GPUs are available, else the CPU.
 
-    :param rank: Unique GPU-ID passed as an integer. Ranges from 0 to N-1 if machine has N GPUs
-    :type rank: int or string
+    :param rank: Unique process-ID passed as an integer. Ranges from 0 to N-1 if N processes are used
+    :return: torch.device
+    """
+    return torch.device(f'cuda:{rank}') if torch.cuda.is_available() else torch.device('cpu')
 
 
-    :param world_size: Total number of processes (or GPUs) used for parallel training, e.g if 2 machines are used, with 4 GPUs each, then world_size = 8
-    :type world_size: int or string
+def pin_threads(rank, world_size, threads=None):
     """
-    os.environ['MASTER_ADDR'] = 'localhost'# If a remote computer is used as master machine, assign the machine's IP, e.g '127.0.0.1'
-    os.environ['MASTER_PORT'] = '12355'# Any available port
-    os.environ['WORLD_SIZE'] = str(world_size)
-    os.environ['RANK'] = str(rank)
-    #nccl is a type of communication backend for GPUs
-    dist.init_process_group("nccl", rank=rank, world_size=world_size)#nccl
-    torch.cuda.set_device(rank)
-
+    Restrict the CPU training process *rank* to its own block of cores and use one intra-op thread per core.
+    Without it, every process starts as many threads as there are cores and the processes compete for them.
 
+    :param rank: Unique process-ID on this machine. Ranges from 0 to N-1 if N processes are used
+    :param world_size: Number of training processes on this machine.
+    :param threads: Threads per process. *default*: The available cores divided by *world_size*.
+    :return: The number of threads of this process
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    threads = threads or max(1, len(cores) // world_size)
+    first = rank * threads % len(cores)#More threads than cores: the blocks wrap around
+    block = (cores + cores)[first:first + min(threads, len(cores))]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, block)
+    torch.set_num_threads(threads)
+    return threads
 
 
+def free_port():
+    """A free TCP port of this machine, so several trainings started on one machine do not use the same port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
 
-class CustomLoss(nn.Module):
 
+def setup(rank, world_size, local_rank=None):
     """
-    Custom loss function: :math:`L` = (1-SSIM) :math:`\cdot` L1
-
-    Example:
-
-        >>>loss = CustomLoss()
+    This function assigns a **master machine** and **port** used for multiprocessing used by *torch.nn.parallel.DistributedDataParallel*.
+    The GPUs will communicate thorough the assigned port.\n
+    If launched by torchrun, master machine and port are read from the environment (MASTER_ADDR, MASTER_PORT), which allows
+    training on several machines. Otherwise this machine and the port chosen before spawning the processes are used, standard port is 12355.
+    With GPUs the processes communicate with the nccl backend, without GPUs each process trains on the CPU and they communicate with gloo.
 
-        >>>loss_value = loss(predicted,target)
-    """
+    :param rank: Unique GPU-ID passed as an integer. Ranges from 0 to N-1 if N GPUs are used, over all machines
+    :type rank: int or string
 
 
-    def __init__(self):
-        super(CustomLoss, self).__init__()
-        # For one dimensional channel, for example when inputting ADC map in loss function.
-        self.ssim_loss = MS_SSIM(channel=1, win_size=5)
+    :param world_size: Total number of processes (or GPUs) used for parallel training, e.g if 2 machines are used, with 4 GPUs each, then world_size = 8
+    :type world_size: int or string
 
-        self.ssim_loss2 = MS_SSIM(channel=20, win_size=5)#Default number of channels
-        self.ssim_loss3 = MS_SSIM(channel=60, win_size=5)#If we use 3D in training
-        self.l1_loss =  nn.L1Loss()#nn.MSELoss()
-    def update_data_range(self, range):
-        self.ssim_loss.data_range = range
-    def forward(self, M,images, ssim_bool = False, only_ssim = False):
-        """
-            :param M: The predicted data/image
-            :param images: The target data/image
-            :param ssim_bool: If True, ssim is part of the loss function. Else only L1 is calculated
-            :param only_ssim: If True, the loss function will only be = 1-ssim. L1 would not be included.
-            """
-        if M.shape[1]>1 and M.shape[1]<21 and ssim_bool:
-            loss_ssim = 1 - self.ssim_loss2(M, images)
-        elif M.shape[1]>21 and ssim_bool:
-            loss_ssim = 1 - self.ssim_loss3(M, images)
-        elif ssim_bool:
-            loss_ssim = 1 - self.ssim_loss(M, images)
-        else:
-            loss_ssim = 1
+    :param local_rank: GPU-ID on this machine. *default*: *rank*, training on one machine
+    """
+    os.environ.setdefault('MASTER_ADDR', 'localhost')# If a remote computer is used as master machine, assign the machine's IP, e.g '127.0.0.1'
+    os.environ.setdefault('MASTER_PORT', '12355')# Any available port
+    os.environ['WORLD_SIZE'] = str(world_size)
+    os.environ['RANK'] = str(rank)
+    #nccl is a type of communication backend for GPUs, gloo for CPUs
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    if backend == "nccl":
+        torch.cuda.set_device(rank if local_rank is None else local_rank)
 
-        if not only_ssim:
-            l1_loss = self.l1_loss(M,images)
-        else:
-            l1_loss = 1
-        return loss_ssim * l1_loss
 
 def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str, fitting_model: str,run_number: str, world_size=None,rank = None,device = None,  epochs: int=30, batch_size: int=1, learning_rate: float = 1e-3,
-    val_percent: float=0.1, save_checkpoint: bool=True, sweeping = False):
+    val_percent: float=0.1, save_checkpoint: bool=True, sweeping = False, teacher = None):
 
     """
     Main function used for training *net*. This function is multi functional and can run on single GPU and on multiple GPUs if available.
@@ -120,7 +116,7 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
 
     :param training_model: Name of network model, possible values 'unet'/'attention_unet'/'res_atten_unet' for UNet/Attention UNet/Residual Attention UNet.
 
-    :param fitting_model: Name of fitting model, possible values 'biexp'/'kurtosis'/'gamma'.
+    :param fitting_model: Name of fitting model, possible values 'biexp'/'kurtosis'/'gamma', or several joined by '_' for shared_attention_unet, e.g. 'biexp_kurtosis_gamma'.
 
     :param run_number: A string of single number used for tracking run-ID used for cross validation purposes.
 
@@ -128,7 +124,7 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
 
     :param rank: Unique GPU-ID passed as an integer. Ranges from 0 to N-1 if machine has N GPUs.
 
-    :param device: Type of computation device ('cpu' or 'cuda:0'). **Only** input device when running one GPU.
+    :param device: Type of computation device ('cpu' or 'cuda:0'), see *training_device*. *default*: The device of *net*.
     :type device: torch.device
 
     :param epochs: Number of epochs to train, *default*: 30.
@@ -143,47 +139,87 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
 
     :param sweeping: True if hyperparameter tuning is being performed. The script/function train_net() will run separately on all GPUs
 
+    :param teacher: Optional frozen network, see *load_teacher*. Its parameter maps and/or logits supervise *net* through a distillation loss added to the loss.
+
     :return: None
     """
 
     args = get_args()#Getting arguments passed from CLI through ArgumentParser.
 
     assert not(args.feed_sigma and not args.input_sigma), 'Error: Argument input_sigma needs to be true if argument feed_sigma is passed'
+    assert not(args.masked_loss and not args.mask_background), 'Error: Argument mask_background needs to be true if argument masked_loss is passed'
+    assert args.accumulate_steps >= 1, 'Error: Argument accumulate_steps has to be at least 1'
 
     ADC_loss = args.adc_as_loss#store boolean 'adc_as_loss'
+    if device is None:
+        device = next(net.parameters()).device
 
     b = b.reshape(1, len(b), 1, 1)#Reshaped to match dimension of data (num_slices, num_diffusion_levels, width, height)
+    adc_map = ADC(b, n_directions=3 if args.use_3D else 1)#For the ADC loss
+
+    #Model checkpoints (.pth) and full training states (.ckpt) of this run
+    save_path = Path(os.path.join(dir_checkpoint, args.main_folder, training_model, fitting_model, f'run_{run_number}'))
+
+    resume_state = None
+    resume = args.resume#Path to a training state, or True for the newest training state of this run
+    newest_state = latest_state(save_path)
+    if int(os.getenv('TORCHELASTIC_RESTART_COUNT', '0')) > 0 and newest_state is not None and \
+            (resume in (None, 'True') or state_step(newest_state) > (state_step(resume) or 0)):
+        #torchrun restarted all processes after a failure, they continue from the newest training state of this run.
+        #A training state passed as argument resume is only used again if this run failed before saving a newer one
+        if (rank == 0 or sweeping) and resume not in (None, 'True'): logging.info(f'Restarted by torchrun: {newest_state} is newer than {resume}')
+        resume = str(newest_state)
+    if resume:
+        resume_path = newest_state if resume == 'True' else Path(resume)
+        assert resume_path is not None and resume_path.exists(), f'Error: No training state to resume from in {save_path if resume == "True" else resume}'
+        resume_state = load_state(resume_path)
+        if rank == 0 or sweeping: logging.info(f'Resuming from {resume_path}: epoch {resume_state["epoch"]}, {resume_state["samples_done"]} samples done')
 
     # split into training and validation set
     n_val = int(len(dataset) * val_percent)
     n_train = len(dataset) - n_val
-    train_set, val_set = random_split(dataset, [n_train, n_val])
+    if resume_state is not None:
+        #Same split as before the interruption
+        train_set, val_set = Subset(dataset, resume_state['train_indices']), Subset(dataset, resume_state['val_indices'])
+    else:
+        train_set, val_set = random_split(dataset, [n_train, n_val])
 
+    #The order of each epoch only depends on the epoch, see ResumableSampler, so a resumed epoch continues with the same batches
     if sweeping:
         #During a sweep (hyperparameter tuning) each wandb.agent is assigned one GPU (different processes/network are trained in parallel on different GPUs).
         #Each GPU will need the whole dataset, as they don't share networks.
         #Thus, no sampling/distribution of data will be done between GPUs as done in parallel training for one network.
-        sampler = None
+        sampler = ResumableSampler(train_set, num_replicas=1, rank=0)
         print(f'Sweeping and using device {device}')
     else:
         #Since we are training one network, it can be trained in parallel with multiple GPUs.
         #Data can be partitioned and distributed to each GPU
-        sampler = DistributedSampler(train_set, num_replicas=world_size, rank=rank)#num_replicas: Number of partitions
+        sampler = ResumableSampler(train_set, num_replicas=world_size, rank=rank)#num_replicas: Number of partitions
         print(f'Not sweeping and using rank {rank}')
 
 
     #For large data, num_workers must be low, as each worker will have a copy of the whole data to RAM.
-    train_loader_args = dict(batch_size=batch_size, num_workers=0, pin_memory=True)
-    val_loader_args = dict(batch_size=1, num_workers=0, pin_memory=True)
+    #Pinned memory only speeds up transfers to a GPU
+    train_loader_args = dict(batch_size=batch_size, num_workers=0, pin_memory=device.type == 'cuda')
+    val_loader_args = dict(batch_size=args.val_batch_size, num_workers=0, pin_memory=device.type == 'cuda')
+
+    #Own generator: starting the loader does not draw from the global RNG, which is restored when resuming mid-epoch
+    train_loader = DataLoader(train_set, shuffle=False, sampler = sampler, generator=torch.Generator(), **train_loader_args)
+    #Each GPU validates its own shard, the losses are summed in post_processing.evaluate
+    val_sampler = ShardSampler(val_set) if sweeping else ShardSampler(val_set, num_replicas=world_size, rank=rank)
+    val_loader = DataLoader(val_set, shuffle=False, sampler=val_sampler, **val_loader_args)
 
-    train_loader = DataLoader(train_set, shuffle=False if not sweeping else True,sampler = sampler, **train_loader_args)
-    val_loader = DataLoader(val_set, shuffle=False, drop_last=True, **val_loader_args)
 
+    #The learning rate is given for args.base_batch_size samples per optimizer step, see scale_learning_rate
+    global_batch_size = batch_size * args.accumulate_steps * (1 if sweeping else world_size)
+    learning_rate = scale_learning_rate(learning_rate, global_batch_size, args.base_batch_size, args.lr_scaling)
 
     logging.info(f'''Starting training:
             Epochs:          {epochs}
             Batch size:      {batch_size}
-            Learning rate:   {learning_rate}
+            Accumulation:    {args.accumulate_steps} micro-batches per optimizer step
+            Global batch:    {global_batch_size} samples per optimizer step
+            Learning rate:   {learning_rate} ({args.lr_scaling} scaling, {args.warmup_steps} warmup steps)
             Training size:   {n_train}
             Validation size: {n_val}
             Checkpoints:     {save_checkpoint}
@@ -191,13 +227,30 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
     ''')    #Ranks only relevant in parallel training. In sweep-mode, each GPU has a separate training instance
 
 
-    optimizer = optim.Adam(net.parameters(), lr=learning_rate)
+    zero_optimizer = bool(args.zero_optimizer) and not sweeping
+    if zero_optimizer:
+        #Each GPU keeps the Adam state (two copies of the weights) of 1/world_size of the parameters and updates them,
+        #the updated parameters are broadcast. Clipping sees the full gradients, which are all-reduced by DDP as before,
+        #and ReduceLROnPlateau changes the learning rate of param_groups, which is passed on to the shards in step
+        optimizer = ZeroRedundancyOptimizer(net.parameters(), optimizer_class=optim.Adam, lr=learning_rate)
+        if rank == 0:
+            state_size = 2 * sum(p.numel() * p.element_size() for p in net.parameters()) / 2**20
+            logging.info(f'Adam state sharded: {state_size / world_size:.1f} MiB per GPU instead of {state_size:.1f} MiB')
+    else:
+        optimizer = optim.Adam(net.parameters(), lr=learning_rate)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=2)
     #If validation loss does not increase in two consecutive epochs, lr decreases
+    warmup = LinearWarmup(optimizer, args.warmup_steps)#Ramps up lr in the first optimizer steps, keeps the decreases of the scheduler
 
 
     criterion = CustomLoss()
+    #Loss scaling against float16 gradient underflow. Not needed for bfloat16, where the scaler is a no-op
+    scaler = torch.amp.GradScaler(next(net.parameters()).device.type, enabled=args.amp == 'fp16')
     global_step = 0
+    metrics = MetricAccumulator(limits=LogitsMonitor.LIMITS)#Train metrics stay on the device and are logged every args.log_every steps
+    #NaN values and maximum of the logits, warned about when the metrics are logged
+    logits_monitor = LogitsMonitor(net) if rank == 0 or sweeping else None
+    group_metrics = {}#Train metrics of the micro-batches since the last optimizer step
     if rank ==0 or sweeping:
         #Used for logging weights and gradients
         #One network on multiple GPUs: To avoid double logging same network, one GPU with ID (rank=0) logs all.
@@ -208,31 +261,166 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
         rank = device#GPU-ID: torch.device used during tensor.to().
         world_size=1#Training session is run by one GPU
 
+    if teacher is not None:
+        #Logits of the latest forward pass of student and teacher, for the distillation loss
+        student_logits = LogitsRecorder(net if sweeping else net.module)
+        teacher_logits = LogitsRecorder(teacher)
+
+    def image_loss(M, images, scale_factor, loss_mask):
+        """
+        Loss between the expected signal *M* of the network and *images*.
+
+        :return: tuple (loss, ADC_loss_val). ADC_loss_val is the ADC part of the loss, None if ADC is not used as loss.
+        """
+        #Rescale output and input images, as they were normalized in dataset.
+        M = M*scale_factor.view(-1,1,1,1)
+        images = images*scale_factor.view(-1,1,1,1)
+
+        if ADC_loss:
+            #ADC between b100 and b1000, averaged over the diffusion directions
+            ADC_avg_images = adc_map(images)
+            ADC_avg_M = adc_map(M)
+        ADC_loss_val = None
+
+
+        if ADC_loss:
+            criterion.update_data_range(torch.max(ADC_avg_images))
+            ADC_loss_val = 9*1000*criterion(ADC_avg_M, ADC_avg_images, ssim_bool=False, mask=loss_mask)
+            # The 9 is arbitrary, depending on how much importance is given to the ADC loss relative to criterion(M,images)
+            # The 1000 is for correct unit
+
+            criterion.update_data_range(torch.max(images))
+            loss = ADC_loss_val + criterion(M, images,  ssim_bool=True, mask=loss_mask)
+            ADC_loss_val = ADC_loss_val.detach()#Store for logging
+
+        else:
+            criterion.update_data_range(torch.max(images))
+            loss = criterion(M,images, ssim_bool = True, mask=loss_mask)
+        return loss, ADC_loss_val
+
+    def loss_step(images, image_b0, sigma, scale_factor, b, mask, loss_mask):
+        """
+        Forward pass and loss of one training batch. Wrapped by torch.compile if argument compile is passed.
+
+        :return: tuple (loss, ADC_loss_val, distill_loss_val). ADC_loss_val is the ADC part of the loss, None if ADC is not used as loss.
+            distill_loss_val is the distillation part of the loss, None without teacher.
+        """
+        #M has same shape as images (num_batches,num_diffusion_levels, width, height)
+        with amp_autocast(args.amp, images.device.type):#Only the trunk runs in reduced precision, the physics head returns float32
+            outputs = net(images,b,image_b0, sigma,scale_factor, mask)#returnes tuple (M:output_image, dictionary_of_predicted_parameter_values)
+        # M: (n_batches, 20 or 60 if use_3D, 200, 240)
+        # param_dict: dict_keys(['parameters', 'sigma', 'names']),  'names' for parameter names
+
+        if isinstance(outputs, dict):
+            #Shared encoder (shared_attention_unet): one tuple (M, param_dict) per fitting model, the loss is their mean
+            losses = [image_loss(M, images, scale_factor, loss_mask) for M, _ in outputs.values()]
+            loss = sum(fit_loss for fit_loss, _ in losses) / len(losses)
+            ADC_loss_val = sum(fit_ADC for _, fit_ADC in losses) / len(losses) if ADC_loss else None
+        else:
+            M, param_dict = outputs
+            loss, ADC_loss_val = image_loss(M, images, scale_factor, loss_mask)
+
+        distill_loss_val = None
+        if teacher is not None:
+            with torch.no_grad(), amp_autocast(args.amp, images.device.type):
+                _, teacher_dict = teacher(images, b, image_b0, sigma.clone(), scale_factor, mask)#The physics head modifies sigma in place, which is used by the backward pass of net
+            distill_loss_val = args.distill_weight * distillation_loss(param_dict['parameters'], teacher_dict['parameters'],
+                                                                       student_logits.logits, teacher_logits.logits, target=args.distill_target, mask=loss_mask)
+            loss = loss + distill_loss_val
+            distill_loss_val = distill_loss_val.detach()#Store for logging
+        return loss, ADC_loss_val, distill_loss_val
+
+    #The network itself is not replaced by the compiled version, so the saved state_dict keys are unchanged
+    run_loss_step = torch.compile(loss_step) if args.compile else loss_step
+
     post_process= post_processing()#Module used for validation of network during training
     overfitting_patience = 5  # Stop if no improvement after 5 epochs
     overfitting_counter = 0
 
-    for epoch in range(1, epochs+1):
+    #Full training states are opt-in (argument checkpoint_every) and written by one GPU in the background, see AsyncCheckpointer
+    save_states = save_checkpoint and args.checkpoint_every is not None
+    checkpointer = AsyncCheckpointer(save_path, keep=args.keep_states) if save_states and (rank == 0 or sweeping) else None
+
+    def save_state(epoch, samples_done, avg_loss):
+        """
+        Save the full training state after *samples_done* samples of *epoch*, counted over all GPUs. Called by all GPUs,
+        the RNG states and loss sums of all GPUs are gathered, so each GPU continues exactly where it stopped.
+        """
+        process_state = {'rng': rng_state(), 'avg_loss': float(avg_loss)}
+        if sweeping:
+            process_states = [process_state]
+        else:
+            process_states = [None] * world_size
+            dist.all_gather_object(process_states, process_state)
+        if zero_optimizer:
+            optimizer.consolidate_state_dict(to=0)#Collects the shards of the Adam state on the GPU that writes the state
+        if checkpointer is not None:
+            checkpointer.save({'net': net.state_dict(),
+                               'optimizer': optimizer.state_dict(),
+                               'scheduler': scheduler.state_dict(),
+                               'scaler': scaler.state_dict(),
+                               'warmup': warmup.state_dict(),
+                               'epoch': epoch,
+                               'samples_done': samples_done,
+                               'global_step': global_step,
+                               'overfitting_counter': overfitting_counter,
+                               'world_size': 1 if sweeping else world_size,
+                               'train_indices': list(train_set.indices),
+                               'val_indices': list(val_set.indices),
+                               'processes': process_states}, state_name(global_step))
+
+    start_epoch, start_batch, start_sample, resume_loss = 1, 0, 0, 0
+    if resume_state is not None:
+        net.load_state_dict(resume_state['net'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        scaler.load_state_dict(resume_state['scaler'])
+        warmup.load_state_dict(resume_state.get('warmup', {'steps': resume_state['global_step']}))
+        start_epoch, start_sample = resume_state['epoch'], resume_state['samples_done']
+        global_step = resume_state['global_step']
+        overfitting_counter = resume_state['overfitting_counter']
+        if resume_state['world_size'] == world_size and start_sample % (batch_size * world_size) == 0:
+            start_batch = start_sample // (batch_size * world_size)
+            process_state = resume_state['processes'][0 if sweeping else rank]
+            resume_loss = process_state['avg_loss']
+            set_rng_state(process_state['rng'])#Last, nothing draws random numbers before the training loop
+        else:
+            #Another number of processes, e.g. torchrun restarted without a failed machine. The remaining samples of the epoch
+            #are split between the processes, see ResumableSampler, and their batches are counted from 0. The RNG states
+            #of the old processes can not be assigned to the new ones, so the training continues, but not bit-exactly
+            if rank == 0 or sweeping: logging.warning(f'Training state was saved with {resume_state["world_size"]} processes, the remaining samples of epoch {start_epoch} are split between {world_size} processes')
+        del resume_state
+
+    for epoch in range(start_epoch, epochs+1):
         net.train()
-        avg_loss = 0
-        num_batches = len(train_loader)
+        sampler.set_epoch(epoch, start=start_sample)#Samples trained before resuming are skipped
+        avg_loss = resume_loss if start_batch > 0 else 0
+        num_batches = start_batch + len(train_loader)
 
-        with tqdm(total=n_train//world_size+1, desc=f'Epoch {epoch}/{epochs}', unit='img') as pbar:
+        with tqdm(total=n_train//world_size+1, initial=start_batch * batch_size, desc=f'Epoch {epoch}/{epochs}', unit='img') as pbar:
 
-            for i, (images,image_b0,sigma,scale_factor) in enumerate(train_loader):
+            for i, (images,image_b0,sigma,scale_factor) in enumerate(train_loader, start=start_batch):
                 #scale_factor: Scaling used on sample images in dataset before forward pass
 
-                # non_blocking=True for asynchronous data transfer (happens in background and simultaneously with other tasks (e.g. computation))
-                images = images.to(rank, dtype=torch.float32, non_blocking=True)# (n_batches, 20 or 60 if use_3D , 200, 240)
-                sigma = sigma.to(rank, dtype=torch.float32, non_blocking=True)# (n_batches, 1, 200, 240)
-                image_b0 = image_b0.to(rank, dtype=torch.float32, non_blocking=True)# (n_batches, 1, 200, 240)
-                scale_factor = scale_factor.to(rank, dtype=torch.float32, non_blocking=True)#(n_batches,)
-                b = b.to(rank, dtype=torch.float32, non_blocking=True)#(1, 20, 1 , 1)
-
+                #Checked on the host before the transfer, so the step does not wait for the device
                 if torch.isnan(images).sum() > 0 or torch.max(images) > 1e10:
+                    #With accumulate_steps > 1, the gradients of a group whose last batch is skipped are added to the next group
                     print(f'-Warning: One batch {i} contained {torch.isnan(images).sum().item()} NaN values and {torch.max(images)} as maximum value.\n This batch was skipped.\n')
                     continue
 
+                #The optimizer steps after every accumulate_steps micro-batches and after the last batch of the epoch
+                group_size = min(args.accumulate_steps, num_batches - i // args.accumulate_steps * args.accumulate_steps)
+                step_now = (i + 1) % args.accumulate_steps == 0 or i + 1 == num_batches
+
+                # non_blocking=True for asynchronous data transfer (happens in background and simultaneously with other tasks (e.g. computation))
+                images = images.to(device, dtype=torch.float32, non_blocking=True)# (n_batches, 20 or 60 if use_3D , 200, 240)
+                sigma = sigma.to(device, dtype=torch.float32, non_blocking=True)# (n_batches, 1, 200, 240)
+                image_b0 = image_b0.to(device, dtype=torch.float32, non_blocking=True)# (n_batches, 1, 200, 240)
+                scale_factor = scale_factor.to(device, dtype=torch.float32, non_blocking=True)#(n_batches,)
+                b = b.to(device, dtype=torch.float32, non_blocking=True)#(1, 20, 1 , 1)
+                if args.channels_last:
+                    images, sigma, image_b0 = to_channels_last(images, sigma, image_b0)
+
 
                 if sweeping:
                     #If number of b-values does not match with number of input channel to net
@@ -247,82 +435,72 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
                         f'but loaded images have {images.shape[1]} channels. Please check that ' \
                         'the images are loaded correctly.'
 
-                #M has same shape as images (num_batches,num_diffusion_levels, width, height)
-                M, _ = net(images,b,image_b0, sigma,scale_factor)#returnes tuple (M:output_image, dictionary_of_predicted_parameter_values)
-                # M: (n_batches, 20 or 60 if use_3D, 200, 240)
-                # param_dict: dict_keys(['parameters', 'sigma', 'names']),  'names' for parameter names
-
-                #Rescale output and input images, as they were normalized in dataset.
-                M = M*scale_factor.view(-1,1,1,1)
-                images = images*scale_factor.view(-1,1,1,1)
-
-                if ADC_loss:
-                    if args.use_3D: slicing = [[slice(0,1),slice(9,10)],#To calculate ADC between b100 and b1000
-                                               [slice(20,21),slice(29,30)],
-                                               [slice(40,41),slice(49,50)]]
-                    else:  slicing = [[slice(0,1),slice(9,10)]]# Array[slice(0,1)] same as [Array[0]]
-                    ADC_avg_M = torch.zeros(size = (len(slicing),M.shape[0],1,*M.shape[-2:]),device=rank)# len(slicing)=3 if 3D else = 1
-                    ADC_avg_images = torch.zeros(size = (len(slicing),images.shape[0],1,*images.shape[-2:]),device=rank)
-
-                    for diff_index,sl in enumerate(slicing):
-                        im100 = images[:,sl[0]]
-                        im1000 = images[:,sl[1]]
-                        im100= im100 + torch.tensor(0.0001, device=im100.device)
-                        im1000= im1000 + torch.tensor(0.0001, device=im100.device)
-                        ADC_avg_images[diff_index] = -torch.log(im1000 / im100) / (1000 -100)
-
-                        M100 = M[:, sl[0]]
-                        M1000 = M[:,sl[1]]
-                        M100= M100 + torch.tensor(0.0001, device=im100.device)
-                        M1000= M1000 +  torch.tensor(0.0001, device=im100.device)
-                        ADC_avg_M[diff_index] = -torch.log(M1000 / M100) / (1000 - 100)
-                    ADC_avg_images = torch.mean(ADC_avg_images,dim=0)
-                    ADC_avg_M = torch.mean(ADC_avg_M, dim=0)
-                ADC_loss_val = 1
-
-
-                if ADC_loss:
-                    criterion.update_data_range(torch.max(ADC_avg_images))
-                    loss = 9*1000*criterion(ADC_avg_M, ADC_avg_images, ssim_bool=False)
-                    # The 9 is arbitrary, depending on how much importance is given to the ADC loss relative to criterion(M,images)
-                    # The 1000 is for correct unit
-
-                    ADC_loss_val = loss.item()#Store for logging
-                    criterion.update_data_range(torch.max(images))
-                    loss += criterion(M, images,  ssim_bool=True)
+                #Foreground mask from b0-image. The physics head is then only evaluated on tissue voxels
+                mask = foreground_mask(image_b0, threshold=args.mask_threshold) if args.mask_background else None
+                loss_mask = mask if args.masked_loss else None
 
-                else:
-                    criterion.update_data_range(torch.max(images))
-                    loss = criterion(M,images, ssim_bool = True)
-                loss.backward()
+                if args.compile and global_step == 0 and i == 0 and (rank == 0 or sweeping):
+                    #Report where torch.compile has to split the loss step into several graphs
+                    with torch.no_grad():
+                        explain_graph_breaks(loss_step, images, image_b0, sigma, scale_factor, b, mask, loss_mask)
 
-                #Maximum gradient before clipping. For logging
-                max_grad_before = max(p.grad.abs().max().item() for p in net.parameters() if p.grad is not None)
+                #Gradients are only all-reduced between the GPUs in the backward pass of the last micro-batch before the optimizer step
+                with net.no_sync() if not sweeping and not step_now else nullcontext():
+                    loss, ADC_loss_val, distill_loss_val = run_loss_step(images, image_b0, sigma, scale_factor, b, mask, loss_mask)
+                    scaler.scale(loss / group_size).backward()#Accumulates the gradient of the mean loss of the group
+
+                avg_loss += loss.detach()
+                if rank ==0 or sweeping:
+                    micro_metrics = {'train loss': loss}
+                    if ADC_loss: micro_metrics['ADC_loss'] = ADC_loss_val
+                    if teacher is not None: micro_metrics['distillation loss'] = distill_loss_val
+                    for name, value in micro_metrics.items():
+                        group_metrics[name] = group_metrics.get(name, 0) + value.detach() / group_size
+                    pbar.update(images.shape[0])
+
+                if not step_now:
+                    continue
+
+                scaler.unscale_(optimizer)#Clipping and logging below use the true gradients
+
+                if rank == 0 or sweeping:
+                    #Gradients before clipping. For logging, read from the device when the metrics are flushed
+                    max_grad_before, grad_norm_before = gradient_norms(net.parameters())
 
                 #Clip gradients to a maximum value
                 torch.nn.utils.clip_grad_value_(net.parameters(), clip_value=1)
 
-                optimizer.step()
+                scale = scaler.get_scale()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
+                if scaler.get_scale() >= scale:
+                    #GradScaler skips the optimizer step if the gradients have inf/NaN values and decreases the scale,
+                    #the warmup only counts the steps that were taken
+                    warmup.step()
 
-                global_step += 1
+                global_step += 1#Counts optimizer steps
                 if rank ==0 or sweeping:
-                    #Log by one GPU
-                    experiment.log({
-                        'train loss': loss.item(),
-                        'ADC_loss': ADC_loss_val,
-                        'max gradient before clipping': max_grad_before,
-                        'step': global_step,
-                        'epoch': epoch
-                    })
-
-                avg_loss += loss.item()
-
-                if rank == 0 or sweeping:
-                    pbar.update(images.shape[0])
+                    #Log by one GPU, the losses are the means over the micro-batches of the step
+                    metrics.update(group_metrics, maxima={'max gradient before clipping': max_grad_before, 'gradient norm before clipping': grad_norm_before,
+                                                          **logits_monitor.collect()})
+                    group_metrics = {}
+                    if metrics.steps == args.log_every:
+                        experiment.log({**metrics.flush(), 'step': global_step, 'epoch': epoch})
+
+                if save_states and args.checkpoint_every and global_step % args.checkpoint_every == 0:
+                    save_state(epoch, start_sample + (i + 1 - start_batch) * batch_size * world_size, avg_loss)
+
+            start_batch, start_sample = 0, 0
+            if (rank == 0 or sweeping) and metrics.steps > 0:
+                #Rest of the epoch
+                experiment.log({**metrics.flush(), 'step': global_step, 'epoch': epoch})
+            avg_loss = float(avg_loss)#One read from the device per epoch
 
             with torch.no_grad():
-                val_loss, params, save_dict, M, img,sig = post_process.evaluate(val_loader, net, rank, b, input_sigma=input_sigma, ADC_loss= ADC_loss, use_3D=args.use_3D)
+                val_loss, params, save_dict, M, img,sig = post_process.evaluate(val_loader, net, device, b, input_sigma=input_sigma, ADC_loss= ADC_loss, use_3D=args.use_3D,
+                                                                                  mask_background=args.mask_background, masked_loss=args.masked_loss, mask_threshold=args.mask_threshold, amp=args.amp,
+                                                                                  snapshot=rank == 0 or sweeping)#Images and parameter maps are only logged by one GPU
             scheduler.step(torch.round(val_loss*10000)/10000)
             # The mul. with 10000 and rounding is a workaround to have
             # scheduler only look at 4 decimals
@@ -331,26 +509,27 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
                 logging.info('Validation Loss: {}'.format(val_loss))
                 logging_dict = {'learning rate': optimizer.param_groups[0]['lr'],
                             'validation Loss': val_loss,
-                            'Max M': M.cpu().max(),
-                            'Min M': M.cpu().min(),
-                            'max Image': img.cpu().max(),
-                            'min Image': img.cpu().min(),
                             'sigma_scale': net.sigma_scale.item() if os.getenv("WANDB_SWEEP_ID") else net.module.sigma_scale.item(),
                             'epoch': epoch,
                             'avg_loss':avg_loss/num_batches
                             }
 
-                logging_dict.update(params)#log model parameters
-                save_dict.update({
-                    'sigma_true' if input_sigma else 'predicted_sigma':sig.cpu(),
-                    'M': M.cpu(),
-                    'image': img.cpu()
-                })
-                image_save_path = Path(os.path.join(experiment.dir,'images'))
-                image_save_path.mkdir(parents=True, exist_ok=True)
+                if M is not None:#None if the validation shard of this GPU is empty, i.e. fewer validation slices than GPUs
+                    logging_dict.update({'Max M': M.cpu().max(),
+                                         'Min M': M.cpu().min(),
+                                         'max Image': img.cpu().max(),
+                                         'min Image': img.cpu().min()})
+                    logging_dict.update(params)#log model parameters
+                    save_dict.update({
+                        'sigma_true' if input_sigma else 'predicted_sigma':sig.cpu(),
+                        'M': M.cpu(),
+                        'image': img.cpu()
+                    })
+                    image_save_path = Path(os.path.join(experiment.dir,'images'))
+                    image_save_path.mkdir(parents=True, exist_ok=True)
+                    for k,v in save_dict.items():#Locally save images
+                        plt.imsave(os.path.join(image_save_path,f"{k}_{global_step}.png"), v, cmap="gray")  # Use cmap="gray" for grayscale images
                 experiment.log(logging_dict)
-                for k,v in save_dict.items():#Locally save images
-                    plt.imsave(os.path.join(image_save_path,f"{k}_{global_step}.png"), v, cmap="gray")  # Use cmap="gray" for grayscale images
             if val_loss < avg_loss/num_batches+2:# +2 leeway in considering as not overfitting
                 if rank == 0 or sweeping:
                     print(f'Not overfitting: val {val_loss:.4f} and avg_loss {avg_loss/num_batches:.4f}')
@@ -363,9 +542,6 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
                     print("Early stopping triggered. Reporting run as finished to wandb.")
                     if rank == 0 or sweeping:
                         if save_checkpoint:
-                            save_path = Path(
-                                os.path.join(dir_checkpoint, args.main_folder, training_model, fitting_model,
-                                             f'run_{run_number}'))
                             Path(save_path).mkdir(parents=True, exist_ok=True)
                             torch.save(net.state_dict(), str(save_path / 'checkpoint_epoch{}.pth'.format(epoch)))
                             logging.info(f'Checkpoint {epoch} saved!')
@@ -373,16 +549,14 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
                     print("Training stopped early due to overfitting.")
                     break
 
-
-
+        if save_states:
+            save_state(epoch + 1, 0, 0)#Start of the next epoch
 
 
         # save the model for the current epoch
         if (epoch>29 or optimizer.param_groups[0]['lr'] < 1e-6):#'lr' < 1e-6 is too low to learn effectively
 
             if (rank == 0 or sweeping) and save_checkpoint:
-                save_path = Path(
-                    os.path.join(dir_checkpoint, args.main_folder, training_model, fitting_model, f'run_{run_number}'))
                 Path(save_path).mkdir(parents=True, exist_ok=True)
                 torch.save(net.state_dict(), str(save_path / 'checkpoint_epoch{}.pth'.format(epoch)))
                 logging.info(f'Checkpoint {epoch} saved!')
@@ -390,6 +564,8 @@ def train_net(dataset, net, b, input_sigma: bool,experiment, training_model: str
             break
 
 
+    if checkpointer is not None:
+        checkpointer.wait()#Last training state on disk before the process ends
     if rank ==0 or sweeping:
         experiment.finish()
 
@@ -410,8 +586,9 @@ def get_args():
     parser.add_argument('--patientData', '-dir', type=str, default='/m2_data/mustafa/patientDataReduced/', help='Enther the directory saving the patient data')
     parser.add_argument('--custom_patient_list', '-clist', type=str, help='Input path to txt file with patient names to be used.')#default='new_patientList.txt'
     parser.add_argument('--input_sigma', '-s',  type=str, help='Use argument if sigma map is used as input.')
-    parser.add_argument('--training_model', '-trn', default='attention_unet',help='Specify which training model to use. Choose between ...,...,...')
-    parser.add_argument('--fitting_model', '-fit', default='biexp', help='Specify which fitting model to use')
+    parser.add_argument('--training_model', '-trn', default='attention_unet',help='Specify which training model to use. Choose between unet, attention_unet, res_atten_unet, shared_attention_unet and unet_2decoder. '
+                        'Append _w<width> for a width multiplier and/or _dw for depthwise-separable convolutions, e.g. attention_unet_w0.5_dw')
+    parser.add_argument('--fitting_model', '-fit', default='biexp', help='Specify which fitting model to use. For shared_attention_unet several fitting models joined by _, e.g. biexp_kurtosis_gamma')
     parser.add_argument('--run_number', '-rnum', default='1', help='This argument is used by sweep_train.py')
     parser.add_argument('--main_folder', '-folder', default='cross_validation_l1', help='Specify main folder name')
     parser.add_argument('--adc_as_loss', '-adc', type=str, help='Pass True if use ADC as loss function')
@@ -419,20 +596,57 @@ def get_args():
     parser.add_argument('--learn_sigma_scaling', '-ss', type= str, help='Pass True if allowing for AI to learn scaling sigma')
     parser.add_argument('--estimate_S0', '-s0', type= str, help='Pass True if allowing for AI to estimate S0-image')
     parser.add_argument('--feed_sigma', '-fs', type= str, help='Pass True if feeding sigma map to AI. Input sigma has to be true')
+    parser.add_argument('--mask_background', '-mask', type= str, help='Pass True if the physics head is only evaluated on foreground voxels, derived from the b0-image')
+    parser.add_argument('--masked_loss', '-mloss', type= str, help='Pass True if the loss is restricted to the foreground voxels. Mask_background has to be true')
+    parser.add_argument('--mask_threshold', '-mth', type=float, default=0.05, help='Fraction of the per-slice b0 maximum used as foreground threshold')
+    parser.add_argument('--channels_last', '-cl', type= str, help='Pass True to run the network and its inputs in channels_last memory format')
+    parser.add_argument('--compile', '-compile', type= str, help='Pass True to wrap the forward pass and loss in torch.compile')
+    parser.add_argument('--amp', '-amp', type= str, default=None, choices=['bf16', 'fp16'], help='Mixed precision for the convolutional part of the network. Physics head and loss stay in float32')
+    parser.add_argument('--checkpointing', '-ckpt', type= str, help='Pass True to recompute the activations of each encoder, decoder and attention stage in the backward pass, allows larger batches')
+    parser.add_argument('--stem', '-stem', type= str, default='dense', choices=['dense', 'grouped', 'shared'], help='Input layer of use_3D. dense: convolutions over all 60 channels, grouped: own convolutions per diffusion direction, shared: same convolutions for every direction. The features of the directions are fused afterwards')
+    parser.add_argument('--teacher', '-teacher', type= str, default=None, help='Path to a trained .pth file used as frozen teacher. Distills it into the trained network, which is usually smaller')
+    parser.add_argument('--teacher_model', '-tmodel', type= str, default='res_atten_unet', help='Network model of the teacher, e.g. res_atten_unet. Other settings (fitting model, input_sigma, ...) are the same as for the trained network')
+    parser.add_argument('--distill_target', '-dtarget', type= str, default='parameters', choices=['parameters', 'logits', 'both'], help='Predictions of the teacher the trained network is fitted to: parameter maps, logits before the physics head, or both')
+    parser.add_argument('--distill_weight', '-dweight', type=float, default=1.0, help='Weight of the distillation loss relative to the loss of the images')
+    parser.add_argument('--log_every', '-log', type=int, default=20, help='Number of training steps the logged train metrics are averaged over. They are read from the device once per log')
+    parser.add_argument('--accumulate_steps', '-acc', type=int, default=1, help='Number of micro-batches whose gradients are accumulated before each optimizer step. '
+                        'Effective batch size = batch size * accumulate_steps * number of GPUs. The GPUs only exchange gradients once per optimizer step')
+    parser.add_argument('--zero_optimizer', '-zero', type= str, help='Pass True to shard the Adam state between the GPUs (ZeroRedundancyOptimizer). Saves memory per GPU for larger batches, no effect in a sweep')
+    parser.add_argument('--lr_scaling', '-lrs', type= str, default='none', choices=list(LR_SCALINGS), help='Scale the learning rate with the samples per optimizer step (batch size * accumulate_steps * number of GPUs) '
+                        'relative to base_batch_size: linear, square root or none')
+    parser.add_argument('--base_batch_size', '-bb', type=int, default=12, help='Samples per optimizer step the learning rate is tuned for, reference of lr_scaling')
+    parser.add_argument('--warmup_steps', '-warmup', type=int, default=0, help='Number of optimizer steps over which the learning rate is ramped up linearly. Composes with the ReduceLROnPlateau scheduler')
+    parser.add_argument('--val_batch_size', '-vb', type=int, default=8, help='Batch size of the validation. The validation data is split between the GPUs')
+    parser.add_argument('--processes', '-np', type=int, default=1, help='Number of training processes if there are no GPUs. Each process trains on its own block of CPU cores, the processes communicate with gloo')
+    parser.add_argument('--threads', '-threads', type=int, default=None, help='Threads per CPU training process. Default: the available cores divided by the number of processes')
+    parser.add_argument('--checkpoint_every', '-ckpt_every', type=int, default=None, help='Write full training states (network, optimizer, scheduler, RNG, data order) in the background to the run folder, needed for resume. '
+                        'N: every N training steps and at the end of each epoch, 0: only at the end of each epoch. Not passed: no training states. '
+                        'Each state takes about three times the size of the .pth checkpoint (weights and the two Adam moments), keep_states of them are kept')
+    parser.add_argument('--keep_states', '-keep', type=int, default=2, help='Number of the newest full training states kept in the run folder')
+    parser.add_argument('--resume', '-resume', type=str, default=None, help='Path to a .ckpt training state to continue from, mid-epoch with the same data order. Pass True for the newest training state of this run. '
+                        'Processes restarted by torchrun continue from the newest training state of this run (needs checkpoint_every), which has to be on storage shared by all machines, or from this path if it is newer. '
+                        'With another number of processes than when it was saved, the remaining samples of the epoch are split between the processes and the random number generators are not restored')
 
 
     return parser.parse_args()
 
 
-def main(rank,world_size ,sweep):
+def main(rank,world_size ,sweep, local_rank=None):
 
+    args = get_args()
+    local_rank = rank if local_rank is None else local_rank#Process on this machine. Differs from rank with torchrun on several machines
+    device = training_device(local_rank)
     if not sweep:
-        #Setup parallel training on multiple GPUs
-        setup(rank,world_size)
+        #Setup parallel training on multiple GPUs, or on multiple CPU processes if there are no GPUs
+        setup(rank,world_size, local_rank)
+        if device.type == 'cpu':
+            threads = pin_threads(local_rank, int(os.getenv('LOCAL_WORLD_SIZE', world_size)), args.threads)
+            print(f'Process {rank} trains on the CPU with {threads} threads')
         torch.manual_seed(42)
         torch.cuda.manual_seed_all(42)
-    args = get_args()
     data_dir = args.patientData
+    #The noise maps of the dataset belong to a fitting model, the first one if several are trained with a shared encoder
+    data_fitting_model = parse_fitting_models(args.fitting_model)[0]
     if args.training_model == 'unetr': model_unetr= True#Required special dimensions for input data (208,240) or (240,240)
     else: model_unetr = False
     #If a select number of patients are used for training and not all patients in data_dir
@@ -442,36 +656,52 @@ def main(rank,world_size ,sweep):
             content = file.read().strip()  # Remove leading/trailing whitespace (if any)
             patient_list = content.split(',')
         #Dataset containing patients from the custom list only
-        patientData = patientDataset(data_dir=data_dir,input_sigma=args.input_sigma,  custom_list=patient_list, transform=False, crop = True,model_unetr =  model_unetr, use_3D=args.use_3D, fitting_model = args.fitting_model)
+        patientData = patientDataset(data_dir=data_dir,input_sigma=args.input_sigma,  custom_list=patient_list, transform=False, crop = True,model_unetr =  model_unetr, use_3D=args.use_3D, fitting_model = data_fitting_model)
     else:
         #Dataset containing all patients in data_dir
-        patientData = patientDataset(data_dir=data_dir,input_sigma=args.input_sigma, transform=False, crop = True,model_unetr =  model_unetr, use_3D=args.use_3D, fitting_model = args.fitting_model)
+        patientData = patientDataset(data_dir=data_dir,input_sigma=args.input_sigma, transform=False, crop = True,model_unetr =  model_unetr, use_3D=args.use_3D, fitting_model = data_fitting_model)
 
     if rank ==0:
         #Log by one GPU (with ID = 0) only
         logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-    b = torch.linspace(0, 2000, steps=21).cuda(non_blocking=True)
+    b = torch.linspace(0, 2000, steps=21).to(device, non_blocking=True)
     b = b[1:]
     n_channels = 20
     if args.use_3D: n_channels *= 3
+    assert args.stem == 'dense' or args.use_3D, 'Error: Argument stem needs use_3D'
+    assert args.stem == 'dense' or args.training_model != 'unet_2decoder', 'Error: unet_2decoder has no grouped or shared input layer'
+    #The stem is part of the name, so the checkpoint folders tell predict.py which network to build
+    training_model = args.training_model + (f'_{args.stem}_stem' if args.stem != 'dense' else '')
 
 
-    if args.training_model == 'attention_unet':
-        n_mess = "atten_unet"
-        net = Atten_Unet(n_channels=n_channels, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma).cuda()
-    elif args.training_model == 'unet':
-        n_mess = "unet"
-        net = UNet(n_channels=n_channels, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma).cuda()
-    elif args.training_model == 'res_atten_unet':
-        n_mess = "res_atten_unet"
-        net = Res_Atten_Unet(n_channels=n_channels, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma).cuda()
-    elif args.training_model == 'unet_2decoder':
+    if args.training_model == 'unet_2decoder':
         n_mess = "unet_2decoder"
-        net = UNet_2Decoders(n_channels=n_channels, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0).cuda()
+        net = UNet_2Decoders(n_channels=n_channels, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0).to(device)
+    else:
+        #unet, attention_unet, res_atten_unet or a lightweight variant such as attention_unet_w0.5_dw, see build_net
+        n_mess = training_model
+        net = build_net(training_model, n_channels, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma, checkpointing=args.checkpointing).to(device)
+
+    if args.channels_last:
+        net = net.to(memory_format=torch.channels_last)#Convolutions run faster on NHWC layout
+
+    teacher = None
+    if args.teacher:
+        assert len(parse_fitting_models(args.fitting_model)) == 1, 'Error: Argument teacher needs a network of one fitting model'
+        #shared_attention_unet returns a dictionary per fitting model and has one output convolution per decoder, even for one fitting model
+        assert not args.training_model.startswith('shared_attention_unet'), 'Error: Argument teacher can not be distilled into shared_attention_unet'
+        #Frozen network supervising net, predicts the same parameters
+        teacher = load_teacher(args.teacher, args.teacher_model, n_channels, next(net.parameters()).device, rice=True, input_sigma=args.input_sigma, fitting_model=args.fitting_model, use_3D=args.use_3D, learn_sigma_scaling=args.learn_sigma_scaling, estimate_S0 = args.estimate_S0, feed_sigma=args.feed_sigma)
+        if args.channels_last:
+            teacher = teacher.to(memory_format=torch.channels_last)
+        if rank == 0: logging.info(f'Distilling teacher {args.teacher_model} from {args.teacher} into {n_mess}')
 
     if rank == 0:
-        print("Using ", torch.cuda.device_count(), " GPUs!\n")
+        if device.type == 'cuda':
+            print("Using ", torch.cuda.device_count(), " GPUs!\n")
+        else:
+            print("Using ", world_size or 1, " CPU processes!\n")
         logging.info(f'Network:\n'
                      f'\t{n_mess}\n'
                      f'\t{net.n_channels} input channels\n'
@@ -486,17 +716,15 @@ def main(rank,world_size ,sweep):
         # The dataset can be partitioned and distributed to each GPU, were each GPU processes their assigned data through the forward pass of network
         # Weights on each GPU is synchronised and resulted gradient calculations are shared between GPUs.
         # Hence, DistributedDataParallel is used to achieve this and train in parallel
-        net = nn.parallel.DistributedDataParallel(net, device_ids=[rank])
+        net = nn.parallel.DistributedDataParallel(net, device_ids=[local_rank] if device.type == 'cuda' else None)#On the CPU, DDP uses the device of the parameters
     if args.load:
 
         if rank == 0: logging.info(f'Model loaded from {args.load}')
-        net.load_state_dict(torch.load(args.load))
+        net.load_state_dict(torch.load(args.load, map_location=device))
     else:
         net.apply(init_weights)#Weights initialization
 
 
-    device = None
-
     if os.getenv("WANDB_SWEEP_ID"):#Variable exists if sweep is used
         print('Running sweep')
         experiment = wandb.init(mode = 'online')
@@ -506,7 +734,6 @@ def main(rank,world_size ,sweep):
         epochs = config['epochs']
         batch_size =  config['batch_size']
         learning_rate =  config['learning_rate']
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print('Using device:', device)
 
     else:
@@ -538,9 +765,10 @@ def main(rank,world_size ,sweep):
                       save_checkpoint=True,
                       sweeping=True,
                       device=device,
-                      training_model = args.training_model,
+                      training_model = training_model,
                       fitting_model = args.fitting_model,
-                      run_number= args.run_number
+                      run_number= args.run_number,
+                      teacher = teacher
                       )
         else:
             train_net(dataset=patientData,
@@ -555,9 +783,11 @@ def main(rank,world_size ,sweep):
                       input_sigma=args.input_sigma,
                       experiment=experiment,
                       save_checkpoint=True,
-                      training_model = args.training_model,
+                      device=device,
+                      training_model = training_model,
                       fitting_model = args.fitting_model,
-                      run_number = args.run_number
+                      run_number = args.run_number,
+                      teacher = teacher
             )
     except KeyboardInterrupt:
         torch.save(net.state_dict(), 'INTERRUPTED.pth')
@@ -575,7 +805,15 @@ if __name__ == "__main__":
             logging.info('Exited')
             raise
 
+    elif 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        #Launched by torchrun, which starts one process per GPU (or per argument processes) on every machine and restarts
+        #them after a failure, e.g. torchrun --nnodes=2 --nproc_per_node=4 --rdzv_backend=c10d --rdzv_endpoint=host:29400 --max_restarts=3 train.py ...
+        #Rank, world size and master machine are read from the environment
+        main(rank=int(os.environ['RANK']), world_size=int(os.environ['WORLD_SIZE']), sweep=False, local_rank=int(os.getenv('LOCAL_RANK', '0')))
+
     else:
         sweep = False
-        world_size = torch.cuda.device_count()  # Number of GPUs
+        #One process per GPU. Without GPUs, argument processes CPU processes communicating with gloo
+        world_size = torch.cuda.device_count() if torch.cuda.is_available() else get_args().processes
+        os.environ.setdefault('MASTER_PORT', str(free_port()))#Inherited by the spawned processes
         mp.spawn(main, args=(world_size,sweep), nprocs=world_size)
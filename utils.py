@@ -1,8 +1,10 @@
 from cmath import sqrt
+import math
 
 import wandb
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torch
+import torch.distributed as dist
 import os
 from scipy import special
 import numpy as np
@@ -10,52 +12,208 @@ import torch.nn as nn
 import torchvision
 from torchvision import transforms
 from IPython import embed
-from pytorch_msssim import MS_SSIM
+from model.utils import foreground_mask
+from model.adc import ADC
+from model.loss import CustomLoss#Also used from here by train.py, predict.py and the tools
 
 
-class CustomLoss(nn.Module):
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
 
+def amp_autocast(amp, device_type):
     """
-    Custom loss function: :math:`L` = (1-SSIM) :math:`\cdot` MSEloss
+    Autocast context for mixed precision. The physics head and the loss stay in float32 through *float32_policy*.
+
+    :param amp: None (float32), 'bf16' or 'fp16'
+    :param device_type: 'cuda' or 'cpu'
+    """
+    return torch.autocast(device_type=device_type, dtype=AMP_DTYPES.get(amp, torch.bfloat16), enabled=bool(amp))
+
+def gradient_norms(parameters):
+    """
+    Largest absolute gradient and L2 norm of all gradients, as 0-dim tensors on the device of the gradients.
+    Uses the multi-tensor (foreach) norm, one kernel for all parameters, and does not wait for the device.
+
+    :param parameters: Parameters of the network, e.g. net.parameters()
+    :return: tuple (max_grad, grad_norm)
+    """
+    grads = [p.grad for p in parameters if p.grad is not None]
+    max_grad = torch.stack(torch._foreach_norm(grads, float('inf'))).max()
+    grad_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads, 2.0)))
+    return max_grad, grad_norm
+
+class MetricAccumulator:
+    """
+    Running sums and maxima of training metrics, kept as tensors on the device. Reading a value from the device
+    (e.g. loss.item()) makes the host wait for all queued kernels, so the values are read together in *flush*.
 
     Example:
 
-        >>>loss = CustomLoss()
+        >>>metrics = MetricAccumulator()
 
-        >>>loss_value = loss(predicted,target)
+        >>>metrics.update({'train loss': loss}, maxima={'max gradient': max_grad})#Every step
+
+        >>>if metrics.steps == 50: experiment.log(metrics.flush())#Means and maxima over the 50 steps
     """
 
-    def __init__(self):
-        super(CustomLoss, self).__init__()
-        # For one dimensional channel, for example when inputting ADC map in loss function.
-        self.ssim_loss = MS_SSIM(channel=1, win_size=5)
-        self.ssim_loss2 = MS_SSIM(channel=20, win_size=5)#Default number of channels
-        self.ssim_loss3 = MS_SSIM(channel=60, win_size=5)#If we use 3D in training
-        self.mse_loss =  nn.L1Loss()#nn.MSELoss()
-    def update_data_range(self, range):
-        self.ssim_loss.data_range = range
-    def forward(self, M,images, ssim_bool = False, only_ssim = False):
+    def __init__(self, limits: dict = None):
         """
-      :param M: The predicted data/image
-      :param images: The target data/image
-      :param ssim_bool: If True, ssim is part of the loss function. Else only L1 is calculated
-      :param only_ssim: If True, the loss function will only be = 1-ssim. L1 would not be included.
-      """
-
-        if M.shape[1]>1 and M.shape[1]<21 and ssim_bool:
-            loss_ssim = 1 - self.ssim_loss2(M, images)
-        elif M.shape[1]>21 and ssim_bool:
-            loss_ssim = 1 - self.ssim_loss3(M, images)
-        elif ssim_bool:
-            loss_ssim = 1 - self.ssim_loss(M, images)
-        else:
-            loss_ssim = 1
+        :param limits: Metric name -> largest expected value. *flush* prints a warning for metrics above it or NaN,
+            e.g. {'max logit': 1e10}, without reading them from the device in every step.
+        """
+        self.sums = {}
+        self.maxima = {}
+        self.steps = 0#Steps since the last flush
+        self.limits = limits or {}
 
-        if not only_ssim:
-            loss_mse = self.mse_loss(M,images)
-        else:
-            loss_mse = 1
-        return loss_ssim * loss_mse
+    def update(self, values: dict, maxima: dict = None):
+        """
+        Add one step.
+
+        :param values: Metric name -> 0-dim tensor, averaged over the steps in *flush*
+        :param maxima: Metric name -> 0-dim tensor, maximum over the steps in *flush*
+        """
+        for name, value in values.items():
+            value = value.detach().float()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+        for name, value in (maxima or {}).items():
+            value = value.detach().float()
+            self.maxima[name] = torch.maximum(self.maxima[name], value) if name in self.maxima else value
+        self.steps += 1
+
+    def flush(self):
+        """
+        :return: dict metric name -> float, read from the device with one transfer. The sums and maxima are reset
+        """
+        names = list(self.sums) + list(self.maxima)
+        if not names:
+            return {}
+        values = dict(zip(names, torch.stack([total / self.steps for total in self.sums.values()] + list(self.maxima.values())).tolist()))
+        for name, limit in self.limits.items():
+            if name in values and not values[name] <= limit:
+                print(f'-Warning: {name} was {values[name]} in the last {self.steps} steps, more than {limit}.\n')
+        self.sums, self.maxima, self.steps = {}, {}, 0
+        return values
+
+class LogitsMonitor:
+    """
+    Number of NaN values and maximum of the logits, the outputs of the last convolutions *outc* of a network, in the
+    training forward passes since the last *collect*. They stay on the device, so a check in every forward pass does not
+    make the host wait for the device. Give them to *MetricAccumulator* with limits, which reports them when flushed.
+
+    Example:
+
+        >>>monitor = LogitsMonitor(net)
+
+        >>>metrics = MetricAccumulator(limits=LogitsMonitor.LIMITS)
+
+        >>>metrics.update({'train loss': loss}, maxima=monitor.collect())#Every step
+    """
+    LIMITS = {'NaN logits': 0, 'max logit': 1e10}
+
+    def __init__(self, net: nn.Module):
+        self.nan = None
+        self.max = None
+        #One output convolution per decoder, e.g. per fitting model of shared_attention_unet
+        self.handles = [module.register_forward_hook(self.hook) for name, module in net.named_modules() if name.split('.')[-1] == 'outc']
+
+    def hook(self, module, inputs, output):
+        if not module.training:#Validation and inference
+            return
+        output = output.detach()
+        nan, maximum = torch.isnan(output).sum(), output.max().float()
+        self.nan = nan if self.nan is None else torch.maximum(self.nan, nan)
+        self.max = maximum if self.max is None else torch.maximum(self.max, maximum)
+
+    def collect(self):
+        """
+        :return: dict 'NaN logits' (most NaN values of one forward pass) and 'max logit' -> 0-dim tensor, empty if there
+            was no training forward pass. Reset for the next steps
+        """
+        if self.nan is None:
+            return {}
+        collected = {'NaN logits': self.nan, 'max logit': self.max}
+        self.nan, self.max = None, None
+        return collected
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+LR_SCALINGS = ('none', 'linear', 'sqrt')
+
+def scale_learning_rate(learning_rate, global_batch_size, base_batch_size, scaling='linear'):
+    """
+    Learning rate for *global_batch_size* samples per optimizer step (all GPUs and accumulated micro-batches), given the
+    learning rate tuned for *base_batch_size* samples per step. With the linear rule, k times more samples per step take
+    a k times larger step, so the training follows the same path per sample when GPUs are added.
+
+    :param scaling: 'none', 'linear' or 'sqrt'
+    """
+    assert scaling in LR_SCALINGS, f'Error: Unknown learning rate scaling {scaling}, choose between {", ".join(LR_SCALINGS)}'
+    ratio = global_batch_size / base_batch_size
+    if scaling == 'linear':
+        return learning_rate * ratio
+    if scaling == 'sqrt':
+        return learning_rate * math.sqrt(ratio)
+    return learning_rate
+
+class LinearWarmup:
+    """
+    Linear warmup of the learning rate over the first *warmup_steps* optimizer steps, from 1/warmup_steps of the
+    learning rate to the full learning rate. Large scaled learning rates are unstable in the first steps.
+
+    The warmup multiplies the learning rate of the param_groups by the change of its factor in every step, instead of
+    setting it. Reductions of ReduceLROnPlateau, which also multiply the learning rate, are therefore kept.
+
+    Example:
+
+        >>>warmup = LinearWarmup(optimizer, warmup_steps=500)
+
+        >>>optimizer.step(); warmup.step()#Every optimizer step
+
+        >>>scheduler.step(val_loss)#ReduceLROnPlateau, every epoch
+    """
+
+    def __init__(self, optimizer, warmup_steps: int):
+        self.optimizer = optimizer
+        self.warmup_steps = warmup_steps
+        self.steps = 0
+        self.rescale(1.0, self.factor())
+
+    def factor(self, steps=None):
+        steps = self.steps if steps is None else steps
+        return min(1.0, (steps + 1) / self.warmup_steps) if self.warmup_steps > 0 else 1.0
+
+    def rescale(self, old_factor, new_factor):
+        for group in self.optimizer.param_groups:
+            group['lr'] *= new_factor / old_factor
+
+    def step(self):
+        old_factor = self.factor()
+        self.steps += 1
+        self.rescale(old_factor, self.factor())
+
+    def state_dict(self):
+        return {'steps': self.steps}
+
+    def load_state_dict(self, state):
+        """The learning rates are part of the state of the optimizer, only the step count is restored"""
+        self.steps = state['steps']
+
+class ShardSampler(Sampler):
+    """
+    Every *num_replicas*-th sample of *dataset*, starting at *rank*, in order. Unlike DistributedSampler, no samples
+    are repeated to give all processes the same number, so the validation loss summed over the processes is exact.
+    """
+
+    def __init__(self, dataset, num_replicas: int = 1, rank: int = 0):
+        self.indices = list(range(rank, len(dataset), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
 
 class post_processing():
     """
@@ -63,10 +221,16 @@ class post_processing():
     """
     def __init__(self):
         super().__init__()
+        self.criterion = CustomLoss()#Reused by every evaluation
 
-    def evaluate(self, val_loader, net, rank, b, input_sigma: bool, ADC_loss,use_3D):
+    def evaluate(self, val_loader, net, rank, b, input_sigma: bool, ADC_loss,use_3D, mask_background=False, masked_loss=False, mask_threshold=0.05, amp=None, snapshot=True):
         """
-        Here, validation data is used to monitor the training
+        Here, validation data is used to monitor the training.
+
+        With several processes, each evaluates the shard of the validation data given by the sampler of *val_loader*
+        (see *ShardSampler*) and the losses are summed over the processes with all_reduce, so every process returns the
+        loss of the whole validation data. The loss is the mean over the slices, computed per slice as with a batch size
+        of 1, so it does not depend on the batch size of *val_loader* or on the number of processes.
 
         :param: val_loader: DataLoader for validation data
         :param: net: the neural network model
@@ -75,98 +239,95 @@ class post_processing():
         :param: input_sigma:Boolean, if a known noise map is input to the neural network.
         :param: ADC_loss: Boolean, if loss based on ADC maps is implemented.
         :param: use_3D: Boolean, if 3D is implemented.
+        :param: mask_background: Boolean, if the physics head is only evaluated on foreground voxels derived from the b0-image.
+        :param: masked_loss: Boolean, if the loss is restricted to the foreground voxels.
+        :param: mask_threshold: Fraction of the per-slice b0 maximum used as foreground threshold.
+        :param: amp: None, 'bf16' or 'fp16'. Mixed precision used for the convolutional part of the network.
+        :param: snapshot: Boolean, if the parameter maps and images of the last batch are returned, only needed by the logging process.
+            Otherwise the dictionaries are empty and the images None.
 
         """
-        criterion = CustomLoss()
+        criterion = self.criterion
+        adc_map = ADC(b, n_directions=3 if use_3D else 1)#For the ADC loss
+        if isinstance(net, nn.parallel.DistributedDataParallel):
+            net = net.module#The shards differ in size, the wrapper would synchronize the forward passes
         net.eval()
-        val_losses = 0
-        final_sigma = 0
+        device = next(net.parameters()).device
+        totals = torch.zeros(2, device=device)#Sum of the losses and number of slices, summed over the processes
         log_dict = {}
         save_dict = {}
+        M_snapshot, image_snapshot, final_sigma = None, None, None
         for i, (images, image_b0, sigma, scale_factor) in enumerate(val_loader):
-            log_dict = {}
-            save_dict = {}
 
             images = images.to(rank, dtype=torch.float32, non_blocking=True)# (n_batches, 20 or 60 if use_3D , 200, 240)
             sigma = sigma.to(rank, dtype=torch.float32, non_blocking=True)# (n_batches, 1, 200, 240)
             image_b0 = image_b0.to(rank, dtype=torch.float32, non_blocking=True)# (n_batches, 1, 200, 240)
             scale_factor = scale_factor.to(rank, dtype=torch.float32, non_blocking=True)#(n_batches,)
-            M, param_dict = net(images,b,image_b0, sigma, scale_factor)
+            mask = foreground_mask(image_b0, threshold=mask_threshold) if mask_background else None
+            loss_mask = mask if masked_loss else None
+            with amp_autocast(amp, images.device.type):
+                outputs = net(images,b,image_b0, sigma, scale_factor, mask)
             # M: (n_batches, 20 or 60 if use_3D, 200, 240)
+            #Shared encoder (shared_attention_unet): one tuple (M, param_dict) per fitting model, the validation loss is their mean
+            fit_outputs = list(outputs.items()) if isinstance(outputs, dict) else [('', outputs)]
 
-            M = M * scale_factor.view(-1, 1, 1, 1)
             images = images * scale_factor.view(-1, 1, 1, 1)
-
-            if ADC_loss:
-                if use_3D:
-                    slicing = [[slice(0, 1), slice(9, 10)],#To calculate ADC between b100 and b1000
-                               [slice(20, 21), slice(29, 30)],
-                               [slice(40, 41), slice(49, 50)]]
-                else:
-                    slicing = [[slice(0, 1), slice(9, 10)]]# Array[slice(0,1)] same as [Array[0]]
-                ADC_avg_M = torch.zeros(size=(len(slicing), M.shape[0], 1, *M.shape[-2:]), device=rank)# len(slicing)=3 if 3D else = 1
-                ADC_avg_images = torch.zeros(size=(len(slicing), images.shape[0], 1, *images.shape[-2:]), device=rank)
-
-                for diff_index, sl in enumerate(slicing):
-                    im100 = images[:, sl[0]]
-                    im1000 = images[:, sl[1]]
-                    im100 = im100 + torch.tensor(0.0001, device=im100.device)
-                    im1000 = im1000 + torch.tensor(0.0001, device=im100.device)
-                    ADC_avg_images[diff_index] = -torch.log(im1000 / im100) / (1000 - 100)
-
-                    M100 = M[:, sl[0]]
-                    M1000 = M[:, sl[1]]
-                    M100 = M100 + torch.tensor(0.0001, device=im100.device)
-                    M1000 = M1000 + torch.tensor(0.0001, device=im100.device)
-                    ADC_avg_M[diff_index] = -torch.log(M1000 / M100) / (2000 - 100)
-                ADC_avg_images = torch.mean(ADC_avg_images, dim=0)
-                ADC_avg_M = torch.mean(ADC_avg_M, dim=0)
-            ADC_loss_val = 1
-
-            if ADC_loss:
-                criterion.update_data_range(torch.max(ADC_avg_images))
-                loss = 9 * 1000 * criterion(ADC_avg_M, ADC_avg_images, ssim_bool=False)
-                # The 9 is arbitrary, depending on how much importance is given to the ADC loss relative to criterion(M,images)
-                # The 1000 is for correct unit
-
-                ADC_loss_val = loss.item()
-                criterion.update_data_range(torch.max(images))
-                loss += criterion(M, images, ssim_bool=True)
-
-            else:
-                criterion.update_data_range(torch.max(images))
-                loss = criterion(M, images, ssim_bool=True)
-
-
-
-
-            loss_value = torch.tensor(loss.item())
-
-            if i == len(val_loader) - 1:#Last batch
-                first_indices = [param_dict['names'].index(val) for val in dict.fromkeys(param_dict['names'])]
-                #returns parameter names, e.g. ['d1','d2','f']
-
-                for inde in first_indices:
-                    res = param_dict['parameters'][inde][0]#Parameter array
-                    key = param_dict['names'][inde]#Parameter name
-                    res = res.cpu().detach().numpy()
-                    res_min = np.min(res)
-                    res_max = np.max(res)
-                    log_dict.update({#For logging
-                                     f'{key}_min': res_min,
-                                     f'{key}_max': res_max,
-                                     })
-                    save_dict.update({f'{key}': res / res_max})#For saving the array as image
-
-                if input_sigma:#If a known noise map is input
-                    final_sigma = sigma[0,0,:,:]#The known noise map
-                else:
-                    final_sigma  =param_dict['sigma'][0,0,:,:]#Noise map from neural network
-
-
-            val_losses += loss_value
-                                                                #For saving the predicted and target image
-        return val_losses/len(val_loader), log_dict, save_dict, M[0, 9, :, :], images[0, 9, :, :], final_sigma
+            for fit, (M, param_dict) in fit_outputs:
+                prefix = f'{fit}_' if fit else ''#Parameter names of the fitting models are logged separately
+                M = M * scale_factor.view(-1, 1, 1, 1)
+
+                if ADC_loss:
+                    #ADC between b100 and b1000, averaged over the diffusion directions
+                    ADC_avg_images = adc_map(images)
+                    ADC_avg_M = adc_map(M)
+
+                for j in range(images.shape[0]):
+                    #The data range of the loss is the maximum of each slice
+                    slice_mask = loss_mask[j:j + 1] if loss_mask is not None else None
+                    if ADC_loss:
+                        criterion.update_data_range(torch.max(ADC_avg_images[j]))
+                        loss = 9 * 1000 * criterion(ADC_avg_M[j:j + 1], ADC_avg_images[j:j + 1], ssim_bool=False, mask=slice_mask)
+                        # The 9 is arbitrary, depending on how much importance is given to the ADC loss relative to criterion(M,images)
+                        # The 1000 is for correct unit
+
+                        criterion.update_data_range(torch.max(images[j]))
+                        loss += criterion(M[j:j + 1], images[j:j + 1], ssim_bool=True, mask=slice_mask)
+
+                    else:
+                        criterion.update_data_range(torch.max(images[j]))
+                        loss = criterion(M[j:j + 1], images[j:j + 1], ssim_bool=True, mask=slice_mask)
+
+                    totals[0] += loss.detach() / len(fit_outputs)#Stays on the device, read once after all batches
+
+                if snapshot and i == len(val_loader) - 1:#Last batch
+                    first_indices = [param_dict['names'].index(val) for val in dict.fromkeys(param_dict['names'])]
+                    #returns parameter names, e.g. ['d1','d2','f']
+
+                    for inde in first_indices:
+                        res = param_dict['parameters'][inde][0]#Parameter array
+                        key = param_dict['names'][inde]#Parameter name
+                        res = res.cpu().detach().numpy()
+                        res_min = np.min(res)
+                        res_max = np.max(res)
+                        log_dict.update({#For logging
+                                         f'{prefix}{key}_min': res_min,
+                                         f'{prefix}{key}_max': res_max,
+                                         })
+                        save_dict.update({f'{prefix}{key}': res / res_max})#For saving the array as image
+
+                    if input_sigma:#If a known noise map is input
+                        final_sigma = sigma[0,0,:,:]#The known noise map
+                    else:
+                        final_sigma  =param_dict['sigma'][0,0,:,:]#Noise map from neural network
+                    #For saving the predicted and target image
+                    M_snapshot, image_snapshot = M[0, 9, :, :], images[0, 9, :, :]
+
+            totals[1] += images.shape[0]
+
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)#Losses and slices of all shards
+        val_loss = (totals[0] / totals[1]).cpu()
+        return val_loss, log_dict, save_dict, M_snapshot, image_snapshot, final_sigma
 
 class patientDataset(Dataset):
     '''
@@ -338,4 +499,26 @@ def init_weights(model):
 
         # Apply Xavier initialization for Linear layers if any (you may not have any in your current structure)
         elif isinstance(module, nn.Linear):
-            nn.init.xavier_uniform_(module.weight)
\ No newline at end of file
+            nn.init.xavier_uniform_(module.weight)
+
+def to_channels_last(*tensors):
+    """
+    Convert 4D tensors (n_batches, C, H, W) to channels_last memory format. Other tensors are returned unchanged.
+    """
+    return [t.contiguous(memory_format=torch.channels_last) if t.dim() == 4 else t for t in tensors]
+
+def explain_graph_breaks(fn, *inputs):
+    """
+    Run *fn* once through torch._dynamo.explain and print where torch.compile has to break the graph.
+
+    :param fn: Function or module that is to be compiled
+    :param inputs: Example inputs passed to *fn*
+    :return: Number of graph breaks
+    """
+    explanation = torch._dynamo.explain(fn)(*inputs)
+    print(f'torch.compile: {explanation.graph_count} graph(s), {explanation.graph_break_count} graph break(s)')
+    for reason in explanation.break_reasons:
+        frame = reason.user_stack[-1] if reason.user_stack else None
+        location = f' ({frame.filename}:{frame.lineno})' if frame is not None else ''
+        print(f'   - {reason.reason}{location}')
+    return explanation.graph_break_count